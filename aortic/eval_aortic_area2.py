@@ -14,19 +14,72 @@
 # ==============================================================================
 import os
 import numpy as np
-import nibabel as nib
 import pandas as pd
 import re
 import argparse
+from ukbb_cardiac.common.image_utils import label_counts
 from ukbb_cardiac.common.cardiac_utils import aorta_pass_quality_control
+from ukbb_cardiac.common.nifti_cache import load_nifti, find_image
+from ukbb_cardiac.common.eval_utils import evaluate_subjects, MISSING
 
 DATA_PATTERN = re.compile('(\d+)_(\d+)')
 
+COLUMNS = ['AAo max area (mm2)', 'AAo min area (mm2)', 'AAo max diameter (mm)', 'AAo min diameter (mm)', 'AAo distensibility (10-3 mmHg-1)',
+           'DAo max area (mm2)', 'DAo min area (mm2)', 'DAo max diameter (mm)', 'DAo min diameter (mm)', 'DAo distensibility (10-3 mmHg-1)']
+
+
+def process_subject(data_dir, central_pp_value):
+    """ Evaluate the aortic areas and diameters of one subject, or return None if it is skipped
+        and MISSING if its files are missing
+        """
+    image_name = os.path.join(data_dir, 'ao.nii.gz')
+    seg_name = find_image(os.path.join(data_dir, 'seg_ao.nii.gz'))
+    if not os.path.exists(image_name) or not os.path.exists(seg_name):
+        return MISSING
+
+    # Read image
+    nim = load_nifti(image_name)
+    dx, dy = nim.header['pixdim'][1:3]
+    area_per_pixel = dx * dy
+    image = nim.get_data()
+
+    # Read segmentation
+    nim = load_nifti(seg_name)
+    seg = nim.get_data()
+
+    if not aorta_pass_quality_control(image, seg):
+        return None
+
+    # Measure the maximal and minimal area for the ascending aorta and descending aorta
+    areas = label_counts(seg, 3) * area_per_pixel
+    val = {}
+    for l_name, l in [('AAo', 1), ('DAo', 2)]:
+        val[l_name] = {}
+        A = areas[:, l]
+        max_area = A.max()
+        min_area = A.min()
+        max_diameter = 2*np.sqrt(max_area/np.pi)
+        min_diameter = 2*np.sqrt(min_area/np.pi)
+        val[l_name]['max area'] = max_area
+        val[l_name]['min area'] = min_area
+        val[l_name]['max diameter'] = max_diameter
+        val[l_name]['min diameter'] = min_diameter
+        val[l_name]['distensibility'] = (max_area - min_area) / (min_area * central_pp_value) * 1e3
+
+    line = [val['AAo']['max area'], val['AAo']['min area'], val['AAo']['max diameter'], val['AAo']['min diameter'], val['AAo']['distensibility'],
+            val['DAo']['max area'], val['DAo']['min area'], val['DAo']['max diameter'], val['DAo']['min diameter'], val['DAo']['distensibility']]
+    return line
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', metavar='dir_name', default='', required=True)
     parser.add_argument('--pressure_csv', metavar='csv_name', default='', required=True)
     parser.add_argument('--output_csv', metavar='csv_name', default='', required=True)
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of subjects which are evaluated in parallel')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also save the table in the Parquet format')
     args = parser.parse_args()
 
     # Read the spreadsheet for blood pressure information
@@ -63,58 +116,16 @@ if __name__ == '__main__':
 
     data_path = args.data_dir
     data_list = sorted(os.listdir(data_path))
-    table = []
-    processed_list = []
+    jobs = []
     for data in data_list:
-        data_dir = os.path.join(data_path, data)
-        image_name = os.path.join(data_dir, 'ao.nii.gz')
-        seg_name = os.path.join(data_dir, 'seg_ao.nii.gz')
-
         m = DATA_PATTERN.match(data)
         if not m:
             print(f'warning: skip invalid data "{data}"')
             continue
         eid = int(m.group(1))
-        if os.path.exists(image_name) and os.path.exists(seg_name):
-            print(data)
-            
-            central_pp_value = central_pp.loc[eid] if eid in central_pp.index else np.nan
-
-            # Read image
-            nim = nib.load(image_name)
-            dx, dy = nim.header['pixdim'][1:3]
-            area_per_pixel = dx * dy
-            image = nim.get_data()
-
-            # Read segmentation
-            nim = nib.load(seg_name)
-            seg = nim.get_data()
-
-            if not aorta_pass_quality_control(image, seg):
-                continue
-
-            # Measure the maximal and minimal area for the ascending aorta and descending aorta
-            val = {}
-            for l_name, l in [('AAo', 1), ('DAo', 2)]:
-                val[l_name] = {}
-                A = np.sum(seg == l, axis=(0, 1, 2)) * area_per_pixel
-                max_area = A.max()
-                min_area = A.min()
-                max_diameter = 2*np.sqrt(max_area/np.pi)
-                min_diameter = 2*np.sqrt(min_area/np.pi)
-                val[l_name]['max area'] = max_area
-                val[l_name]['min area'] = min_area
-                val[l_name]['max diameter'] = max_diameter
-                val[l_name]['min diameter'] = min_diameter
-                val[l_name]['distensibility'] = (max_area - min_area) / (min_area * central_pp_value) * 1e3
-
-            line = [val['AAo']['max area'], val['AAo']['min area'], val['AAo']['max diameter'], val['AAo']['min diameter'], val['AAo']['distensibility'],
-                    val['DAo']['max area'], val['DAo']['min area'], val['DAo']['max diameter'], val['DAo']['min diameter'], val['DAo']['distensibility']]
-            table += [line]
-            processed_list += [data]
-
-    # Save the spreadsheet for the measures
-    df = pd.DataFrame(table, index=processed_list,
-                      columns=['AAo max area (mm2)', 'AAo min area (mm2)', 'AAo max diameter (mm)', 'AAo min diameter (mm)', 'AAo distensibility (10-3 mmHg-1)',
-                               'DAo max area (mm2)', 'DAo min area (mm2)', 'DAo max diameter (mm)', 'DAo min diameter (mm)', 'DAo distensibility (10-3 mmHg-1)'])
-    df.to_csv(args.output_csv)
+        central_pp_value = central_pp.loc[eid] if eid in central_pp.index else np.nan
+        jobs.append((data, (os.path.join(data_path, data), central_pp_value)))
+
+    # Evaluate the subjects and save the measures in batches of the results store
+    evaluate_subjects(process_subject, jobs, args.output_csv, COLUMNS, args.workers,
+                      parquet=args.parquet)
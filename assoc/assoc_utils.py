@@ -0,0 +1,249 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Vectorised statistics for the phenome-wide association studies.
+
+    The data are matrices of subjects x phenotypes, where NaN denotes a missing value.
+    The statistics between two phenotypes are computed over the pairwise complete
+    observations, i.e. the subjects for which both phenotypes are available.
+    """
+import math
+import numpy as np
+import pandas as pd
+import scipy.special
+
+# Number of columns processed at a time
+CHUNK_SIZE = 500
+
+
+def age_by_date(year_of_birth, month_of_birth, date):
+    """
+        Age in years, rounded to 1 decimal, at the dates 'YYYY-MM-DD' for the subjects
+        born on the 15th day of the given months. The age is NaN if any field is missing.
+        """
+    birth = pd.to_datetime(pd.DataFrame({'year': year_of_birth,
+                                         'month': month_of_birth,
+                                         'day': 15}))
+    visit = pd.to_datetime(pd.Series(date).values, format='%Y-%m-%d')
+    days = (visit - pd.DatetimeIndex(birth)).days.values.astype(np.float64)
+    return np.round(days / 365.25, 1)
+
+
+def normalise(x):
+    return (x - np.mean(x)) / np.std(x)
+
+
+def normalise_columns(X):
+    """ Standard normalisation of each column of X over its valid values """
+    X = np.asarray(X, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (X - np.nanmean(X, axis=0)) / np.nanstd(X, axis=0)
+
+
+def rank_columns(X):
+    """
+        Ranks of the valid values of each column of X, starting from 1, with the average
+        rank for tied values as scipy.stats.rankdata(). The rank is NaN for a missing value.
+        """
+    n = X.shape[0]
+    # Missing values are sorted to the end of each column
+    order = np.argsort(X, axis=0, kind='mergesort')
+    xs = np.take_along_axis(X, order, axis=0)
+
+    # The first and the last positions of the group of tied values at each position
+    idx = np.arange(n).reshape(-1, 1)
+    new_group = np.ones(X.shape, dtype=bool)
+    new_group[1:] = xs[1:] != xs[:-1]
+    first = np.maximum.accumulate(np.where(new_group, idx, 0), axis=0)
+    end_group = np.ones(X.shape, dtype=bool)
+    end_group[:-1] = new_group[1:]
+    last = np.minimum.accumulate(np.where(end_group, idx, n - 1)[::-1], axis=0)[::-1]
+
+    ranks = np.empty(X.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=0)
+    ranks[np.isnan(X)] = np.nan
+    return ranks
+
+
+def rank_normalise(x):
+    # Rank-based inverse normal transform
+    # Please refer to the function inormal() in the FSLNets package
+    return rank_normalise_columns(np.reshape(x, (-1, 1)))[:, 0]
+
+
+def rank_normalise_columns(X, chunk_size=CHUNK_SIZE):
+    """ Rank-based inverse normal transform of each column of X over its valid values """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.full(X.shape, np.nan)
+    for start in range(0, X.shape[1], chunk_size):
+        end = min(start + chunk_size, X.shape[1])
+        # Tied values get the average of their ranks, which is rounded down, as the
+        # ranks were stored as integers in the previous implementation
+        ri = np.floor(rank_columns(X[:, start:end]))
+
+        # p squashes the rank into the range of [0, 1]
+        # erfinv can generate a distribution from 2 * p - 1 with 0 mean and 1 standard deviation
+        N = np.sum(~np.isnan(X[:, start:end]), axis=0)
+        c = 3.0 / 8
+        p = (ri - c) / (N - 2 * c + 1)
+        Y[:, start:end] = math.sqrt(2) * scipy.special.erfinv(2 * p - 1)
+    return Y
+
+
+def masked_corr(X, Y):
+    """
+        Pearson correlation between the columns of X (n x M) and the columns of Y (n x N)
+        over the pairwise complete observations.
+
+        Returns the M x N correlation matrix and the M x N numbers of observations.
+        The correlation is NaN if a column is constant over the observations.
+        """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    mx = ~np.isnan(X)
+    my = ~np.isnan(Y)
+    fx = mx.astype(np.float64)
+    fy = my.astype(np.float64)
+
+    # Centre each column by its mean, which does not change the correlation but
+    # keeps the sums below accurate. Missing values are set to 0 so that they do
+    # not contribute to the sums.
+    mean_x = np.nansum(X, axis=0) / np.maximum(np.sum(mx, axis=0), 1)
+    mean_y = np.nansum(Y, axis=0) / np.maximum(np.sum(my, axis=0), 1)
+    X0 = np.where(mx, X - mean_x, 0)
+    Y0 = np.where(my, Y - mean_y, 0)
+
+    # Sums over the pairwise complete observations, as matrix products
+    n = np.dot(fx.T, fy)
+    sx = np.dot(X0.T, fy)
+    sy = np.dot(fx.T, Y0)
+    sxx = np.dot((X0 ** 2).T, fy)
+    syy = np.dot(fx.T, Y0 ** 2)
+    sxy = np.dot(X0.T, Y0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vx = sxx - sx ** 2 / n
+        vy = syy - sy ** 2 / n
+        r = (sxy - sx * sy / n) / np.sqrt(vx * vy)
+
+    # Constant columns, up to the rounding error of the sums
+    r[(vx <= 1e-12 * sxx) | (vy <= 1e-12 * syy)] = np.nan
+    r = np.clip(r, -1, 1)
+    return r, n.astype(np.int64)
+
+
+def pearson_p(r, n):
+    """
+        Two-sided p-value of the Pearson correlation r over n observations, the same as
+        scipy.stats.pearsonr(). The p-value is NaN for fewer than 3 observations.
+        """
+    r = np.asarray(r, dtype=np.float64)
+    n = np.asarray(n)
+    # Under the null hypothesis, (r + 1) / 2 follows a beta distribution B(n/2 - 1, n/2 - 1)
+    ab = np.maximum(n / 2.0 - 1, 0.5)
+    p = 2 * scipy.special.betainc(ab, ab, 0.5 * (1 - np.abs(r)))
+    p = np.minimum(p, 1)
+    p[n < 3] = np.nan
+    return p
+
+
+def masked_pearsonr(X, Y, chunk_size=CHUNK_SIZE):
+    """
+        Pearson correlation and its p-value between each column of X (n x M) and each
+        column of Y (n x N) over the pairwise complete observations, as M x N matrices.
+
+        Y is processed in chunks of chunk_size columns, so that the memory use does not
+        grow with the number of columns of Y.
+        """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    M, N = X.shape[1], Y.shape[1]
+    corr = np.zeros((M, N))
+    corr_p = np.zeros((M, N))
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        r, n = masked_corr(X, Y[:, start:end])
+        corr[:, start:end] = r
+        corr_p[:, start:end] = pearson_p(r, n)
+    return corr, corr_p
+
+
+def collinear_columns(X, threshold=0.9999, chunk_size=CHUNK_SIZE):
+    """
+        Indices of the columns of X (n x N) to discard because they are almost perfectly
+        correlated (r > threshold) with another column.
+
+        The correlation matrix is computed in blocks of chunk_size x chunk_size columns.
+        The pairs (i, j), i < j, above the threshold are then visited in order and, unless
+        one of the two columns has already been discarded, the column with fewer valid
+        values is discarded (column i if both have the same number of valid values).
+        """
+    X = np.asarray(X, dtype=np.float64)
+    N = X.shape[1]
+    pairs = []
+    for start_i in range(0, N, chunk_size):
+        end_i = min(start_i + chunk_size, N)
+        for start_j in range(start_i, N, chunk_size):
+            end_j = min(start_j + chunk_size, N)
+            r, _ = masked_corr(X[:, start_i:end_i], X[:, start_j:end_j])
+            with np.errstate(invalid='ignore'):
+                i, j = np.nonzero(r > threshold)
+            i, j = i + start_i, j + start_j
+            pairs += [np.stack((i[i < j], j[i < j]), axis=1)]
+    pairs = np.concatenate(pairs, axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    n_valid = np.sum(~np.isnan(X), axis=0)
+    discard = set()
+    for i, j in pairs:
+        if i in discard or j in discard:
+            continue
+        # Keep the column with more valid elements
+        if n_valid[i] > n_valid[j]:
+            discard.add(j)
+        else:
+            discard.add(i)
+    return sorted(discard)
+
+
+def deconfound(Y, conf):
+    """
+        Regress the confounding factors conf (n x K) out of each column of Y (n x N),
+        using the valid values of the column.
+
+        The columns are grouped by their pattern of missing values and the least squares
+        problem is solved once for all the columns of a group. Returns the residuals
+        (n x N, with NaN for the missing values) and the regression coefficients (K x N).
+        """
+    Y = np.asarray(Y, dtype=np.float64)
+    conf = np.asarray(conf, dtype=np.float64)
+    valid = ~np.isnan(Y)
+    residual = np.full(Y.shape, np.nan)
+    beta = np.zeros((conf.shape[1], Y.shape[1]))
+
+    # Group the columns with the same valid rows
+    patterns, group = np.unique(valid.T, axis=0, return_inverse=True)
+    group = group.ravel()
+    for g, rows in enumerate(patterns):
+        cols = np.nonzero(group == g)[0]
+        if not np.any(rows):
+            continue
+        A = conf[rows]
+        B = Y[np.ix_(rows, cols)]
+        # The minimum norm solution, the same as using the pseudo-inverse of A
+        b = np.linalg.lstsq(A, B, rcond=None)[0]
+        beta[:, cols] = b
+        residual[np.ix_(rows, cols)] = B - np.dot(A, b)
+    return residual, beta
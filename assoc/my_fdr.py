@@ -58,3 +58,54 @@ def fdr_threshold(p, q):
     idx = np.nonzero(p2 <= ((I * q) / (n * cVN)))[0]
     pN = p2[np.max(idx)] if len(idx) >= 1 else 0
     return pID, pN
+
+
+def fwer_p_adjust(p, min_p):
+    # Permutation-based FWER correction for multiple testing
+    # p: array of p-values
+    # min_p: minimum p-value over all the tests for each permutation
+    #
+    # The adjusted p-value is the proportion of permutations whose minimum p-value
+    # is smaller than or equal to p, counting the observed data as one permutation.
+    min_p = np.sort(min_p)
+    n_perm = len(min_p)
+    p_adj = (1 + np.searchsorted(min_p, p, side='right')) / float(n_perm + 1)
+    p_adj = np.minimum(p_adj, 1)
+    p_adj[np.isnan(p)] = np.nan
+    return p_adj
+
+
+def fwer_threshold(min_p, alpha):
+    # min_p: minimum p-value over all the tests for each permutation
+    # alpha: family-wise error rate level
+    #
+    # return value
+    # p-value threshold t, for which p < t controls the FWER at level alpha. It is the
+    # k-th smallest minimum p-value of the permutations, k = floor(alpha * n_perm), so
+    # that at most alpha * n_perm of them are smaller than t. The order statistic is
+    # used rather than an interpolated quantile, which can exceed it. It returns 0 if
+    # there are fewer than 1 / alpha permutations.
+    min_p = np.sort(min_p)
+    k = int(np.floor(alpha * len(min_p)))
+    pT = min_p[k - 1] if k >= 1 else 0
+    return pT
+
+
+def permutation_fdr_threshold(p, null_counts, q):
+    # p: vector of observed p-values
+    # null_counts: mean number of null p-values over the permutations smaller than or
+    #              equal to each of the sorted observed p-values (see permutation_test.py)
+    # q: false discovery rate level
+    #
+    # return value
+    # p-value threshold based on the permutation estimate of the FDR, i.e. the number of
+    # null p-values divided by the number of observed p-values below the threshold.
+    # As fdr_threshold(), it returns 0 if no p-value reaches the level.
+    p2 = p[~np.isnan(p)]
+    p2 = np.sort(p2)
+    n_obs = np.searchsorted(p2, p2, side='right')
+    fdr = null_counts / n_obs
+
+    idx = np.nonzero(fdr <= q)[0]
+    pT = p2[np.max(idx)] if len(idx) >= 1 else 0
+    return pT
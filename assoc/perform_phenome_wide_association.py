@@ -18,58 +18,34 @@
 import os
 import numpy as np
 import pandas as pd
-import datetime
-import scipy.stats
 import math
 import re
 import csv
 import statsmodels.api as sm
 from ukbb_cardiac.data.ukb_field_categories import *
-from ukbb_cardiac.assoc.my_fdr import fdr_threshold
+from ukbb_cardiac.assoc.my_fdr import fdr_threshold, fwer_threshold, permutation_fdr_threshold
+from ukbb_cardiac.assoc.permutation_test import permutation_test
+from ukbb_cardiac.assoc.assoc_utils import age_by_date, normalise_columns, rank_normalise_columns, \
+    masked_pearsonr, collinear_columns, deconfound
+from ukbb_cardiac.common.eval_utils import parquet_name, read_table
 import seaborn as sns
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
 
-def normalise(x):
-    return (x - np.mean(x)) / np.std(x)
-
-
-def rank_normalise(x):
-    # Rank-based inverse normal transform
-    # Please refer to the function inormal() in the FSLNets package
-
-    # Get the rank of the values in x
-    ri = np.argsort(np.argsort(x))
-
-    # Correct for the ranks of repeated values
-    # argsort assign different ranks for these values
-    # We fill them with the same value
-    u, inv_idx = np.unique(x, return_inverse=True)
-    sii = np.sort(inv_idx)
-    repeated_idx = np.unique(sii[np.diff(np.append(sii, 1)) == 0])
-    for i in repeated_idx:
-        ri[inv_idx == i] = np.mean(ri[inv_idx == i])
-
-    # Perform inverse normal transform
-    # ri + 1 so that the rank starts from 1, to be consistent with Karla's Matlab code
-    # p squashes the rank into the range of [0, 1]
-    # erfinv can generate a distribution from 2 * p - 1 with 0 mean and 1 standard deviation
-    N = len(x)
-    ri = ri + 1
-    c = 3.0 / 8
-    p = (ri - c) / (N - 2 * c + 1)
-    y = math.sqrt(2) * scipy.special.erfinv(2 * p - 1)
-    return y
-
-
 if __name__ == '__main__':
     # # # # # # # # # # # # # # # # # # # #
     # Step 1: read imaging phenotypes
     # # # # # # # # # # # # # # # # # # # #
     # Cardiac imaging phenotypes
+    # Set idp_columns to a list of column names to read only these phenotypes.
+    idp_columns = None
+    # The Parquet table is read if it has been saved alongside the csv table.
     data_path = '/vol/vipdata/data/biobank/cardiac/Application_18545/clinical'
-    df_idp = pd.read_csv('{0}/clinical_measures_26k_collated_qced.csv'.format(data_path), index_col=0)
+    idp_name = '{0}/clinical_measures_26k_collated_qced.csv'.format(data_path)
+    if os.path.exists(parquet_name(idp_name)):
+        idp_name = parquet_name(idp_name)
+    df_idp = read_table(idp_name, columns=idp_columns)
 
     # # # # # # # # # # # # # # # # # # # #
     # Step 2: read non-imaging phenotypes
@@ -119,13 +95,9 @@ if __name__ == '__main__':
     sex = df['Sex', '31-0.0'].values
     # Age provided by UK Biobank (21003-2.0) seems to be floored, i.e. with half a year error.
     # To get more accurate age values, we calculate age by date.
-    age = np.zeros(len(df))
-    for i in range(len(df)):
-        # Calculate age
-        d1 = datetime.date(df.iloc[i]['Year of birth', '34-0.0'], df.iloc[i]['Month of birth', '52-0.0'], 15)
-        s = df.iloc[i]['Date of attending assessment centre', '53-2.0']
-        d2 = datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
-        age[i] = np.round((d2 - d1).days / 365.25, 1)
+    age = age_by_date(df['Year of birth', '34-0.0'].values,
+                      df['Month of birth', '52-0.0'].values,
+                      df['Date of attending assessment centre', '53-2.0'].values)
     weight = df['Weight', '21002-2.0'].values
     bmi = df['Body mass index (BMI)', '21001-2.0'].values
     height = np.round(np.sqrt(weight / bmi) * 100)
@@ -198,23 +170,11 @@ if __name__ == '__main__':
             bad_vars += [i]
             continue
 
-    for i in range(n_col):
-        for j in range(i + 1, n_col):
-            if i in bad_vars or j in bad_vars:
-                continue
-            # Discard columns with very high correlation
-            val_i = df.iloc[:, i]
-            val_j = df.iloc[:, j]
-            valid_idx = ~np.isnan(val_i) & ~np.isnan(val_j)
-            if np.sum(valid_idx) == 0:
-                continue
-            cc, _ = scipy.stats.pearsonr(val_i[valid_idx], val_j[valid_idx])
-            if cc > 0.9999:
-                # Keep the column with more valid elements
-                if np.sum(~np.isnan(val_i)) > np.sum(~np.isnan(val_j)):
-                    bad_vars += [j]
-                else:
-                    bad_vars += [i]
+    # Discard columns with very high correlation with another column
+    # The correlations between the remaining columns are computed in blocks.
+    candidates = sorted(set(range(n_col)) - set(bad_vars))
+    collinear = collinear_columns(df.iloc[:, candidates].values, threshold=0.9999)
+    bad_vars += [candidates[k] for k in collinear]
 
     # The cleaned data
     bad_vars = np.unique(bad_vars)
@@ -228,38 +188,22 @@ if __name__ == '__main__':
     # Step 4.3: normalise non imaging phenotypes
     df_cont = pd.read_csv('/vol/vipdata/data/biobank/cardiac/Application_18545/clinical/continuous.csv', index_col=0)
 
-    n_col = df.shape[1]
-    for i in range(n_col):
-        val = df.iloc[:, i]
-        valid_idx = ~np.isnan(val)
-        x = val[valid_idx]
-
-        # Field ID
-        field_id = int(df.columns[i][1].split('-')[0])
-        is_continuous = df_cont.loc[field_id]['continuous']
-
-        if is_continuous:
-            # If it is a continuous variable, perform standard normalisation.
-            x = normalise(x)
-        else:
-            # If we are not sure whether it is a continuous or categorical variable, convert it
-            # into a continuous variable using rank-based inverse normal transform.
-            x = rank_normalise(x)
-        df.iloc[:, i][valid_idx] = x
+    # If it is a continuous variable, perform standard normalisation.
+    # If we are not sure whether it is a continuous or categorical variable, convert it
+    # into a continuous variable using rank-based inverse normal transform.
+    field_ids = [int(field_id.split('-')[0]) for _, field_id in df.columns]
+    is_continuous = df_cont.loc[field_ids]['continuous'].values.astype(bool)
+    x = df.values.astype(np.float64)
+    x[:, is_continuous] = normalise_columns(x[:, is_continuous])
+    x[:, ~is_continuous] = rank_normalise_columns(x[:, ~is_continuous])
+    df = pd.DataFrame(x, index=df.index, columns=df.columns)
     df.to_csv('/vol/vipdata/data/biobank/cardiac/Application_18545/clinical/normalised_non_IDPs_26k.csv')
 
     # Step 4.4: de-confound and normalise IDPs
-    n_row = conf.shape[1]
-    n_col = df_idp.shape[1]
-    beta = np.zeros((n_row, n_col))
-    for i in range(n_col):
-        val = df_idp.iloc[:, i]
-        valid_idx = ~np.isnan(val)
-        x = val[valid_idx]
-        beta[:, i] = np.dot(np.linalg.pinv(conf[valid_idx]), x)
-        x = x - np.dot(conf[valid_idx], beta[:, i])
-        x = normalise(x)
-        df_idp.iloc[:, i][valid_idx] = x
+    # The IDPs with the same missing subjects are de-confounded together.
+    x, beta = deconfound(df_idp.values, conf)
+    x = normalise_columns(x)
+    df_idp = pd.DataFrame(x, index=df_idp.index, columns=df_idp.columns)
     df_idp.to_csv('/vol/vipdata/data/biobank/cardiac/Application_18545/clinical/normalised_IDPs_26k.csv')
 
     df_beta = pd.DataFrame(beta,
@@ -270,23 +214,10 @@ if __name__ == '__main__':
     # # # # # # # # # # # # # # # # # # # # #
     # # Step 5: uni-variate correlation studies
     # # # # # # # # # # # # # # # # # # # # #
-    M = df_idp.shape[1]
-    N = df.shape[1]
-    corr = np.zeros((M, N))
-    corr_p = np.zeros((M, N))
-    for i in range(M):
-        for j in range(N):
-            # Remove NaNs
-            x = df_idp.iloc[:, i]
-            y = df.iloc[:, j]
-            valid_idx = ~np.isnan(x) & ~np.isnan(y)
-            x = x[valid_idx]
-            y = y[valid_idx]
-
-            # Pearson correlation
-            cc, p_val = scipy.stats.pearsonr(x, y)
-            corr[i, j] = cc
-            corr_p[i, j] = p_val
+    # The correlations between all the IDPs and the non-imaging phenotypes are
+    # computed over the pairwise complete observations, with the non-imaging
+    # phenotypes processed in chunks of columns.
+    corr, corr_p = masked_pearsonr(df_idp.values, df.values)
 
     # For p-value of 0, assign it with the mininal positive floating value
     # so that we can calculate the logarithm for the Manhattan plot
@@ -323,6 +254,25 @@ if __name__ == '__main__':
     print('Number of phenotypes reaching Bonferroni threshold = {0}'.format(np.sum(np.sum(corr_p < p_bonf, axis=0) > 0)))
     print('Number of phenotypes reaching FDR threshold = {0}'.format(np.sum(np.sum(corr_p < p_fdr, axis=0) > 0)))
 
+    # Permutation-based FWER and FDR thresholds, which account for the correlations
+    # between the phenotypes. Set n_perm to the number of permutations, e.g. 1000, to
+    # run the permutation test, which computes all the correlations for each permutation.
+    # Each of the n_workers processes uses cpu_count / n_workers BLAS threads for the
+    # matrix products, if threadpoolctl is installed.
+    n_perm = 0
+    n_workers = max(1, os.cpu_count() // 4)
+    if n_perm > 0:
+        min_p, null_counts = permutation_test(df_idp.values, df.values, corr_p, n_perm=n_perm,
+                                              seed=0, n_workers=n_workers)
+        p_fwer_perm = fwer_threshold(min_p, 0.05)
+        p_fdr_perm = permutation_fdr_threshold(corr_p.flatten(), null_counts, 0.05)
+        print('p_fwer (permutation) = {0}'.format(p_fwer_perm))
+        print('p_fdr (permutation) = {0}'.format(p_fdr_perm))
+        print('Number of correlations reaching permutation FWER threshold = {0}'.format(np.sum(corr_p < p_fwer_perm)))
+        print('Number of correlations reaching permutation FDR threshold = {0}'.format(np.sum(corr_p <= p_fdr_perm)))
+        print('Number of phenotypes reaching permutation FWER threshold = {0}'.format(
+            np.sum(np.sum(corr_p < p_fwer_perm, axis=0) > 0)))
+
     # # # # # # # # # # # # # # # # # # # #
     # Step 6: Manhattan plot
     # # # # # # # # # # # # # # # # # # # #
@@ -0,0 +1,124 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Permutation tests for the phenome-wide association studies.
+
+    For each permutation, the subjects of the imaging phenotypes are shuffled with respect
+    to the non-imaging phenotypes and all the correlations are computed again. The null
+    distributions keep the correlations between the phenotypes, so the thresholds derived
+    from them in my_fdr.py are less conservative than the Bonferroni correction:
+
+    - the minimum p-value of each permutation gives the null distribution for the
+      family-wise error rate (FWER), see fwer_threshold() and fwer_p_adjust().
+    - the numbers of null p-values below each of the observed p-values give a permutation
+      estimate of the false discovery rate (FDR), see permutation_fdr_threshold().
+    """
+import importlib.util
+import multiprocessing
+import os
+import numpy as np
+from ukbb_cardiac.assoc.assoc_utils import CHUNK_SIZE, masked_pearsonr
+
+# Data shared by the permutations of a worker process
+_shared = {}
+
+
+def limit_blas_threads(n_threads):
+    """
+        Limit the threads of the BLAS library used by numpy in this process, so that the
+        workers do not oversubscribe the cores. Returns False if threadpoolctl is not installed.
+        """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return False
+    # The limits are kept for the lifetime of the process
+    _shared['blas_limits'] = threadpool_limits(limits=n_threads, user_api='blas')
+    return True
+
+
+def _init_worker(X, Y, p_sorted, chunk_size, blas_threads=None):
+    _shared.update(X=X, Y=Y, p_sorted=p_sorted, chunk_size=chunk_size)
+    if blas_threads is not None:
+        limit_blas_threads(blas_threads)
+
+
+def _permute(seed):
+    """
+        Minimum p-value of one permutation and the numbers of its p-values smaller than
+        or equal to each of the sorted observed p-values
+        """
+    X, Y, p_sorted = _shared['X'], _shared['Y'], _shared['p_sorted']
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(X.shape[0])
+    _, p = masked_pearsonr(X[perm], Y, chunk_size=_shared['chunk_size'])
+    p = p[~np.isnan(p)]
+    if len(p) == 0:
+        # No correlation can be computed for this permutation
+        return 1.0, np.zeros(len(p_sorted), dtype=np.int64)
+    counts = np.bincount(np.searchsorted(p_sorted, p, side='left'), minlength=len(p_sorted) + 1)
+    return np.min(p), np.cumsum(counts[:len(p_sorted)])
+
+
+def run_permutations(seeds, init_args, n_workers):
+    """
+        Run the permutations in the order of their seeds, in n_workers processes if
+        n_workers > 1. Each worker then uses cpu_count / n_workers BLAS threads.
+        """
+    if n_workers <= 1:
+        _init_worker(*init_args)
+        for seed in seeds:
+            yield _permute(seed)
+    else:
+        blas_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        if importlib.util.find_spec('threadpoolctl') is None:
+            print('Warning: threadpoolctl is not installed, so the BLAS threads of the {0} workers '
+                  'are not limited and may oversubscribe the cores.'.format(n_workers))
+        with multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                  initargs=tuple(init_args) + (blas_threads,)) as pool:
+            for result in pool.imap(_permute, seeds):
+                yield result
+
+
+def permutation_test(X, Y, corr_p=None, n_perm=1000, seed=0, n_workers=1, chunk_size=CHUNK_SIZE):
+    """
+        Permutation test of the correlations between the columns of X (n x M) and the
+        columns of Y (n x N), with NaN for the missing values. corr_p is the M x N matrix
+        of the observed p-values, which is computed if it is not given.
+
+        The permutations are run by n_workers processes, which share the cores between
+        their BLAS threads. Each permutation has its own random generator derived from
+        seed, so the result does not depend on the number of workers.
+
+        Returns the minimum p-value of each permutation (n_perm) and the mean number of
+        null p-values over the permutations smaller than or equal to each of the sorted
+        observed p-values. A permutation without any valid p-value has a minimum of 1.
+        """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if corr_p is None:
+        _, corr_p = masked_pearsonr(X, Y, chunk_size=chunk_size)
+    p_sorted = np.sort(corr_p[~np.isnan(corr_p)])
+
+    seeds = np.random.SeedSequence(seed).spawn(n_perm)
+    min_p = np.zeros(n_perm)
+    null_counts = np.zeros(len(p_sorted))
+    init_args = (X, Y, p_sorted, chunk_size)
+    for k, (p_min, counts) in enumerate(run_permutations(seeds, init_args, n_workers)):
+        min_p[k] = p_min
+        null_counts += counts
+        if (k + 1) % 100 == 0:
+            print('{0} permutations done.'.format(k + 1))
+    return min_p, null_counts / n_perm
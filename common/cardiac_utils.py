@@ -22,9 +22,13 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from vtk.util import numpy_support
 from scipy import interpolate
+from scipy.spatial import cKDTree
 import skimage
 import skimage.measure
 from ukbb_cardiac.common.image_utils import *
+from ukbb_cardiac.common.nifti_cache import load_nifti, find_image
+from ukbb_cardiac.common.image_geometry import read_geometry
+from ukbb_cardiac.common.motion_utils import create_motion_backend, track_contour_motion, MotionScheduler
 
 
 def approximate_contour(contour, factor=4, smooth=0.05, periodic=False):
@@ -76,7 +80,7 @@ def approximate_contour(contour, factor=4, smooth=0.05, periodic=False):
 
 def sa_pass_quality_control(seg_sa_name):
     """ Quality control for short-axis image segmentation """
-    nim = nib.load(seg_sa_name)
+    nim = load_nifti(seg_sa_name)
     seg_sa = nim.get_data()
     X, Y, Z = seg_sa.shape[:3]
 
@@ -138,7 +142,7 @@ def sa_pass_quality_control(seg_sa_name):
 
 def la_pass_quality_control(seg_la_name):
     """ Quality control for long-axis image segmentation """
-    nim = nib.load(seg_la_name)
+    nim = load_nifti(seg_la_name)
     seg = nim.get_data()
     X, Y, Z = seg.shape[:3]
     seg_z = seg[:, :, 0]
@@ -355,10 +359,89 @@ def determine_aha_segment_id(point, lv_centre, aha_axis, part):
     return seg_id
 
 
-def evaluate_wall_thickness(seg_name, output_name_stem, part=None):
-    """ Evaluate myocardial wall thickness. """
+def determine_aha_segment_ids(points, lv_centre, aha_axis, part):
+    """ Determine the AHA segment IDs for an array of points (N x 3) in one go.
+        This is the vectorised version of determine_aha_segment_id.
+        """
+    d = points - lv_centre
+    x = np.dot(d, aha_axis['inf_to_ant'])
+    y = np.dot(d, aha_axis['lv_to_sep'])
+    deg = np.degrees(np.arctan2(y, x))
+
+    # Each of the basal and mid-cavity parts is divided into six 60-degree sectors
+    # starting from -30 degree, and the apical part into four 90-degree sectors
+    # starting from -45 degree.
+    if part == 'basal':
+        seg_id = 1 + np.mod(np.floor((deg + 30) / 60.0), 6)
+    elif part == 'mid':
+        seg_id = 7 + np.mod(np.floor((deg + 30) / 60.0), 6)
+    elif part == 'apical':
+        seg_id = 13 + np.mod(np.floor((deg + 45) / 90.0), 4)
+    elif part == 'apex':
+        seg_id = np.full(len(points), 17)
+    else:
+        print('Error: unknown part {0}!'.format(part))
+        exit(0)
+    return seg_id.astype(np.int32)
+
+
+def contours_to_polydata(points, contour_sizes):
+    """ Construct a polydata of closed contours.
+
+        points: the contour points (N x 3), contour by contour
+        contour_sizes: the number of points of each contour
+        """
+    # Each point is connected to the next point on the same contour
+    # and the last point is connected to the first one.
+    ids = np.arange(len(points))
+    next_ids = ids + 1
+    start = 0
+    for n in contour_sizes:
+        next_ids[start + n - 1] = start
+        start += n
+    cells = np.stack((np.full(len(points), 2), ids, next_ids), axis=1).ravel()
+
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points, dtype=np.float32), deep=True))
+    lines = vtk.vtkCellArray()
+    lines.SetCells(len(points), numpy_support.numpy_to_vtkIdTypeArray(cells.astype(np.int64), deep=True))
+
+    poly = vtk.vtkPolyData()
+    poly.SetPoints(vtk_points)
+    poly.SetLines(lines)
+    return poly
+
+
+def add_point_array(poly, name, values, array_type=vtk.VTK_DOUBLE):
+    """ Add a numpy array as a named point data array of the polydata """
+    array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=True, array_type=array_type)
+    array.SetName(name)
+    poly.GetPointData().AddArray(array)
+
+
+def contour_to_world(contour, z, affine):
+    """ Transform a 2D contour (N x 2) from cv2 on slice z to world coordinates (N x 3).
+        Note: cv2 considers an input image as a Y x X array, which is different
+        from nibabel which assumes a X x Y array.
+        """
+    N = contour.shape[0]
+    voxels = np.stack((contour[:, 1], contour[:, 0], np.full(N, z), np.ones(N)), axis=0)
+    return np.dot(affine, voxels)[:3].T
+
+
+def evaluate_wall_thickness(seg_name, output_name_stem, part=None, save_vtk=True, save_epi_contour=False):
+    """ Evaluate myocardial wall thickness.
+
+        The thickness at each endocardial point is the distance to the closest
+        epicardial point. The thickness per AHA segment is saved to
+        <output_name_stem>.csv and <output_name_stem>_max.csv. If save_vtk is True,
+        the endocardial contours with the thickness and the AHA segment ID are
+        saved to <output_name_stem>.vtk. If save_epi_contour is True, the epicardial
+        contours are also saved to <output_name_stem>_epi.vtk for debug and
+        demonstration purposes.
+        """
     # Read the segmentation image
-    nim = nib.load(seg_name)
+    nim = load_nifti(seg_name)
     Z = nim.header['dim'][3]
     affine = nim.affine
     seg = nim.get_data()
@@ -376,23 +459,12 @@ def evaluate_wall_thickness(seg_name, output_name_stem, part=None):
     else:
         part_z = {z: part for z in range(Z)}
 
-    # Construct the points set to represent the endocardial contours
-    endo_points = vtk.vtkPoints()
-    thickness = vtk.vtkDoubleArray()
-    thickness.SetName('Thickness')
-    points_aha = vtk.vtkIntArray()
-    points_aha.SetName('Segment ID')
-    point_id = 0
-    lines = vtk.vtkCellArray()
-
-    # Save epicardial contour for debug and demonstration purposes
-    save_epi_contour = False
-    if save_epi_contour:
-        epi_points = vtk.vtkPoints()
-        points_epi_aha = vtk.vtkIntArray()
-        points_epi_aha.SetName('Segment ID')
-        point_epi_id = 0
-        lines_epi = vtk.vtkCellArray()
+    # The endocardial points, their thickness and AHA segment IDs for each slice
+    endo_points = []
+    thickness = []
+    points_aha = []
+    epi_points = []
+    points_epi_aha = []
 
     # For each slice
     for z in range(Z):
@@ -416,8 +488,6 @@ def evaluate_wall_thickness(seg_name, output_name_stem, part=None):
         lv_centre = np.dot(affine, np.array([cx, cy, z, 1]))[:3]
 
         # Extract endocardial contour
-        # Note: cv2 considers an input image as a Y x X array, which is different
-        # from nibabel which assumes a X x Y array.
         contours, _ = cv2.findContours(cv2.inRange(endo, 1, 1), cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
         endo_contour = contours[0][:, 0, :]
 
@@ -429,95 +499,39 @@ def evaluate_wall_thickness(seg_name, output_name_stem, part=None):
         endo_contour = approximate_contour(endo_contour, periodic=True)
         epi_contour = approximate_contour(epi_contour, periodic=True)
 
-        # A polydata representation of the epicardial contour
-        epi_points_z = vtk.vtkPoints()
-        for y, x in epi_contour:
-            p = np.dot(affine, np.array([x, y, z, 1]))[:3]
-            epi_points_z.InsertNextPoint(p)
-        epi_poly_z = vtk.vtkPolyData()
-        epi_poly_z.SetPoints(epi_points_z)
-
-        # Point locator for the epicardial contour
-        locator = vtk.vtkPointLocator()
-        locator.SetDataSet(epi_poly_z)
-        locator.BuildLocator()
-
-        # For each point on endocardium, find the closest point on epicardium
-        N = endo_contour.shape[0]
-        for i in range(N):
-            y, x = endo_contour[i]
+        # The world coordinates of the contour points
+        p = contour_to_world(endo_contour, z, affine)
+        q = contour_to_world(epi_contour, z, affine)
 
-            # The world coordinate of this point
-            p = np.dot(affine, np.array([x, y, z, 1]))[:3]
-            endo_points.InsertNextPoint(p)
+        # For each point on endocardium, the distance to the closest point on epicardium
+        dist_pq, _ = cKDTree(q).query(p)
 
-            # The closest epicardial point
-            q = np.array(epi_points_z.GetPoint(locator.FindClosestPoint(p)))
-
-            # The distance from endo to epi
-            dist_pq = np.linalg.norm(q - p)
-
-            # Add the point data
-            thickness.InsertNextTuple1(dist_pq)
-            seg_id = determine_aha_segment_id(p, lv_centre, aha_axis, part_z[z])
-            points_aha.InsertNextTuple1(seg_id)
-
-            # Record the first point of the current contour
-            if i == 0:
-                contour_start_id = point_id
-
-            # Add the line
-            if i == (N - 1):
-                lines.InsertNextCell(2, [point_id, contour_start_id])
-            else:
-                lines.InsertNextCell(2, [point_id, point_id + 1])
-
-            # Increment the point index
-            point_id += 1
+        endo_points += [p]
+        thickness += [dist_pq]
+        points_aha += [determine_aha_segment_ids(p, lv_centre, aha_axis, part_z[z])]
 
         if save_epi_contour:
-            # For each point on epicardium
-            N = epi_contour.shape[0]
-            for i in range(N):
-                y, x = epi_contour[i]
-
-                # The world coordinate of this point
-                p = np.dot(affine, np.array([x, y, z, 1]))[:3]
-                epi_points.InsertNextPoint(p)
-                seg_id = determine_aha_segment_id(p, lv_centre, aha_axis, part_z[z])
-                points_epi_aha.InsertNextTuple1(seg_id)
-
-                # Record the first point of the current contour
-                if i == 0:
-                    contour_start_id = point_epi_id
-
-                # Add the line
-                if i == (N - 1):
-                    lines_epi.InsertNextCell(2, [point_epi_id, contour_start_id])
-                else:
-                    lines_epi.InsertNextCell(2, [point_epi_id, point_epi_id + 1])
-
-                # Increment the point index
-                point_epi_id += 1
+            epi_points += [q]
+            points_epi_aha += [determine_aha_segment_ids(q, lv_centre, aha_axis, part_z[z])]
+
+    np_thickness = np.concatenate(thickness)
+    np_points_aha = np.concatenate(points_aha)
 
     # Save to a vtk file
-    endo_poly = vtk.vtkPolyData()
-    endo_poly.SetPoints(endo_points)
-    endo_poly.GetPointData().AddArray(thickness)
-    endo_poly.GetPointData().AddArray(points_aha)
-    endo_poly.SetLines(lines)
+    if save_vtk:
+        endo_poly = contours_to_polydata(np.concatenate(endo_points), [len(x) for x in endo_points])
+        add_point_array(endo_poly, 'Thickness', np_thickness, vtk.VTK_DOUBLE)
+        add_point_array(endo_poly, 'Segment ID', np_points_aha, vtk.VTK_INT)
 
-    writer = vtk.vtkPolyDataWriter()
-    output_name = '{0}.vtk'.format(output_name_stem)
-    writer.SetFileName(output_name)
-    writer.SetInputData(endo_poly)
-    writer.Write()
+        writer = vtk.vtkPolyDataWriter()
+        output_name = '{0}.vtk'.format(output_name_stem)
+        writer.SetFileName(output_name)
+        writer.SetInputData(endo_poly)
+        writer.Write()
 
     if save_epi_contour:
-        epi_poly = vtk.vtkPolyData()
-        epi_poly.SetPoints(epi_points)
-        epi_poly.GetPointData().AddArray(points_epi_aha)
-        epi_poly.SetLines(lines_epi)
+        epi_poly = contours_to_polydata(np.concatenate(epi_points), [len(x) for x in epi_points])
+        add_point_array(epi_poly, 'Segment ID', np.concatenate(points_epi_aha), vtk.VTK_INT)
 
         writer = vtk.vtkPolyDataWriter()
         output_name = '{0}_epi.vtk'.format(output_name_stem)
@@ -526,14 +540,14 @@ def evaluate_wall_thickness(seg_name, output_name_stem, part=None):
         writer.Write()
 
     # Evaluate the wall thickness per AHA segment and save to a csv file
+    np_thickness = np_thickness.astype(np.float32)
     table_thickness = np.zeros(17)
-    table_thickness_max = np.zeros(17)
-    np_thickness = numpy_support.vtk_to_numpy(thickness).astype(np.float32)
-    np_points_aha = numpy_support.vtk_to_numpy(points_aha).astype(np.int8)
-
-    for i in range(16):
-        table_thickness[i] = np.mean(np_thickness[np_points_aha == (i + 1)])
-        table_thickness_max[i] = np.max(np_thickness[np_points_aha == (i + 1)])
+    table_thickness_max = np.full(17, np.nan)
+    count = np.bincount(np_points_aha - 1, minlength=16)[:16]
+    total = np.bincount(np_points_aha - 1, weights=np_thickness, minlength=16)[:16]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table_thickness[:16] = total / count
+    np.fmax.at(table_thickness_max, np_points_aha - 1, np_thickness)
     table_thickness[-1] = np.mean(np_thickness)
     table_thickness_max[-1] = np.max(np_thickness)
 
@@ -554,7 +568,7 @@ def extract_myocardial_contour(seg_name, contour_name_stem, part=None, three_sli
         If part is given, this function will use the given part for the image slice.
         """
     # Read the segmentation image
-    nim = nib.load(seg_name)
+    nim = load_nifti(seg_name)
     X, Y, Z = nim.header['dim'][1:4]
     affine = nim.affine
     seg = nim.get_data()
@@ -744,90 +758,124 @@ def extract_myocardial_contour(seg_name, contour_name_stem, part=None, three_sli
         poly.GetCellData().AddArray(lines_aha)
         poly.GetCellData().AddArray(lines_dir)
 
-        writer = vtk.vtkPolyDataWriter()
         contour_name = '{0}{1:02d}.vtk'.format(contour_name_stem, z)
-        writer.SetFileName(contour_name)
-        writer.SetInputData(poly)
-        writer.Write()
-        os.system('sed -i "1s/4.1/4.0/" {0}'.format(contour_name))
+        write_polydata(poly, contour_name)
 
 
-def evaluate_strain_by_length(contour_name_stem, T, dt, output_name_stem):
-    """ Calculate the strain based on the line length """
-    # Read the polydata at the first time frame (ED frame)
-    fr = 0
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName('{0}{1:02d}.vtk'.format(contour_name_stem, fr))
-    reader.Update()
-    poly = reader.GetOutput()
-    points = poly.GetPoints()
+def write_polydata(poly, filename):
+    """ Save a polydata to a legacy vtk file.
+        Change vtk file version to 4.0 to avoid the warning by MIRTK, which is
+        developed using VTK 6.3, which does not know file version 4.1.
+        """
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetInputData(poly)
+    writer.WriteToOutputStringOn()
+    writer.Write()
+    header, body = writer.GetOutputStdString().split('\n', 1)
+    with open(filename, 'w') as f:
+        f.write(header.replace('4.1', '4.0', 1) + '\n' + body)
 
-    # Calculate the length of each line
-    lines = poly.GetLines()
-    lines_aha = poly.GetCellData().GetArray('Segment ID')
-    lines_dir = poly.GetCellData().GetArray('Direction ID')
-    n_lines = lines.GetNumberOfCells()
-    length_ED = np.zeros(n_lines)
-    seg_id = np.zeros(n_lines)
-    dir_id = np.zeros(n_lines)
-
-    lines.InitTraversal()
-    for i in range(n_lines):
-        ids = vtk.vtkIdList()
-        lines.GetNextCell(ids)
-        p1 = np.array(points.GetPoint(ids.GetId(0)))
-        p2 = np.array(points.GetPoint(ids.GetId(1)))
-        d = np.linalg.norm(p1 - p2)
-        seg_id[i] = lines_aha.GetValue(i)
-        dir_id[i] = lines_dir.GetValue(i)
-        length_ED[i] = d
-
-    # For each time frame, calculate the strain, i.e. change of length
-    table_strain = {}
-    table_strain['radial'] = np.zeros((17, T))
-    table_strain['circum'] = np.zeros((17, T))
 
-    for fr in range(0, T):
-        # Read the polydata
+def read_contour_sequence(contour_name_stem, T):
+    """ Read the contours of all the time frames, <contour_name_stem><fr>.vtk.
+        Return the polydata and the point coordinates (T x N x 3) of the time frames.
+        """
+    polys = []
+    for fr in range(T):
         reader = vtk.vtkPolyDataReader()
-        filename = '{0}{1:02d}.vtk'.format(contour_name_stem, fr)
-        reader.SetFileName(filename)
+        reader.SetFileName('{0}{1:02d}.vtk'.format(contour_name_stem, fr))
         reader.Update()
-        poly = reader.GetOutput()
-        points = poly.GetPoints()
-
-        # Calculate the strain for each line
-        lines = poly.GetLines()
-        n_lines = lines.GetNumberOfCells()
-        strain = np.zeros(n_lines)
-        vtk_strain = vtk.vtkFloatArray()
+        polys += [reader.GetOutput()]
+    points = np.stack([numpy_support.vtk_to_numpy(poly.GetPoints().GetData()) for poly in polys], axis=0)
+    return polys, points.astype(np.float64)
+
+
+def polydata_line_ids(poly):
+    """ Return the point IDs of the two end points of each line (n_lines x 2) """
+    lines = poly.GetLines()
+    if hasattr(lines, 'GetOffsetsArray'):
+        offsets = numpy_support.vtk_to_numpy(lines.GetOffsetsArray())[:-1]
+        conn = numpy_support.vtk_to_numpy(lines.GetConnectivityArray())
+        return np.stack((conn[offsets], conn[offsets + 1]), axis=1)
+
+    # Legacy cell array layout: [n, id_0, ..., id_n-1, n, ...]
+    cells = numpy_support.vtk_to_numpy(lines.GetData())
+    offsets = []
+    i = 0
+    while i < len(cells):
+        offsets += [i + 1]
+        i += cells[i] + 1
+    offsets = np.array(offsets, dtype=np.int64)
+    return np.stack((cells[offsets], cells[offsets + 1]), axis=1)
+
+
+def strain_by_length(points, line_ids):
+    """ Calculate the strain (unit: %) of each line for each time frame,
+        i.e. the change of line length relative to the first time frame.
+
+        points: the point coordinates of the time frames (T x N x 3)
+        line_ids: the point IDs of the end points of each line (n_lines x 2)
+        return the strain (T x n_lines)
+        """
+    length = np.linalg.norm(points[:, line_ids[:, 0]] - points[:, line_ids[:, 1]], axis=-1)
+    return (length - length[0]) / length[0] * 100
+
+
+def segment_mean(values, seg_id, n_segments):
+    """ Calculate the mean value of each segment (1 to n_segments) for each time frame.
+
+        values: the values of the lines or points for each time frame (T x N)
+        seg_id: the segment ID of the lines or points (N)
+        return the segmental means (n_segments x T), NaN if a segment is empty
+        """
+    T = values.shape[0]
+    mask = (seg_id >= 1) & (seg_id <= n_segments)
+    values = values[:, mask]
+    index = (np.arange(T)[:, np.newaxis] * n_segments + seg_id[mask] - 1).ravel()
+    total = np.bincount(index, weights=values.ravel(), minlength=T * n_segments)
+    count = np.bincount(index, minlength=T * n_segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return mean.reshape((T, n_segments)).T
+
+
+def save_contour_strain(polys, strain, contour_name_stem):
+    """ Add the strain of each line to the contours and save them """
+    for fr, poly in enumerate(polys):
+        vtk_strain = numpy_support.numpy_to_vtk(np.ascontiguousarray(strain[fr], dtype=np.float32), deep=True)
         vtk_strain.SetName('Strain')
-        lines.InitTraversal()
-        for i in range(n_lines):
-            ids = vtk.vtkIdList()
-            lines.GetNextCell(ids)
-            p1 = np.array(points.GetPoint(ids.GetId(0)))
-            p2 = np.array(points.GetPoint(ids.GetId(1)))
-            d = np.linalg.norm(p1 - p2)
-
-            # Strain of this line (unit: %)
-            strain[i] = (d - length_ED[i]) / length_ED[i] * 100
-            vtk_strain.InsertNextTuple1(strain[i])
-
-        # Save the strain array to the vtk file
         poly.GetCellData().AddArray(vtk_strain)
-        writer = vtk.vtkPolyDataWriter()
-        writer.SetInputData(poly)
-        writer.SetFileName(filename)
-        writer.Write()
-        os.system('sed -i "1s/4.1/4.0/" {0}'.format(filename))
+        write_polydata(poly, '{0}{1:02d}.vtk'.format(contour_name_stem, fr))
+
 
-        # Calculate the segmental and global strains
-        for i in range(0, 16):
-            table_strain['radial'][i, fr] = np.mean(strain[(seg_id == (i + 1)) & (dir_id == 1)])
-            table_strain['circum'][i, fr] = np.mean(strain[(seg_id == (i + 1)) & (dir_id == 2)])
-        table_strain['radial'][-1, fr] = np.mean(strain[dir_id == 1])
-        table_strain['circum'][-1, fr] = np.mean(strain[dir_id == 2])
+def evaluate_strain_by_length(contour_name_stem, T, dt, output_name_stem, save_vtk=False):
+    """ Calculate the strain based on the line length.
+
+        If save_vtk is True, the strain of each line is added to the contour
+        file of each time frame.
+        """
+    # Read the polydata of all the time frames and the lines at the first
+    # time frame (ED frame), which are the same for all the time frames
+    polys, points = read_contour_sequence(contour_name_stem, T)
+    line_ids = polydata_line_ids(polys[0])
+    seg_id = numpy_support.vtk_to_numpy(polys[0].GetCellData().GetArray('Segment ID'))
+    dir_id = numpy_support.vtk_to_numpy(polys[0].GetCellData().GetArray('Direction ID'))
+
+    # Calculate the strain of each line for each time frame (T x n_lines)
+    strain = strain_by_length(points, line_ids)
+
+    # Save the strain array to the vtk files
+    if save_vtk:
+        save_contour_strain(polys, strain, contour_name_stem)
+
+    # Calculate the segmental and global strains
+    table_strain = {}
+    table_strain['radial'] = np.zeros((17, T))
+    table_strain['circum'] = np.zeros((17, T))
+    table_strain['radial'][:16] = segment_mean(strain[:, dir_id == 1], seg_id[dir_id == 1], 16)
+    table_strain['circum'][:16] = segment_mean(strain[:, dir_id == 2], seg_id[dir_id == 2], 16)
+    table_strain['radial'][-1] = np.mean(strain[:, dir_id == 1], axis=1)
+    table_strain['circum'][-1] = np.mean(strain[:, dir_id == 2], axis=1)
 
     for c in ['radial', 'circum']:
         # Save into csv files
@@ -837,23 +885,35 @@ def evaluate_strain_by_length(contour_name_stem, T, dt, output_name_stem):
         df.to_csv('{0}_{1}.csv'.format(output_name_stem, c))
 
 
-def cine_2d_sa_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_name_stem):
-    """ Perform motion tracking and strain analysis for cine MR images. """
+def cine_2d_sa_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_name_stem, motion_backend='mirtk',
+                                          n_workers=0):
+    """ Perform motion tracking and strain analysis for cine MR images.
+
+        motion_backend: 'mirtk' for the MIRTK command line tools or 'sitk' for the
+                        in-process SimpleITK registration, see motion_utils.py.
+        n_workers: number of registrations of all the slices and time frames which
+                   run concurrently. By default, they run one after another.
+        """
+    backend = create_motion_backend(motion_backend, '{0}/ffd_cine_2d_motion.cfg'.format(par_dir), output_dir)
+
+    # The segmentations may be saved as .nii.gz or .nii
+    seg_sa_ED_name = find_image('{0}/seg_sa_ED.nii.gz'.format(data_dir))
+    seg_sa_name = find_image('{0}/seg_sa.nii.gz'.format(data_dir))
+
     # Crop the image to save computation for image registration
     # Focus on the left ventricle so that motion tracking is less affected by
     # the movement of RV and LV outflow tract
-    padding('{0}/seg_sa_ED.nii.gz'.format(data_dir),
-            '{0}/seg_sa_ED.nii.gz'.format(data_dir),
+    padding(seg_sa_ED_name, seg_sa_ED_name,
             '{0}/seg_sa_lv_ED.nii.gz'.format(output_dir), 3, 0)
     auto_crop_image('{0}/seg_sa_lv_ED.nii.gz'.format(output_dir),
                     '{0}/seg_sa_lv_crop_ED.nii.gz'.format(output_dir), 20)
-    os.system('mirtk transform-image {0}/sa.nii.gz {1}/sa_crop.nii.gz '
-              '-target {1}/seg_sa_lv_crop_ED.nii.gz'.format(data_dir, output_dir))
-    os.system('mirtk transform-image {0}/seg_sa.nii.gz {1}/seg_sa_crop.nii.gz '
-              '-target {1}/seg_sa_lv_crop_ED.nii.gz'.format(data_dir, output_dir))
+    backend.resample('{0}/sa.nii.gz'.format(data_dir), '{0}/sa_crop.nii.gz'.format(output_dir),
+                     '{0}/seg_sa_lv_crop_ED.nii.gz'.format(output_dir))
+    backend.resample(seg_sa_name, '{0}/seg_sa_crop.nii.gz'.format(output_dir),
+                     '{0}/seg_sa_lv_crop_ED.nii.gz'.format(output_dir))
 
     # Extract the myocardial contours for three slices, respectively basal, mid-cavity and apical
-    extract_myocardial_contour('{0}/seg_sa_ED.nii.gz'.format(data_dir),
+    extract_myocardial_contour(seg_sa_ED_name,
                                '{0}/myo_contour_ED_z'.format(output_dir),
                                three_slices=True)
 
@@ -865,82 +925,38 @@ def cine_2d_sa_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_
     label = {'BG': 0, 'LV': 1, 'Myo': 2, 'RV': 3}
 
     # Inter-frame motion estimation
-    nim = nib.load('{0}/sa_crop.nii.gz'.format(output_dir))
-    Z = nim.header['dim'][3]
-    T = nim.header['dim'][4]
-    dt = nim.header['pixdim'][4]
-    dice_lv_myo = []
-    for z in range(Z):
-        if not os.path.exists('{0}/myo_contour_ED_z{1:02d}.vtk'.format(output_dir, z)):
-            continue
-
+    geometry = read_geometry('{0}/sa_crop.nii.gz'.format(output_dir))
+    Z = geometry.dim[3]
+    T = geometry.dim[4]
+    dt = geometry.dt
+    slices = [z for z in range(Z) if os.path.exists('{0}/myo_contour_ED_z{1:02d}.vtk'.format(output_dir, z))]
+
+    # The slices are tracked independently, so the registrations of all the slices
+    # are scheduled together on the worker pool
+    scheduler = MotionScheduler(n_workers)
+    outputs = []
+    for z in slices:
         # Split the cine sequence for this slice
         split_sequence('{0}/sa_crop_z{1:02d}.nii.gz'.format(output_dir, z),
                        '{0}/sa_crop_z{1:02d}_fr'.format(output_dir, z))
 
-        # Forward image registration
-        for fr in range(1, T):
-            target_fr = fr - 1
-            source_fr = fr
-            target = '{0}/sa_crop_z{1:02d}_fr{2:02d}.nii.gz'.format(output_dir, z, target_fr)
-            source = '{0}/sa_crop_z{1:02d}_fr{2:02d}.nii.gz'.format(output_dir, z, source_fr)
-            par = '{0}/ffd_cine_2d_motion.cfg'.format(par_dir)
-            dof = '{0}/ffd_z{1:02d}_pair_{2:02d}_to_{3:02d}.dof.gz'.format(output_dir, z, target_fr, source_fr)
-            os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(target, source, par, dof))
-
-        # Compose forward inter-frame transformation fields
-        os.system('cp {0}/ffd_z{1:02d}_pair_00_to_01.dof.gz '
-                  '{0}/ffd_z{1:02d}_forward_00_to_01.dof.gz'.format(output_dir, z))
-        for fr in range(2, T):
-            dofs = ''
-            for k in range(1, fr + 1):
-                dof = '{0}/ffd_z{1:02d}_pair_{2:02d}_to_{3:02d}.dof.gz'.format(output_dir, z, k - 1, k)
-                dofs += dof + ' '
-            dof_out = '{0}/ffd_z{1:02d}_forward_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr)
-            os.system('mirtk compose-dofs {0} {1} -approximate'.format(dofs, dof_out))
-
-        # Backward image registration
-        for fr in range(T - 1, 0, -1):
-            target_fr = (fr + 1) % T
-            source_fr = fr
-            target = '{0}/sa_crop_z{1:02d}_fr{2:02d}.nii.gz'.format(output_dir, z, target_fr)
-            source = '{0}/sa_crop_z{1:02d}_fr{2:02d}.nii.gz'.format(output_dir, z, source_fr)
-            par = '{0}/ffd_cine_2d_motion.cfg'.format(par_dir)
-            dof = '{0}/ffd_z{1:02d}_pair_{2:02d}_to_{3:02d}.dof.gz'.format(output_dir, z, target_fr, source_fr)
-            os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(target, source, par, dof))
-
-        # Compose backward inter-frame transformation fields
-        os.system('cp {0}/ffd_z{1:02d}_pair_00_to_{2:02d}.dof.gz '
-                  '{0}/ffd_z{1:02d}_backward_00_to_{2:02d}.dof.gz'.format(output_dir, z, T - 1))
-        for fr in range(T - 2, 0, -1):
-            dofs = ''
-            for k in range(T - 1, fr - 1, -1):
-                dof = '{0}/ffd_z{1:02d}_pair_{2:02d}_to_{3:02d}.dof.gz'.format(output_dir, z,
-                                                                               (k + 1) % T, k)
-                dofs += dof + ' '
-            dof_out = '{0}/ffd_z{1:02d}_backward_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr)
-            os.system('mirtk compose-dofs {0} {1} -approximate'.format(dofs, dof_out))
-
-        # Average the forward and backward transformations
-        os.system('mirtk init-dof {0}/ffd_z{1:02d}_forward_00_to_00.dof.gz'.format(output_dir, z))
-        os.system('mirtk init-dof {0}/ffd_z{1:02d}_backward_00_to_00.dof.gz'.format(output_dir, z))
-        os.system('mirtk init-dof {0}/ffd_z{1:02d}_00_to_00.dof.gz'.format(output_dir, z))
-        for fr in range(1, T):
-            dof_forward = '{0}/ffd_z{1:02d}_forward_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr)
-            weight_forward = float(T - fr) / T
-            dof_backward = '{0}/ffd_z{1:02d}_backward_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr)
-            weight_backward = float(fr) / T
-            dof_combine = '{0}/ffd_z{1:02d}_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr)
-            os.system('average_3d_ffd 2 {0} {1} {2} {3} {4}'.format(dof_forward, weight_forward,
-                                                                    dof_backward, weight_backward,
-                                                                    dof_combine))
-
-        # Transform the contours
-        for fr in range(0, T):
-            os.system('mirtk transform-points {0}/myo_contour_ED_z{1:02d}.vtk '
-                      '{0}/myo_contour_z{1:02d}_fr{2:02d}.vtk '
-                      '-dofin {0}/ffd_z{1:02d}_00_to_{2:02d}.dof.gz'.format(output_dir, z, fr))
+        # Track the myocardial contour through the cine sequence
+        image_names = ['{0}/sa_crop_z{1:02d}_fr{2:02d}.nii.gz'.format(output_dir, z, fr) for fr in range(T)]
+        output_names = ['{0}/myo_contour_z{1:02d}_fr{2:02d}.vtk'.format(output_dir, z, fr) for fr in range(T)]
+        outputs += track_contour_motion(backend,
+                                        image_names,
+                                        '{0}/myo_contour_ED_z{1:02d}.vtk'.format(output_dir, z),
+                                        output_names,
+                                        'ffd_z{0:02d}'.format(z),
+                                        scheduler)
+
+    # Wait for the tracked contours
+    for output in outputs:
+        output.result()
+    scheduler.shutdown()
 
+    dice_lv_myo = []
+    for z in slices:
         # Transform the segmentation and evaluate the Dice metric
         eval_dice = False
         if eval_dice:
@@ -1312,89 +1328,34 @@ def extract_la_myocardial_contour(seg_la_name, seg_sa_name, contour_name):
     poly.GetCellData().AddArray(lines_aha)
     poly.GetCellData().AddArray(lines_dir)
 
-    writer = vtk.vtkPolyDataWriter()
-    writer.SetFileName(contour_name)
-    writer.SetInputData(poly)
-    writer.Write()
+    write_polydata(poly, contour_name)
 
-    # Change vtk file version to 4.0 to avoid the warning by MIRTK, which is
-    # developed using VTK 6.3, which does not know file version 4.1.
-    os.system('sed -i "1s/4.1/4.0/" {0}'.format(contour_name))
 
+def evaluate_la_strain_by_length(contour_name_stem, T, dt, output_name_stem, save_vtk=False):
+    """ Calculate the strain based on the line length.
 
-def evaluate_la_strain_by_length(contour_name_stem, T, dt, output_name_stem):
-    """ Calculate the strain based on the line length """
-    # Read the polydata at the first time frame (ED frame)
-    fr = 0
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName('{0}{1:02d}.vtk'.format(contour_name_stem, fr))
-    reader.Update()
-    poly = reader.GetOutput()
-    points = poly.GetPoints()
+        If save_vtk is True, the strain of each line is added to the contour
+        file of each time frame.
+        """
+    # Read the polydata of all the time frames and the lines at the first
+    # time frame (ED frame), which are the same for all the time frames
+    polys, points = read_contour_sequence(contour_name_stem, T)
+    line_ids = polydata_line_ids(polys[0])
+    seg_id = numpy_support.vtk_to_numpy(polys[0].GetCellData().GetArray('Segment ID'))
+    dir_id = numpy_support.vtk_to_numpy(polys[0].GetCellData().GetArray('Direction ID'))
 
-    # Calculate the length of each line
-    lines = poly.GetLines()
-    lines_aha = poly.GetCellData().GetArray('Segment ID')
-    lines_dir = poly.GetCellData().GetArray('Direction ID')
-    n_lines = lines.GetNumberOfCells()
-    length_ED = np.zeros(n_lines)
-    seg_id = np.zeros(n_lines)
-    dir_id = np.zeros(n_lines)
-
-    lines.InitTraversal()
-    for i in range(n_lines):
-        ids = vtk.vtkIdList()
-        lines.GetNextCell(ids)
-        p1 = np.array(points.GetPoint(ids.GetId(0)))
-        p2 = np.array(points.GetPoint(ids.GetId(1)))
-        d = np.linalg.norm(p1 - p2)
-        seg_id[i] = lines_aha.GetValue(i)
-        dir_id[i] = lines_dir.GetValue(i)
-        length_ED[i] = d
-
-    # For each time frame, calculate the strain, i.e. change of length
-    table_strain = {}
-    table_strain['longit'] = np.zeros((7, T))
+    # Calculate the strain of each line for each time frame (T x n_lines)
+    strain = strain_by_length(points, line_ids)
 
-    for fr in range(0, T):
-        # Read the polydata
-        reader = vtk.vtkPolyDataReader()
-        filename = '{0}{1:02d}.vtk'.format(contour_name_stem, fr)
-        reader.SetFileName(filename)
-        reader.Update()
-        poly = reader.GetOutput()
-        points = poly.GetPoints()
-
-        # Calculate the strain for each line
-        lines = poly.GetLines()
-        n_lines = lines.GetNumberOfCells()
-        strain = np.zeros(n_lines)
-        vtk_strain = vtk.vtkFloatArray()
-        vtk_strain.SetName('Strain')
-        lines.InitTraversal()
-        for i in range(n_lines):
-            ids = vtk.vtkIdList()
-            lines.GetNextCell(ids)
-            p1 = np.array(points.GetPoint(ids.GetId(0)))
-            p2 = np.array(points.GetPoint(ids.GetId(1)))
-            d = np.linalg.norm(p1 - p2)
-
-            # Strain of this line (unit: %)
-            strain[i] = (d - length_ED[i]) / length_ED[i] * 100
-            vtk_strain.InsertNextTuple1(strain[i])
-
-        # Save the strain array to the vtk file
-        poly.GetCellData().AddArray(vtk_strain)
-        writer = vtk.vtkPolyDataWriter()
-        writer.SetInputData(poly)
-        writer.SetFileName(filename)
-        writer.Write()
-        os.system('sed -i "1s/4.1/4.0/" {0}'.format(filename))
+    # Save the strain array to the vtk files
+    if save_vtk:
+        save_contour_strain(polys, strain, contour_name_stem)
 
-        # Calculate the segmental and global strains
-        for i in range(6):
-            table_strain['longit'][i, fr] = np.mean(strain[(seg_id == (i + 1)) & (dir_id == 3)])
-        table_strain['longit'][-1, fr] = np.mean(strain[dir_id == 3])
+    # Calculate the segmental and global strains
+    table_strain = {}
+    table_strain['longit'] = np.zeros((7, T))
+    table_strain['longit'][:6] = segment_mean(strain[:, dir_id == 3], seg_id[dir_id == 3], 6)
+    table_strain['longit'][-1] = np.mean(strain[:, dir_id == 3], axis=1)
 
     for c in ['longit']:
         # Save into csv files
@@ -1404,13 +1365,25 @@ def evaluate_la_strain_by_length(contour_name_stem, T, dt, output_name_stem):
         df.to_csv('{0}_{1}.csv'.format(output_name_stem, c))
 
 
-def cine_2d_la_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_name_stem):
-    """ Perform motion tracking and strain analysis for cine MR images. """
+def cine_2d_la_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_name_stem, motion_backend='mirtk',
+                                          n_workers=0):
+    """ Perform motion tracking and strain analysis for cine MR images.
+
+        motion_backend: 'mirtk' for the MIRTK command line tools or 'sitk' for the
+                        in-process SimpleITK registration, see motion_utils.py.
+        n_workers: number of registrations of the time frames which run concurrently.
+                   By default, they run one after another.
+        """
+    backend = create_motion_backend(motion_backend, '{0}/ffd_cine_la_2d_motion.cfg'.format(par_dir), output_dir)
+
+    # The segmentations may be saved as .nii.gz or .nii
+    seg4_la_4ch_ED_name = find_image('{0}/seg4_la_4ch_ED.nii.gz'.format(data_dir))
+    seg4_la_4ch_name = find_image('{0}/seg4_la_4ch.nii.gz'.format(data_dir))
+
     # Crop the image to save computation for image registration
     # Focus on the left ventricle so that motion tracking is less affected by
     # the movement of RV and LV outflow tract
-    padding('{0}/seg4_la_4ch_ED.nii.gz'.format(data_dir),
-            '{0}/seg4_la_4ch_ED.nii.gz'.format(data_dir),
+    padding(seg4_la_4ch_ED_name, seg4_la_4ch_ED_name,
             '{0}/seg4_la_4ch_lv_ED.nii.gz'.format(output_dir), 2, 1)
     padding('{0}/seg4_la_4ch_lv_ED.nii.gz'.format(output_dir),
             '{0}/seg4_la_4ch_lv_ED.nii.gz'.format(output_dir),
@@ -1423,20 +1396,20 @@ def cine_2d_la_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_
             '{0}/seg4_la_4ch_lv_ED.nii.gz'.format(output_dir), 5, 0)
     auto_crop_image('{0}/seg4_la_4ch_lv_ED.nii.gz'.format(output_dir),
                     '{0}/seg4_la_4ch_lv_crop_ED.nii.gz'.format(output_dir), 20)
-    os.system('mirtk transform-image {0}/la_4ch.nii.gz {1}/la_4ch_crop.nii.gz '
-              '-target {1}/seg4_la_4ch_lv_crop_ED.nii.gz'.format(data_dir, output_dir))
-    os.system('mirtk transform-image {0}/seg4_la_4ch.nii.gz {1}/seg4_la_4ch_crop.nii.gz '
-              '-target {1}/seg4_la_4ch_lv_crop_ED.nii.gz'.format(data_dir, output_dir))
+    backend.resample('{0}/la_4ch.nii.gz'.format(data_dir), '{0}/la_4ch_crop.nii.gz'.format(output_dir),
+                     '{0}/seg4_la_4ch_lv_crop_ED.nii.gz'.format(output_dir))
+    backend.resample(seg4_la_4ch_name, '{0}/seg4_la_4ch_crop.nii.gz'.format(output_dir),
+                     '{0}/seg4_la_4ch_lv_crop_ED.nii.gz'.format(output_dir))
 
     # Extract the myocardial contour
-    extract_la_myocardial_contour('{0}/seg4_la_4ch_ED.nii.gz'.format(data_dir),
-                                  '{0}/seg_sa_ED.nii.gz'.format(data_dir),
+    extract_la_myocardial_contour(seg4_la_4ch_ED_name,
+                                  find_image('{0}/seg_sa_ED.nii.gz'.format(data_dir)),
                                   '{0}/la_4ch_myo_contour_ED.vtk'.format(output_dir))
 
     # Inter-frame motion estimation
-    nim = nib.load('{0}/la_4ch_crop.nii.gz'.format(output_dir))
-    T = nim.header['dim'][4]
-    dt = nim.header['pixdim'][4]
+    geometry = read_geometry('{0}/la_4ch_crop.nii.gz'.format(output_dir))
+    T = geometry.dim[4]
+    dt = geometry.dt
 
     # Label class in the segmentation
     label = {'BG': 0, 'LV': 1, 'Myo': 2, 'RV': 3, 'LA': 4, 'RA': 5}
@@ -1445,67 +1418,19 @@ def cine_2d_la_motion_and_strain_analysis(data_dir, par_dir, output_dir, output_
     split_sequence('{0}/la_4ch_crop.nii.gz'.format(output_dir),
                    '{0}/la_4ch_crop_fr'.format(output_dir))
 
-    # Forward image registration
-    for fr in range(1, T):
-        target_fr = fr - 1
-        source_fr = fr
-        target = '{0}/la_4ch_crop_fr{1:02d}.nii.gz'.format(output_dir, target_fr)
-        source = '{0}/la_4ch_crop_fr{1:02d}.nii.gz'.format(output_dir, source_fr)
-        par = '{0}/ffd_cine_la_2d_motion.cfg'.format(par_dir)
-        dof = '{0}/ffd_la_4ch_pair_{1:02d}_to_{2:02d}.dof.gz'.format(output_dir, target_fr, source_fr)
-        os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(target, source, par, dof))
-
-    # Compose forward inter-frame transformation fields
-    os.system('cp {0}/ffd_la_4ch_pair_00_to_01.dof.gz '
-              '{0}/ffd_la_4ch_forward_00_to_01.dof.gz'.format(output_dir))
-    for fr in range(2, T):
-        dofs = ''
-        for k in range(1, fr + 1):
-            dof = '{0}/ffd_la_4ch_pair_{1:02d}_to_{2:02d}.dof.gz'.format(output_dir, k - 1, k)
-            dofs += dof + ' '
-        dof_out = '{0}/ffd_la_4ch_forward_00_to_{1:02d}.dof.gz'.format(output_dir, fr)
-        os.system('mirtk compose-dofs {0} {1} -approximate'.format(dofs, dof_out))
-
-    # Backward image registration
-    for fr in range(T - 1, 0, -1):
-        target_fr = (fr + 1) % T
-        source_fr = fr
-        target = '{0}/la_4ch_crop_fr{1:02d}.nii.gz'.format(output_dir, target_fr)
-        source = '{0}/la_4ch_crop_fr{1:02d}.nii.gz'.format(output_dir, source_fr)
-        par = '{0}/ffd_cine_la_2d_motion.cfg'.format(par_dir)
-        dof = '{0}/ffd_la_4ch_pair_{1:02d}_to_{2:02d}.dof.gz'.format(output_dir, target_fr, source_fr)
-        os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(target, source, par, dof))
-
-    # Compose backward inter-frame transformation fields
-    os.system('cp {0}/ffd_la_4ch_pair_00_to_{1:02d}.dof.gz '
-              '{0}/ffd_la_4ch_backward_00_to_{1:02d}.dof.gz'.format(output_dir, T - 1))
-    for fr in range(T - 2, 0, -1):
-        dofs = ''
-        for k in range(T - 1, fr - 1, -1):
-            dof = '{0}/ffd_la_4ch_pair_{1:02d}_to_{2:02d}.dof.gz'.format(output_dir, (k + 1) % T, k)
-            dofs += dof + ' '
-        dof_out = '{0}/ffd_la_4ch_backward_00_to_{1:02d}.dof.gz'.format(output_dir, fr)
-        os.system('mirtk compose-dofs {0} {1} -approximate'.format(dofs, dof_out))
-
-    # Average the forward and backward transformations
-    os.system('mirtk init-dof {0}/ffd_la_4ch_forward_00_to_00.dof.gz'.format(output_dir))
-    os.system('mirtk init-dof {0}/ffd_la_4ch_backward_00_to_00.dof.gz'.format(output_dir))
-    os.system('mirtk init-dof {0}/ffd_la_4ch_00_to_00.dof.gz'.format(output_dir))
-    for fr in range(1, T):
-        dof_forward = '{0}/ffd_la_4ch_forward_00_to_{1:02d}.dof.gz'.format(output_dir, fr)
-        weight_forward = float(T - fr) / T
-        dof_backward = '{0}/ffd_la_4ch_backward_00_to_{1:02d}.dof.gz'.format(output_dir, fr)
-        weight_backward = float(fr) / T
-        dof_combine = '{0}/ffd_la_4ch_00_to_{1:02d}.dof.gz'.format(output_dir, fr)
-        os.system('average_3d_ffd 2 {0} {1} {2} {3} {4}'.format(dof_forward, weight_forward,
-                                                              dof_backward, weight_backward,
-                                                              dof_combine))
-
-    # Transform the contours and calculate the strain
-    for fr in range(0, T):
-        os.system('mirtk transform-points {0}/la_4ch_myo_contour_ED.vtk '
-                  '{0}/la_4ch_myo_contour_fr{1:02d}.vtk '
-                  '-dofin {0}/ffd_la_4ch_00_to_{1:02d}.dof.gz'.format(output_dir, fr))
+    # Track the myocardial contour through the cine sequence
+    image_names = ['{0}/la_4ch_crop_fr{1:02d}.nii.gz'.format(output_dir, fr) for fr in range(T)]
+    output_names = ['{0}/la_4ch_myo_contour_fr{1:02d}.vtk'.format(output_dir, fr) for fr in range(T)]
+    scheduler = MotionScheduler(n_workers)
+    outputs = track_contour_motion(backend,
+                                   image_names,
+                                   '{0}/la_4ch_myo_contour_ED.vtk'.format(output_dir),
+                                   output_names,
+                                   'ffd_la_4ch',
+                                   scheduler)
+    for output in outputs:
+        output.result()
+    scheduler.shutdown()
 
     # Calculate the strain based on the line length
     evaluate_la_strain_by_length('{0}/la_4ch_myo_contour_fr'.format(output_dir),
@@ -1714,12 +1639,14 @@ def evaluate_atrial_area_length(label, nim, long_axis):
 
 def aorta_pass_quality_control(image, seg):
     """ Quality control for aortic segmentation """
+    # Areas of the labels at each time frame
+    T = seg.shape[3]
+    counts = label_counts(seg, 3)
+
     for l_name, l in [('AAo', 1), ('DAo', 2)]:
         # Criterion 1: the aorta does not disappear at some point.
-        T = seg.shape[3]
         for t in range(T):
-            seg_t = seg[:, :, :, t]
-            area = np.sum(seg_t == l)
+            area = counts[t, l]
             if area == 0:
                 print('The area of {0} is 0 at time frame {1}.'.format(l_name, t))
                 return False
@@ -1755,7 +1682,7 @@ def aorta_pass_quality_control(image, seg):
                 return False
 
         # Criterion 4: no abrupt change of area
-        A = np.sum(seg == l, axis=(0, 1, 2))
+        A = counts[:, l]
         for t in range(T):
             ratio = A[t] / float(A[t-1])
             if ratio >= 2 or ratio <= 0.5:
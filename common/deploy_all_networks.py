@@ -0,0 +1,168 @@
+# Copyright 2017, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+    This script deploys all the short-axis and long-axis segmentation networks in one pass
+    over the data set.
+
+    Each network is loaded once, in its own graph and session. Each subject directory is
+    visited once, each image sequence is read once and segmented by every network which
+    applies to it. The subjects are processed in windows of a few subjects, so that each
+    network can pack the time frames of several subjects into a batch. The completion
+    markers of each network are the same as those written by deploy_network.py, so the
+    two scripts can be used interchangeably.
+    """
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from ukbb_cardiac.common.deploy_utils import completion_marker, SequenceJob, segment_sequences, save_sequence, \
+    prefetch, windows, AsyncWriter, load_model
+
+
+""" Deployment parameters """
+FLAGS = tf.app.flags.FLAGS
+tf.app.flags.DEFINE_string('data_dir', '/vol/bitbucket/wbai/own_work/ukbb_cardiac_demo',
+                           'Path to the data set directory, under which images '
+                           'are organised in subdirectories for each subject.')
+tf.app.flags.DEFINE_string('model_dir', 'trained_model',
+                           'Path to the directory of the saved trained models.')
+tf.app.flags.DEFINE_boolean('frozen', False,
+                            'Load the frozen inference graphs <model_name>.pb exported by '
+                            'export_frozen_graph.py, instead of the checkpoints.')
+tf.app.flags.DEFINE_integer('batch_slices', 0,
+                            'Maximum number of image slices evaluated by a network in one batch. '
+                            'By default, each time frame is evaluated on its own.')
+tf.app.flags.DEFINE_integer('compress_level', -1,
+                            'Gzip compression level (0-9) of the segmentations. '
+                            'By default, the nibabel default level is used.')
+tf.app.flags.DEFINE_enum('seg_ext', 'nii.gz', ['nii.gz', 'nii'],
+                         'File extension of the segmentations. Use nii to save them uncompressed, '
+                         'e.g. for scratch stages. The evaluation scripts read either extension.')
+tf.app.flags.DEFINE_integer('io_threads', 0,
+                            'Number of threads for reading the images ahead and for saving the '
+                            'segmentations, which overlap with the network evaluation. '
+                            'By default, images are read and saved on the main thread.')
+tf.app.flags.DEFINE_integer('prefetch', 2,
+                            'Number of subjects which are read ahead when io_threads > 0.')
+tf.app.flags.DEFINE_integer('window', 4,
+                            'Number of subjects whose time frames are batched together by each '
+                            'network when batch_slices > 0.')
+
+# The networks, as (sequence name, model name, seg4)
+MODELS = [('sa', 'FCN_sa', False),
+          ('la_2ch', 'FCN_la_2ch', False),
+          ('la_4ch', 'FCN_la_4ch', False),
+          ('la_4ch', 'FCN_la_4ch_seg4', True)]
+
+# workaround for issue on GeForce RTX20xx GPUs
+# https://github.com/tensorflow/tensorflow/issues/36025#issuecomment-628145158
+gpu_devices = tf.config.experimental.list_physical_devices("GPU")
+for device in gpu_devices:
+    tf.config.experimental.set_memory_growth(device, True)
+
+
+def read_subject(data, data_dir, seq_names):
+    """ Read each image sequence of a subject which needs to be segmented """
+    jobs = {}
+    for seq_name in seq_names:
+        image_name = '{0}/{1}.nii.gz'.format(data_dir, seq_name)
+        jobs[seq_name] = SequenceJob(data, data_dir, image_name)
+    return data, jobs
+
+
+if __name__ == '__main__':
+    # Load all the networks once
+    models = []
+    for seq_name, model_name, seg4 in MODELS:
+        model_path = os.path.join(FLAGS.model_dir, model_name)
+        if FLAGS.frozen:
+            model_path += '.pb'
+            model_file = model_path
+        else:
+            model_file = '{0}.meta'.format(model_path)
+        if not os.path.exists(model_file):
+            print('Model {0} is not found. Skip.'.format(model_path))
+            continue
+        print('Loading {0} ...'.format(model_path))
+        models += [(seq_name, model_name, seg4, load_model(model_path))]
+
+    print('Start deployment on the data set ...')
+    start_time = time.time()
+
+    # Visit each subject subdirectory once and find the networks which need to be run
+    data_list = sorted(filter(lambda x: not x.startswith('.'), os.listdir(FLAGS.data_dir)))
+    subjects = []
+    skipped = 0
+    for data in data_list:
+        data_dir = os.path.join(FLAGS.data_dir, data)
+        tasks = []
+        for seq_name, model_name, seg4, sess in models:
+            if os.path.exists(completion_marker(data_dir, seq_name, seg4)):
+                continue
+            if not os.path.exists('{0}/{1}.nii.gz'.format(data_dir, seq_name)):
+                continue
+            tasks += [(seq_name, model_name, seg4, sess)]
+        if not tasks:
+            skipped += 1
+            continue
+        subjects += [(data, data_dir, tasks)]
+    if skipped > 0:
+        print(f'{skipped} completed subjects skipped')
+
+    # The ED/ES images of a sequence segmented by several networks are saved by the seg4
+    # network, as the ES frame depends on the network. Otherwise, the saves of the two
+    # la_4ch networks may write the same files concurrently.
+    seg4_seqs = set([seq_name for seq_name, _, seg4, _ in models if seg4])
+
+    # Read the images ahead and save the segmentations in thread pools,
+    # while the networks run on the main thread.
+    reads = [(data, data_dir, sorted(set([x[0] for x in tasks]))) for data, data_dir, tasks in subjects]
+    writer = AsyncWriter(FLAGS.io_threads)
+    table_time = []
+    completed = 0
+    for window in windows(zip(prefetch(read_subject, reads, FLAGS.prefetch, FLAGS.io_threads), subjects),
+                          max(1, FLAGS.window)):
+        print(' '.join([data for (data, _), _ in window]))
+        used = set()
+        for seq_name, model_name, seg4, sess in models:
+            # The jobs of this network over the subjects of the window. The image of a
+            # sequence is shared by the networks which segment it.
+            model_jobs = []
+            for (data, jobs), (_, _, tasks) in window:
+                if model_name not in [x[1] for x in tasks]:
+                    continue
+                model_jobs += [jobs[seq_name].clone() if (data, seq_name) in used else jobs[seq_name]]
+                used.add((data, seq_name))
+
+            for seg_job in segment_sequences(sess, model_jobs, FLAGS.batch_slices):
+                print('  {0} {1}: segmentation time = {2:3f}s'.format(seg_job.data, model_name, seg_job.seg_time))
+                table_time += [seg_job.seg_time]
+                save_images = seg4 or seq_name not in seg4_seqs
+                writer.submit(save_sequence, seg_job, seq_name, seg4, True, FLAGS.compress_level, FLAGS.seg_ext,
+                              save_images)
+        completed += len(window)
+        print(f'progress: {completed/len(subjects) * 100:.2f}%')
+    writer.close()
+
+    for seq_name, model_name, seg4, sess in models:
+        sess.close()
+
+    if len(table_time) > 0:
+        print('Average segmentation time = {:.3f}s per sequence'.format(np.mean(table_time)))
+    process_time = time.time() - start_time
+    if len(subjects) > 0:
+        print('Including image I/O, CUDA resource allocation, '
+              'it took {:.3f}s for processing {:d} subjects ({:.3f}s per subjects).'.format(
+              process_time, len(subjects), process_time / len(subjects)))
@@ -20,6 +20,8 @@ import numpy as np
 import nibabel as nib
 import tensorflow as tf
 from ukbb_cardiac.common.image_utils import rescale_intensity
+from ukbb_cardiac.common.deploy_utils import completion_marker, SequenceJob, segment_sequences, save_sequence, \
+    save_segmentation, prefetch, AsyncWriter, load_model, run_network
 
 
 """ Deployment parameters """
@@ -32,7 +34,8 @@ tf.app.flags.DEFINE_string('data_dir', '/vol/bitbucket/wbai/own_work/ukbb_cardia
                            'are organised in subdirectories for each subject.')
 tf.app.flags.DEFINE_string('model_path',
                            '',
-                           'Path to the saved trained model.')
+                           'Path to the saved trained model, or to a frozen inference '
+                           'graph (.pb) exported by export_frozen_graph.py.')
 tf.app.flags.DEFINE_boolean('process_seq', True,
                             'Process a time sequence of images.')
 tf.app.flags.DEFINE_boolean('save_seg', True,
@@ -43,6 +46,22 @@ tf.app.flags.DEFINE_boolean('seg4', False,
                             'By default, for all the other tasks (ventricular segmentation'
                             'on short-axis images and atrial segmentation on long-axis images,'
                             'the networks are trained using 3,975 subjects from Application 2964.')
+tf.app.flags.DEFINE_integer('batch_slices', 0,
+                            'Maximum number of image slices evaluated by the network in one batch. '
+                            'Time frames of one or several subjects are packed into a batch. '
+                            'By default, each time frame is evaluated on its own.')
+tf.app.flags.DEFINE_integer('compress_level', -1,
+                            'Gzip compression level (0-9) of the segmentations. '
+                            'By default, the nibabel default level is used.')
+tf.app.flags.DEFINE_enum('seg_ext', 'nii.gz', ['nii.gz', 'nii'],
+                         'File extension of the segmentations. Use nii to save them uncompressed, '
+                         'e.g. for scratch stages. The evaluation scripts read either extension.')
+tf.app.flags.DEFINE_integer('io_threads', 0,
+                            'Number of threads for reading the images ahead and for saving the '
+                            'segmentations, which overlap with the network evaluation. '
+                            'By default, images are read and saved on the main thread.')
+tf.app.flags.DEFINE_integer('prefetch', 2,
+                            'Number of subjects which are read ahead when io_threads > 0.')
 
 # workaround for issue on GeForce RTX20xx GPUs
 # https://github.com/tensorflow/tensorflow/issues/36025#issuecomment-628145158
@@ -51,12 +70,9 @@ for device in gpu_devices:
     tf.config.experimental.set_memory_growth(device, True)
 
 if __name__ == '__main__':
-    with tf.compat.v1.Session() as sess:
-        sess.run(tf.compat.v1.global_variables_initializer())
-
-        # Import the computation graph and restore the variable values
-        saver = tf.compat.v1.train.import_meta_graph('{0}.meta'.format(FLAGS.model_path))
-        saver.restore(sess, '{0}'.format(FLAGS.model_path))
+    # Import the computation graph and restore the variable values,
+    # or load the frozen inference graph
+    with load_model(FLAGS.model_path) as sess:
 
         print('Start deployment on the data set ...')
         start_time = time.time()
@@ -68,26 +84,16 @@ if __name__ == '__main__':
         total = len(data_list)
         skipped = 0
         completed = 0
-        for data in data_list:
-            
-            data_dir = os.path.join(FLAGS.data_dir, data)
-
-            if FLAGS.process_seq:
-                if FLAGS.seq_name == 'la_4ch' and FLAGS.seg4:
-                    completion_marker = f'{data_dir}/.seg4_{FLAGS.seq_name}.done'
-                else:
-                    completion_marker = f'{data_dir}/.seg_{FLAGS.seq_name}.done'
-                if os.path.exists(completion_marker):
+        if FLAGS.process_seq:
+            # Find the subjects which have not been segmented yet
+            sequences = []
+            for data in data_list:
+                data_dir = os.path.join(FLAGS.data_dir, data)
+                if os.path.exists(completion_marker(data_dir, FLAGS.seq_name, FLAGS.seg4)):
                     skipped += 1
                     completed += 1
                     continue
 
-                if skipped > 0:
-                    print(f'{skipped} completed subjects skipped')
-                    skipped = 0
-
-                print(data)
-
                 # Process the temporal sequence
                 image_name = '{0}/{1}.nii.gz'.format(data_dir, FLAGS.seq_name)
 
@@ -95,90 +101,34 @@ if __name__ == '__main__':
                     print('  Directory {0} does not contain an image with file '
                           'name {1}. Skip.'.format(data_dir, os.path.basename(image_name)))
                     continue
-
-                # Read the image
-                print('  Reading {} ...'.format(image_name))
-                nim = nib.load(image_name)
-                image = nim.get_data()
-                X, Y, Z, T = image.shape
-                orig_image = image
-
-                print('  Segmenting full sequence ...')
-                start_seg_time = time.time()
-
-                # Intensity rescaling
-                image = rescale_intensity(image, (1, 99))
-
-                # Prediction (segmentation)
-                pred = np.zeros(image.shape)
-
-                # Pad the image size to be a factor of 16 so that the
-                # downsample and upsample procedures in the network will
-                # result in the same image size at each resolution level.
-                X2, Y2 = int(math.ceil(X / 16.0)) * 16, int(math.ceil(Y / 16.0)) * 16
-                x_pre, y_pre = int((X2 - X) / 2), int((Y2 - Y) / 2)
-                x_post, y_post = (X2 - X) - x_pre, (Y2 - Y) - y_pre
-                image = np.pad(image, ((x_pre, x_post), (y_pre, y_post), (0, 0), (0, 0)), 'constant')
-
-                # Process each time frame
-                for t in range(T):
-                    # Transpose the shape to NXYC
-                    image_fr = image[:, :, :, t]
-                    image_fr = np.transpose(image_fr, axes=(2, 0, 1)).astype(np.float32)
-                    image_fr = np.expand_dims(image_fr, axis=-1)
-
-                    # Evaluate the network
-                    prob_fr, pred_fr = sess.run(['prob:0', 'pred:0'],
-                                                feed_dict={'image:0': image_fr, 'training:0': False})
-
-                    # Transpose and crop segmentation to recover the original size
-                    pred_fr = np.transpose(pred_fr, axes=(1, 2, 0))
-                    pred_fr = pred_fr[x_pre:x_pre + X, y_pre:y_pre + Y]
-                    pred[:, :, :, t] = pred_fr
-
-                seg_time = time.time() - start_seg_time
-                print('  Segmentation time = {:3f}s'.format(seg_time))
-                table_time += [seg_time]
-                processed_list += [data]
-
-                # ED frame defaults to be the first time frame.
-                # Determine ES frame according to the minimum LV volume.
-                k = {}
-                k['ED'] = 0
-                if FLAGS.seq_name == 'sa' or (FLAGS.seq_name == 'la_4ch' and FLAGS.seg4):
-                    k['ES'] = np.argmin(np.sum(pred == 1, axis=(0, 1, 2)))
-                else:
-                    k['ES'] = np.argmax(np.sum(pred == 1, axis=(0, 1, 2)))
-                print('  ED frame = {:d}, ES frame = {:d}'.format(k['ED'], k['ES']))
-
-                # Save the segmentation
-                if FLAGS.save_seg:
-                    print('  Saving segmentation ...')
-                    nim2 = nib.Nifti1Image(pred, nim.affine)
-                    nim2.header['pixdim'] = nim.header['pixdim']
-                    if FLAGS.seq_name == 'la_4ch' and FLAGS.seg4:
-                        seg_name = '{0}/seg4_{1}.nii.gz'.format(data_dir, FLAGS.seq_name)
-                    else:
-                        seg_name = '{0}/seg_{1}.nii.gz'.format(data_dir, FLAGS.seq_name)
-                    nib.save(nim2, seg_name)
-
-                    for fr in ['ED', 'ES']:
-                        nib.save(nib.Nifti1Image(orig_image[:, :, :, k[fr]], nim.affine),
-                                 '{0}/{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr))
-                        if FLAGS.seq_name == 'la_4ch' and FLAGS.seg4:
-                            seg_name = '{0}/seg4_{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr)
-                        else:
-                            seg_name = '{0}/seg_{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr)
-                        nib.save(nib.Nifti1Image(pred[:, :, :, k[fr]], nim.affine), seg_name)
-                
-                # Touch the completion marker
-                Path(completion_marker).touch()
+                sequences += [(data, data_dir, image_name)]
+
+            if skipped > 0:
+                print(f'{skipped} completed subjects skipped')
+                skipped = 0
+
+            # Read the images ahead and save the segmentations in thread pools,
+            # while the time frames are segmented in batches on the main thread.
+            jobs = prefetch(SequenceJob, sequences, FLAGS.prefetch, FLAGS.io_threads)
+            writer = AsyncWriter(FLAGS.io_threads)
+            for job in segment_sequences(sess, jobs, FLAGS.batch_slices):
+                print('{0}: segmentation time = {1:3f}s'.format(job.data, job.seg_time))
+                table_time += [job.seg_time]
+                processed_list += [job.data]
+
+                # Save the segmentation and touch the completion marker
+                writer.submit(save_sequence, job, FLAGS.seq_name, FLAGS.seg4, FLAGS.save_seg,
+                              FLAGS.compress_level, FLAGS.seg_ext)
                 completed += 1
                 print(f'progress: {completed/total * 100:.2f}%')
+            writer.close()
 
-            else:
-                completion_marker = f'{data_dir}/.{FLAGS.seq_name}_EDES.done'
-                if os.path.exists(completion_marker):
+        else:
+            for data in data_list:
+                data_dir = os.path.join(FLAGS.data_dir, data)
+
+                edes_marker = f'{data_dir}/.{FLAGS.seq_name}_EDES.done'
+                if os.path.exists(edes_marker):
                     skipped += 1
                     continue
 
@@ -230,8 +180,7 @@ if __name__ == '__main__':
                     image = np.expand_dims(image, axis=-1)
 
                     # Evaluate the network
-                    prob, pred = sess.run(['prob:0', 'pred:0'],
-                                          feed_dict={'image:0': image, 'training:0': False})
+                    pred = run_network(sess, image)
 
                     # Transpose and crop the segmentation to recover the original size
                     pred = np.transpose(pred, axes=(1, 2, 0))
@@ -245,16 +194,14 @@ if __name__ == '__main__':
                     # Save the segmentation
                     if FLAGS.save_seg:
                         print('  Saving segmentation ...')
-                        nim2 = nib.Nifti1Image(pred, nim.affine)
-                        nim2.header['pixdim'] = nim.header['pixdim']
                         if FLAGS.seq_name == 'la_4ch' and FLAGS.seg4:
-                            seg_name = '{0}/seg4_{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr)
+                            seg_name = '{0}/seg4_{1}_{2}.{3}'.format(data_dir, FLAGS.seq_name, fr, FLAGS.seg_ext)
                         else:
-                            seg_name = '{0}/seg_{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr)
-                        nib.save(nim2, seg_name)
+                            seg_name = '{0}/seg_{1}_{2}.{3}'.format(data_dir, FLAGS.seq_name, fr, FLAGS.seg_ext)
+                        save_segmentation(pred, nim, seg_name, FLAGS.compress_level)
 
                 # Touch the completion marker
-                Path(completion_marker).touch()
+                Path(edes_marker).touch()
 
         if skipped > 0:
             print(f'{skipped} completed subjects skipped')
@@ -20,6 +20,8 @@ import numpy as np
 import nibabel as nib
 import tensorflow as tf
 from ukbb_cardiac.common.image_utils import *
+from ukbb_cardiac.common.deploy_utils import load_model, make_feed_dict, save_segmentation
+from ukbb_cardiac.common.network_ao import LSTM_FEATURES, find_lstm_features
 
 
 """ Deployment parameters """
@@ -36,7 +38,8 @@ tf.app.flags.DEFINE_string('data_dir',
                            'are organised in subdirectories for each subject.')
 tf.app.flags.DEFINE_string('model_path',
                            '/vol/biomedic2/wbai/ukbb_cardiac/UKBB_18545/model/UNet-LSTM_ao_level5_filter16_22222_batch1_iter20000_lr0.001_zscore_tw9_h16_bidir_seq2seq_wR5_wr0.1_joint/UNet-LSTM_ao_level5_filter16_22222_batch1_iter20000_lr0.001_zscore_tw9_h16_bidir_seq2seq_wR5_wr0.1_joint.ckpt-20000',
-                           'Path to the saved trained model.')
+                           'Path to the saved trained model, or to a frozen inference '
+                           'graph (.pb) exported by export_frozen_graph.py.')
 tf.app.flags.DEFINE_boolean('process_seq', True,
                             'Process a time sequence of images.')
 tf.app.flags.DEFINE_boolean('save_seg', True,
@@ -44,10 +47,22 @@ tf.app.flags.DEFINE_boolean('save_seg', True,
 tf.app.flags.DEFINE_boolean('z_score', True,
                             'Normalise the image intensity to z-score. '
                             'Otherwise, rescale the intensity.')
+tf.app.flags.DEFINE_integer('compress_level', -1,
+                            'Gzip compression level (0-9) of the segmentations. '
+                            'By default, the nibabel default level is used.')
+tf.app.flags.DEFINE_enum('seg_ext', 'nii.gz', ['nii.gz', 'nii'],
+                         'File extension of the segmentations. Use nii to save them uncompressed, '
+                         'e.g. for scratch stages. The evaluation scripts read either extension.')
 tf.app.flags.DEFINE_integer('weight_R', 5,
                             'Radius of the weighting window.')
 tf.app.flags.DEFINE_float('weight_r', 0.1,
                           'Power of weight for the seq2seq loss. 0: uniform; 1: linear; 2: square.')
+tf.app.flags.DEFINE_boolean('reuse_features', True,
+                            'For UNet-LSTM, compute the UNet features of each time frame once and '
+                            'reuse them for all the time windows which contain the frame. '
+                            'Otherwise, each time window is evaluated by the full network. '
+                            'The feature map is found by its graph collection or name, which are '
+                            'saved with the models trained by train_network_ao.py.')
 
 # workaround for issue on GeForce RTX20xx GPUs
 # https://github.com/tensorflow/tensorflow/issues/36025#issuecomment-628145158
@@ -55,13 +70,17 @@ gpu_devices = tf.config.experimental.list_physical_devices("GPU")
 for device in gpu_devices:
     tf.config.experimental.set_memory_growth(device, True)
 
-if __name__ == '__main__':
-    with tf.Session() as sess:
-        sess.run(tf.global_variables_initializer())
 
-        # Import the computation graph and restore the variable values
-        saver = tf.train.import_meta_graph('{0}.meta'.format(FLAGS.model_path))
-        saver.restore(sess, '{0}'.format(FLAGS.model_path))
+if __name__ == '__main__':
+    # Import the computation graph and restore the variable values,
+    # or load the frozen inference graph
+    with load_model(FLAGS.model_path) as sess:
+        features_tensor = None
+        if FLAGS.model == 'UNet-LSTM' and FLAGS.reuse_features:
+            features_tensor = find_lstm_features(sess.graph)
+            if features_tensor is None:
+                print('Warning: the model was saved without the UNet feature map {0}. '
+                      'Each time window will be evaluated by the full network.'.format(LSTM_FEATURES))
 
         print('Start evaluating on the test set ...')
         start_time = time.time()
@@ -139,8 +158,7 @@ if __name__ == '__main__':
 
                         # Evaluate the network
                         # prob_fr: NXYC
-                        prob_fr = sess.run('prob:0',
-                                           feed_dict={'image:0': image_fr, 'training:0': False})
+                        prob_fr = sess.run('prob:0', feed_dict=make_feed_dict(sess, image_fr))
 
                         # Transpose and crop to recover the original size
                         # prob_fr: XYNC
@@ -164,6 +182,18 @@ if __name__ == '__main__':
                     w = np.array(w)
                     w = np.reshape(w, (1, 1, 1, time_window, 1))
 
+                    # Compute the UNet features of each time frame once, in chunks of time_window frames.
+                    # Each frame is contained in time_window overlapping windows, which reuse its features.
+                    # features: NTXYC
+                    if features_tensor is not None:
+                        features = []
+                        for t1 in range(0, T, time_window):
+                            image_idx = image[:, :, :, t1:t1 + time_window]
+                            image_idx = np.transpose(image_idx, axes=(2, 3, 0, 1)).astype(np.float32)
+                            image_idx = np.expand_dims(image_idx, axis=-1)
+                            features += [sess.run(features_tensor, feed_dict=make_feed_dict(sess, image_idx))]
+                        features = np.concatenate(features, axis=1)
+
                     # For each time frame after a time_step
                     for t in range(0, T, FLAGS.time_step):
                         # Get the frames in the time window
@@ -178,19 +208,20 @@ if __name__ == '__main__':
                             else:
                                 idx += [i]
 
-                        # image_idx: NTXYC
-                        image_idx = image[:, :, :, idx]
-                        image_idx = np.transpose(image_idx, axes=(2, 3, 0, 1)).astype(np.float32)
-                        image_idx = np.expand_dims(image_idx, axis=-1)
-
                         # Evaluate the network
-                        # Curious: can we deploy the LSTM model more efficiently by utilising the state variable?
-                        # Currently, we have to feed all the time frames in the time window and we can not just
-                        # feed one time frame, because the LSTM is an unrolled model in the dataflow graph.
-                        # It needs all the input from the time window.
+                        # The LSTM is an unrolled model in the dataflow graph, so it needs all the input
+                        # from the time window. When the UNet features have been computed, only the
+                        # LSTM is evaluated for the window.
                         # prob_idx: NTXYC
-                        prob_idx = sess.run('prob:0',
-                                            feed_dict={'image:0': image_idx, 'training:0': False})
+                        if features_tensor is not None:
+                            prob_idx = sess.run('prob:0', feed_dict=make_feed_dict(sess, features[:, idx],
+                                                                                   features_tensor))
+                        else:
+                            # image_idx: NTXYC
+                            image_idx = image[:, :, :, idx]
+                            image_idx = np.transpose(image_idx, axes=(2, 3, 0, 1)).astype(np.float32)
+                            image_idx = np.expand_dims(image_idx, axis=-1)
+                            prob_idx = sess.run('prob:0', feed_dict=make_feed_dict(sess, image_idx))
 
                         # Transpose and crop the segmentation to recover the original size
                         # prob_idx: XYNTC
@@ -212,9 +243,8 @@ if __name__ == '__main__':
                 # Save the segmentation
                 if FLAGS.save_seg:
                     print('  Saving segmentation ...')
-                    nim2 = nib.Nifti1Image(pred, nim.affine)
-                    nim2.header['pixdim'] = nim.header['pixdim']
-                    nib.save(nim2, '{0}/seg_{1}.nii.gz'.format(data_dir, FLAGS.seq_name))
+                    seg_name = '{0}/seg_{1}.{2}'.format(data_dir, FLAGS.seq_name, FLAGS.seg_ext)
+                    save_segmentation(pred, nim, seg_name, FLAGS.compress_level)
 
                 seg_time = time.time() - start_seg_time
                 print('  Segmentation time = {:3f}s'.format(seg_time))
@@ -287,8 +317,7 @@ if __name__ == '__main__':
 
                     # Evaluate the network
                     # pred: NXY
-                    prob, pred = sess.run(['prob:0', 'pred:0'],
-                                          feed_dict={'image:0': image, 'training:0': False})
+                    prob, pred = sess.run(['prob:0', 'pred:0'], feed_dict=make_feed_dict(sess, image))
 
                     # Transpose and crop the segmentation to recover the original size
                     pred = np.transpose(pred, axes=(1, 2, 0))
@@ -300,9 +329,8 @@ if __name__ == '__main__':
                     # Save the segmentation
                     if FLAGS.save_seg:
                         print('  Saving segmentation ...')
-                        nim2 = nib.Nifti1Image(pred, nim.affine)
-                        nim2.header['pixdim'] = nim.header['pixdim']
-                        nib.save(nim2, '{0}/seg_{1}_{2}.nii.gz'.format(data_dir, FLAGS.seq_name, fr))
+                        seg_name = '{0}/seg_{1}_{2}.{3}'.format(data_dir, FLAGS.seq_name, fr, FLAGS.seg_ext)
+                        save_segmentation(pred, nim, seg_name, FLAGS.compress_level)
 
                 processed_list += [data]
                 
@@ -0,0 +1,328 @@
+# Copyright 2017, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+    Utility functions for deploying the segmentation networks on the image
+    sequences of a data set.
+
+    The time frames of a sequence are evaluated in batches. A batch can contain
+    several time frames of one subject, as well as time frames of several subjects,
+    as long as their padded image sizes are the same.
+
+    Image reading and segmentation saving (gzip decoding and encoding) can run in
+    thread pools, so that they overlap with the network evaluation on the main thread.
+    """
+import gzip
+import math
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import tensorflow as tf
+from ukbb_cardiac.common.image_utils import rescale_intensity, label_counts
+from ukbb_cardiac.common.nifti_cache import load_nifti
+
+
+def seg_prefix(seq_name, seg4=False):
+    """ File name prefix of the segmentation, which is seg4 for the 4-chamber segmentation """
+    if seq_name == 'la_4ch' and seg4:
+        return 'seg4'
+    return 'seg'
+
+
+def completion_marker(data_dir, seq_name, seg4=False):
+    """ File which marks that the sequence of a subject has been segmented """
+    return '{0}/.{1}_{2}.done'.format(data_dir, seg_prefix(seq_name, seg4), seq_name)
+
+
+def save_segmentation(pred, nim, filename, compress_level=-1):
+    """
+        Save a label map with the geometry of the image nim as uint8, without intensity
+        scaling. A .nii.gz file is compressed with the given gzip level (0-9), or with the
+        nibabel default if compress_level < 0. A .nii file is saved uncompressed.
+        """
+    nim2 = nib.Nifti1Image(pred.astype(np.uint8), nim.affine)
+    nim2.header['pixdim'] = nim.header['pixdim']
+    nim2.set_data_dtype(np.uint8)
+    nim2.header.set_slope_inter(1, 0)
+    if filename.endswith('.gz') and compress_level >= 0:
+        with gzip.open(filename, 'wb', compresslevel=compress_level) as f:
+            f.write(nim2.to_bytes())
+    else:
+        nib.save(nim2, filename)
+
+
+def pad_size(X, Y, factor=16):
+    """
+        Padding which makes the image size a factor of 16, so that the downsample
+        and upsample procedures in the network will result in the same image size
+        at each resolution level.
+        """
+    X2, Y2 = int(math.ceil(X / float(factor))) * factor, int(math.ceil(Y / float(factor))) * factor
+    x_pre, y_pre = int((X2 - X) / 2), int((Y2 - Y) / 2)
+    x_post, y_post = (X2 - X) - x_pre, (Y2 - Y) - y_pre
+    return x_pre, x_post, y_pre, y_post
+
+
+def load_model(model_path):
+    """
+        Load a trained model into its own graph and session.
+
+        model_path is either the checkpoint of a trained model, whose computation graph is
+        imported from the .meta file and whose variable values are restored, or a frozen
+        inference graph (.pb) exported by export_frozen_graph.py.
+        """
+    graph = tf.Graph()
+    with graph.as_default():
+        if model_path.endswith('.pb'):
+            graph_def = tf.compat.v1.GraphDef()
+            with tf.io.gfile.GFile(model_path, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name='')
+            sess = tf.compat.v1.Session(graph=graph)
+        else:
+            sess = tf.compat.v1.Session(graph=graph)
+            saver = tf.compat.v1.train.import_meta_graph('{0}.meta'.format(model_path))
+            saver.restore(sess, '{0}'.format(model_path))
+    return sess
+
+
+def make_feed_dict(sess, image, image_tensor='image:0'):
+    """
+        Feed dictionary for evaluating the network on an image batch. The training flag
+        only exists in the training graph, as it is folded into a frozen inference graph.
+        """
+    feed_dict = {image_tensor: image}
+    try:
+        sess.graph.get_operation_by_name('training')
+        feed_dict['training:0'] = False
+    except KeyError:
+        pass
+    return feed_dict
+
+
+def run_network(sess, image):
+    """ Evaluate the network on a batch of images (NXYC) and return the label maps (NXY) """
+    return sess.run('pred:0', feed_dict=make_feed_dict(sess, image))
+
+
+class SequenceJob(object):
+    """ A temporal image sequence of one subject, which is segmented time frame by time frame """
+    def __init__(self, data, data_dir, image_name):
+        self.data = data
+        self.data_dir = data_dir
+
+        # Read the image
+        self.nim = load_nifti(image_name)
+        image = self.nim.get_data()
+        X, Y, Z, T = image.shape
+        self.orig_image = image
+
+        # Intensity rescaling
+        image = rescale_intensity(image, (1, 99))
+
+        # Prediction (segmentation)
+        self.pred = np.zeros(image.shape, dtype=np.uint8)
+
+        # Pad the image size to be a factor of 16
+        x_pre, x_post, y_pre, y_post = pad_size(X, Y)
+        self.image = np.pad(image, ((x_pre, x_post), (y_pre, y_post), (0, 0), (0, 0)), 'constant')
+        self.crop = (slice(x_pre, x_pre + X), slice(y_pre, y_pre + Y))
+
+        # Number of time frames which have not been segmented yet
+        self.n_pending = T
+        self.seg_time = 0
+
+    def clone(self):
+        """
+            Return a job which shares the image of this job but has its own segmentation,
+            so that another network can segment the same sequence without reading it again.
+            """
+        job = SequenceJob.__new__(SequenceJob)
+        job.__dict__.update(self.__dict__)
+        job.pred = np.zeros(self.pred.shape, dtype=np.uint8)
+        job.n_pending = self.image.shape[3]
+        job.seg_time = 0
+        return job
+
+    def get_frame(self, t):
+        """ Return time frame t in the shape of NXYC """
+        image_fr = np.transpose(self.image[:, :, :, t], axes=(2, 0, 1)).astype(np.float32)
+        return np.expand_dims(image_fr, axis=-1)
+
+    def set_frame(self, t, pred_fr):
+        """ Transpose and crop the segmentation of time frame t to recover the original size """
+        pred_fr = np.transpose(pred_fr, axes=(1, 2, 0))
+        self.pred[:, :, :, t] = pred_fr[self.crop]
+        self.n_pending -= 1
+
+
+def segment_sequences(sess, jobs, batch_slices=0):
+    """
+        Segment the time frames of a stream of sequence jobs.
+
+        Time frames with the same padded image size are packed into a batch of at most
+        batch_slices slices, which may contain time frames of several subjects. A time frame
+        is never split across batches, so with batch_slices=0, each time frame is evaluated
+        on its own. Each job is yielded once all its time frames have been segmented.
+        """
+    # Time frames waiting to be evaluated and their number of slices,
+    # grouped by the padded image size
+    pending = {}
+    pending_slices = {}
+
+    def evaluate(key):
+        frames = pending.pop(key)
+        pending_slices.pop(key)
+        start_time = time.time()
+        batch = np.concatenate([job.get_frame(t) for job, t in frames], axis=0)
+        pred = run_network(sess, batch)
+        batch_time = time.time() - start_time
+
+        # Scatter the predictions back to each job
+        completed = []
+        n = 0
+        for job, t in frames:
+            Z = job.image.shape[2]
+            job.set_frame(t, pred[n:n + Z])
+            job.seg_time += batch_time * Z / float(len(batch))
+            n += Z
+            if job.n_pending == 0:
+                completed += [job]
+        return completed
+
+    for job in jobs:
+        key = job.image.shape[:2]
+        Z, T = job.image.shape[2:]
+        for t in range(T):
+            if key in pending and pending_slices[key] + Z > batch_slices:
+                for completed_job in evaluate(key):
+                    yield completed_job
+            pending.setdefault(key, []).append((job, t))
+            pending_slices[key] = pending_slices.get(key, 0) + Z
+            if pending_slices[key] >= batch_slices:
+                for completed_job in evaluate(key):
+                    yield completed_job
+
+    # Evaluate the remaining time frames
+    for key in list(pending.keys()):
+        for completed_job in evaluate(key):
+            yield completed_job
+
+
+def save_sequence(job, seq_name, seg4=False, save_seg=True, compress_level=-1, seg_ext='nii.gz',
+                  save_images=True):
+    """
+        Determine the ED and ES time frames of a segmented sequence, save the segmentation
+        and the ED/ES images, then touch the completion marker. The segmentations are saved
+        as uint8 .<seg_ext> files using save_segmentation.
+
+        The ED/ES images <seq_name>_ED/ES.nii.gz do not depend on the network, but their
+        time frames do. With save_images=False, they are left to another job of the same
+        sequence, e.g. the la_4ch images are saved by the seg4 job, so that two jobs saved
+        concurrently never write the same file.
+        """
+    pred = job.pred
+    nim = job.nim
+    data_dir = job.data_dir
+    prefix = seg_prefix(seq_name, seg4)
+
+    # ED frame defaults to be the first time frame.
+    # Determine ES frame according to the minimum LV volume.
+    k = {}
+    k['ED'] = 0
+    lv_volume = label_counts(pred, 2)[:, 1]
+    if seq_name == 'sa' or (seq_name == 'la_4ch' and seg4):
+        k['ES'] = np.argmin(lv_volume)
+    else:
+        k['ES'] = np.argmax(lv_volume)
+    print('  {0}: ED frame = {1:d}, ES frame = {2:d}'.format(job.data, k['ED'], k['ES']))
+
+    # Save the segmentation
+    if save_seg:
+        seg_name = '{0}/{1}_{2}.{3}'.format(data_dir, prefix, seq_name, seg_ext)
+        save_segmentation(pred, nim, seg_name, compress_level)
+
+        for fr in ['ED', 'ES']:
+            if save_images:
+                nib.save(nib.Nifti1Image(job.orig_image[:, :, :, k[fr]], nim.affine),
+                         '{0}/{1}_{2}.nii.gz'.format(data_dir, seq_name, fr))
+            seg_name = '{0}/{1}_{2}_{3}.{4}'.format(data_dir, prefix, seq_name, fr, seg_ext)
+            save_segmentation(pred[:, :, :, k[fr]], nim, seg_name, compress_level)
+
+    # Touch the completion marker
+    Path(completion_marker(data_dir, seq_name, seg4)).touch()
+
+
+def prefetch(func, args_list, n_prefetch=2, n_threads=0):
+    """
+        Apply func to each tuple of arguments in args_list and yield the results in order.
+        With n_threads > 0, the next n_prefetch items are processed ahead in a thread pool,
+        e.g. to read and preprocess the next subjects while the network is running.
+        """
+    if n_threads <= 0:
+        for args in args_list:
+            yield func(*args)
+        return
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        futures = collections.deque()
+        for args in args_list:
+            futures.append(executor.submit(func, *args))
+            if len(futures) > n_prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def windows(items, size):
+    """ Split a stream of items into lists of at most size consecutive items """
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+class AsyncWriter(object):
+    """
+        Run the saving functions in a thread pool, so that compressing and writing the
+        images overlap with the network evaluation. At most 2 * n_threads saves are kept
+        in flight, which bounds the memory held by the pending images. With n_threads = 0,
+        the saving functions are run immediately.
+        """
+    def __init__(self, n_threads=0):
+        self.executor = ThreadPoolExecutor(n_threads) if n_threads > 0 else None
+        self.max_pending = 2 * n_threads
+        self.futures = collections.deque()
+
+    def submit(self, func, *args):
+        if self.executor is None:
+            func(*args)
+            return
+        self.futures.append(self.executor.submit(func, *args))
+        while len(self.futures) > self.max_pending:
+            self.futures.popleft().result()
+
+    def close(self):
+        """ Wait for the pending saves, re-raising any exception """
+        while self.futures:
+            self.futures.popleft().result()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,459 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Utility functions for running the evaluation scripts on a data set.
+
+    The subjects are evaluated in a process pool. Each worker takes the next subject
+    as soon as it has finished the previous one, so that a few slow subjects do not
+    hold up a statically assigned share of the data set.
+
+    The measures are saved by a results store in batches of csv files
+    <output_csv>.NNNN. The result of each subject is journaled as soon as it is
+    available and an index of the completed subjects is kept next to the batches,
+    so that an interrupted run can be resumed without reading the previous batches.
+    The batches can be merged into <output_csv> by running this script:
+
+        python3 common/eval_utils.py --output_csv <csv_name>
+
+    Optionally, the merged tables are also saved in the Parquet format (which needs
+    pyarrow), with the subject as the key, typed columns and the unit of each
+    column kept in the schema metadata, so that they can be read back column by column.
+    """
+import os
+import re
+import json
+import argparse
+import csv
+import time
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+BATCH_SIZE = 500
+TIME_COLUMN = 'time (s)'
+# Status of a subject in the index which is skipped, e.g. because its segmentation fails the quality control
+SKIPPED = 'skipped'
+# Result of a subject whose input files are missing, which is not recorded in the index,
+# so that the subject is evaluated once its files exist
+MISSING = 'missing'
+UNIT_PATTERN = re.compile(r'^(.*) \((.+)\)$')
+
+
+def run_subject(func, data, args):
+    """
+        Run func(*args) for one subject and time it. Returns a tuple
+        (data, result, seconds, error), where error is the traceback if func failed.
+        """
+    start_time = time.time()
+    try:
+        result = func(*args)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    return data, result, time.time() - start_time, error
+
+
+def run_subject_star(job):
+    """ Unpack the arguments of run_subject for Pool.imap_unordered """
+    return run_subject(*job)
+
+
+def run_subjects(func, jobs, n_workers=1):
+    """
+        Evaluate func on a list of jobs (data, args) and yield the tuples
+        (data, result, seconds, error) in the order of completion.
+
+        With n_workers > 1, the jobs are run in a process pool and handed out one at a
+        time, so that each worker takes the next pending subject once it becomes idle.
+        Otherwise, the jobs are run in order in the current process.
+        """
+    jobs = [(func, data, args) for data, args in jobs]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            for result in pool.imap_unordered(run_subject_star, jobs, chunksize=1):
+                yield result
+    else:
+        for job in jobs:
+            yield run_subject(*job)
+
+
+class ResultsStore(object):
+    """
+        Resumable store of the per-subject results of an evaluation script.
+
+        The measures are saved in batches <output_csv>.NNNN of batch_size subjects, with
+        the evaluation time of each subject as the last column. A batch is written to a
+        temporary file and renamed, so it is either complete or absent. The subjects of
+        each committed batch are then appended to the index <output_csv>.index, which is
+        all that needs to be read to find the completed subjects at startup.
+
+        Until its batch is committed, the result of a subject is appended to the journal
+        <output_csv>.journal and flushed to disk, so that no completed subject is lost
+        if the run is interrupted. A journal row which is cut short by a crash is ignored.
+
+        A subject which is skipped, e.g. because its segmentation fails the quality
+        control, is added to the index with the status 'skipped' instead of a batch number,
+        so that it is not evaluated again when the run is resumed. Remove its line from the
+        index to evaluate it again.
+        """
+    def __init__(self, output_csv, columns, batch_size=BATCH_SIZE):
+        self.output_dir = os.path.dirname(os.path.abspath(output_csv))
+        self.output_csv = output_csv
+        self.prefix = os.path.basename(output_csv) + '.'
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.index_name = '{0}.index'.format(output_csv)
+        self.journal_name = '{0}.journal'.format(output_csv)
+
+        # Read the index of the completed and skipped subjects
+        self.completed, self.skipped, self.batch = read_index(self.index_name)
+
+        # Index the batches which are not in the index, i.e. all the batches written by
+        # an earlier version of the script, or a batch committed just before a crash
+        for batch in batch_numbers(self.output_dir, self.prefix):
+            if batch > self.batch:
+                df = pd.read_csv(self.batch_name(batch), index_col=0)
+                self.append_index(batch, df.index.astype(str))
+                self.batch = batch
+
+        # Recover the results in the journal which have not been committed
+        self.pending = []
+        if os.path.exists(self.journal_name):
+            with open(self.journal_name, newline='') as f:
+                for row in csv.reader(complete_lines(f.read())):
+                    if len(row) == len(self.columns) + 2 and row[0] not in self.completed:
+                        self.pending.append(row)
+        self.journal = open(self.journal_name, 'w', newline='')
+        self.writer = csv.writer(self.journal)
+        self.writer.writerows(self.pending)
+        self.flush_journal()
+        self.completed.update(row[0] for row in self.pending)
+
+    def __contains__(self, data):
+        return data in self.completed or data in self.skipped
+
+    def __len__(self):
+        return len(self.completed)
+
+    def batch_name(self, batch):
+        return os.path.join(self.output_dir, '{0}{1:04d}'.format(self.prefix, batch))
+
+    def write_index(self, status, subjects):
+        with open(self.index_name, 'a') as f:
+            f.write(''.join('{0},{1}\n'.format(status, data) for data in subjects))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append_index(self, batch, subjects):
+        self.write_index(batch, subjects)
+        self.completed.update(subjects)
+        self.skipped.difference_update(subjects)
+
+    def flush_journal(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def append(self, data, line, seconds=np.nan):
+        """ Add the measures of a subject, committing a batch once it is full """
+        row = [data] + [repr(float(x)) for x in line] + ['{0:.3f}'.format(seconds)]
+        self.writer.writerow(row)
+        self.flush_journal()
+        self.pending.append(row)
+        self.completed.add(data)
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def skip(self, data):
+        """ Record a subject which is skipped, so that it is not evaluated again """
+        self.write_index(SKIPPED, [data])
+        self.skipped.add(data)
+
+    def commit(self):
+        """ Write the pending results as a new batch, index them and clear the journal """
+        if not self.pending:
+            return
+        batch = self.batch + 1
+        df = pd.DataFrame([row[1:] for row in self.pending],
+                          index=[row[0] for row in self.pending],
+                          columns=self.columns + [TIME_COLUMN]).astype(float)
+        tmp_name = os.path.join(self.output_dir, '.{0}{1:04d}.tmp'.format(self.prefix, batch))
+        df.to_csv(tmp_name)
+        os.replace(tmp_name, self.batch_name(batch))
+        self.append_index(batch, df.index)
+        self.batch = batch
+        self.pending = []
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.flush_journal()
+
+    def close(self):
+        """ Commit the remaining results """
+        self.commit()
+        self.journal.close()
+        os.remove(self.journal_name)
+
+
+def complete_lines(text):
+    """ The lines of a text which are terminated by a newline, i.e. not cut short by a crash """
+    return text.split('\n')[:-1]
+
+
+def read_index(index_name):
+    """
+        Read the index of a results store. Returns the set of completed subjects, the set
+        of skipped subjects and the number of the last indexed batch. The latest line of
+        a subject determines its status.
+        """
+    completed = set()
+    skipped = set()
+    last_batch = 0
+    if os.path.exists(index_name):
+        with open(index_name) as f:
+            for line in complete_lines(f.read()):
+                status, data = line.split(',', 1)
+                if status == SKIPPED:
+                    completed.discard(data)
+                    skipped.add(data)
+                else:
+                    skipped.discard(data)
+                    completed.add(data)
+                    last_batch = max(last_batch, int(status))
+    return completed, skipped, last_batch
+
+
+def batch_numbers(output_dir, prefix):
+    """ Numbers of the batch files <prefix>NNNN in the output directory """
+    pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+    batches = []
+    for f in os.listdir(output_dir):
+        m = pattern.match(f)
+        if m:
+            batches.append(int(m.group(1)))
+    return sorted(batches)
+
+
+def column_units(columns):
+    """ Units of the columns, which are given in brackets, e.g. 'LVEDV (mL)' is in mL """
+    units = {}
+    for c in columns:
+        m = UNIT_PATTERN.match(c)
+        units[c] = m.group(2) if m else ''
+    return units
+
+
+def parquet_name(table_name):
+    """ Name of the Parquet file saved alongside a csv table """
+    return '{0}.parquet'.format(os.path.splitext(table_name)[0])
+
+
+def save_parquet(df, filename):
+    """
+        Save a table of measures in the Parquet format. The index is saved as the
+        'subject' column, the measures as columns of their own types and the units
+        of the columns in the schema metadata under the key 'units'.
+        """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.rename_axis('subject')
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'units'] = json.dumps(column_units(df.columns)).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    tmp_name = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                            '.{0}.tmp'.format(os.path.basename(filename)))
+    pq.write_table(table, tmp_name)
+    os.replace(tmp_name, filename)
+
+
+def read_units(filename):
+    """ Units of the columns of a table saved by save_parquet """
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(filename).metadata or {}
+    return json.loads(metadata.get(b'units', b'{}').decode())
+
+
+def save_table(df, output_csv, parquet=False):
+    """ Save a table of measures to output_csv and optionally to <output_csv stem>.parquet """
+    tmp_name = os.path.join(os.path.dirname(os.path.abspath(output_csv)),
+                            '.{0}.tmp'.format(os.path.basename(output_csv)))
+    df.to_csv(tmp_name)
+    os.replace(tmp_name, output_csv)
+    if parquet:
+        save_parquet(df, parquet_name(output_csv))
+
+
+def read_table(filename, columns=None):
+    """
+        Read a table of measures saved as csv or Parquet, indexed by the subject.
+        Only the given columns are read if columns is not None.
+        """
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename, columns=columns)
+    if columns is None:
+        return pd.read_csv(filename, index_col=0)
+    index_col = pd.read_csv(filename, nrows=0).columns[0]
+    keep = set(columns) | {index_col}
+    return pd.read_csv(filename, index_col=0, usecols=lambda c: c in keep)[columns]
+
+
+def read_merge_state(output_csv):
+    """
+        The number of the last batch and the size of the index when the batches were last
+        merged into output_csv, or None if they have not been merged yet.
+        """
+    state_name = '{0}.merged'.format(output_csv)
+    if not os.path.exists(state_name) or not os.path.exists(output_csv):
+        return None
+    with open(state_name) as f:
+        last_batch, index_size = f.read().split(',')
+    return int(last_batch), int(index_size)
+
+
+def consolidate(output_csv, parquet=False, incremental=False):
+    """
+        Merge the batches <output_csv>.NNNN into output_csv, sorted by subject, and save
+        the evaluation times to <output_csv stem>_time.csv if they are recorded.
+        If a subject occurs in several batches, its latest measures are kept. The subjects
+        which are skipped according to the index are left out.
+
+        With incremental=True, only the batches committed since the last merge are read
+        and merged with the current output_csv, which is not rewritten if neither the
+        batches nor the index have changed since then.
+        """
+    output_dir = os.path.dirname(os.path.abspath(output_csv))
+    prefix = os.path.basename(output_csv) + '.'
+    index_name = '{0}.index'.format(output_csv)
+    time_csv = '{0}_time.csv'.format(os.path.splitext(output_csv)[0])
+    batches = batch_numbers(output_dir, prefix)
+    index_size = os.path.getsize(index_name) if os.path.exists(index_name) else 0
+
+    dfs = []
+    last_batch = 0
+    state = read_merge_state(output_csv) if incremental else None
+    if state is not None:
+        last_batch, last_index_size = state
+        if batches[-1:] <= [last_batch] and index_size == last_index_size \
+                and (not parquet or os.path.exists(parquet_name(output_csv))):
+            print('{0} is up to date.'.format(output_csv))
+            return None
+        batches = [batch for batch in batches if batch > last_batch]
+        df = pd.read_csv(output_csv, index_col=0)
+        if os.path.exists(time_csv):
+            df = df.join(pd.read_csv(time_csv, index_col=0))
+        dfs.append(df)
+
+    dfs += [pd.read_csv(os.path.join(output_dir, '{0}{1:04d}'.format(prefix, batch)), index_col=0)
+            for batch in batches]
+    if not dfs:
+        print('No results found for {0}.'.format(output_csv))
+        return None
+    df = pd.concat(dfs, sort=False)
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+    _, skipped, _ = read_index(index_name)
+    df = df[~df.index.astype(str).isin(skipped)]
+    if TIME_COLUMN in df.columns:
+        df[[TIME_COLUMN]].to_csv(time_csv)
+        df = df.drop(columns=[TIME_COLUMN])
+    save_table(df, output_csv, parquet)
+    with open('{0}.merged'.format(output_csv), 'w') as f:
+        f.write('{0},{1}'.format(max(batches + [last_batch]), index_size))
+    print('{0} subjects from {1} batches saved to {2}.'.format(len(df), len(batches), output_csv))
+    return df
+
+
+def collate(table_names, output_csv, parquet=False):
+    """
+        Collate the tables of several evaluation scripts into one table of imaging
+        phenotypes, with a row for each subject in any of the tables.
+        """
+    dfs = [read_table(name) for name in table_names]
+    for df in dfs:
+        df.index = df.index.astype(str)
+    df = pd.concat(dfs, axis=1, sort=True)
+    save_table(df, output_csv, parquet)
+    print('{0} subjects and {1} measures saved to {2}.'.format(len(df), len(df.columns), output_csv))
+    return df
+
+
+def evaluate_subjects(func, jobs, output_csv, columns, n_workers=1, batch_size=BATCH_SIZE, parquet=False):
+    """
+        Evaluate the subjects and save their measures to output_csv.
+
+        func(*args) returns the list of measures of a subject, None if the subject is
+        skipped, e.g. because its segmentation fails the quality control, or MISSING if its
+        input files are missing. The measures are saved in the results store of output_csv
+        as soon as each subject is complete and the subjects which are already in the store,
+        completed or skipped, are not evaluated again. A subject whose files are missing or
+        for which func raises an exception is evaluated again. At the end, the new batches
+        are merged into output_csv, and <output_csv stem>.parquet if parquet is True, and
+        the evaluation time of each subject is saved to <output_csv stem>_time.csv.
+        """
+    store = ResultsStore(output_csv, columns, batch_size)
+    pending = [(data, args) for data, args in jobs if data not in store]
+    completed = len([data for data, _ in jobs if data in store.completed])
+    if completed > 0:
+        print(f'{completed} completed subjects skipped')
+    skipped = len(jobs) - len(pending) - completed
+    if skipped > 0:
+        print(f'{skipped} subjects skipped in an earlier run')
+
+    results = {'processed': [], 'skipped': [], 'missing': [], 'failed': []}
+    try:
+        for data, line, seconds, error in run_subjects(func, pending, n_workers):
+            if error is not None:
+                print(f'{data}: failed after {seconds:.1f}s\n{error}', flush=True)
+                results['failed'].append(data)
+            elif isinstance(line, str) and line == MISSING:
+                print(f'{data}: missing input files', flush=True)
+                results['missing'].append(data)
+            elif line is None:
+                store.skip(data)
+                print(f'{data}: skipped', flush=True)
+                results['skipped'].append(data)
+            else:
+                store.append(data, line, seconds)
+                print(f'{data}: {seconds:.1f}s', flush=True)
+                results['processed'].append(data)
+    finally:
+        store.close()
+
+    # Save the measures and the evaluation times of all the subjects
+    consolidate(output_csv, parquet, incremental=True)
+
+    print(f'processed: {len(results["processed"])}, skipped: {completed + skipped + len(results["skipped"])}, '
+          f'missing: {len(results["missing"])}, failed: {len(results["failed"])}')
+    if results['failed']:
+        print('failed subjects: {0}'.format(' '.join(sorted(results['failed']))))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_csv', metavar='csv_name', default='', required=True,
+                        help='Merge the batches <csv_name>.NNNN into <csv_name>')
+    parser.add_argument('--collate', metavar='csv_name', nargs='+', default=None,
+                        help='Collate these tables into <csv_name> instead of merging the batches')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also save the table in the Parquet format')
+    args = parser.parse_args()
+
+    if args.collate:
+        collate(args.collate, args.output_csv, args.parquet)
+    else:
+        consolidate(args.output_csv, args.parquet)
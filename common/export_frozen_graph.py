@@ -0,0 +1,175 @@
+# Copyright 2017, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""
+    This script exports a trained model (build_FCN, build_ResNet or UNet-LSTM) as a frozen
+    inference graph, which can be loaded by deploy_network.py, deploy_all_networks.py and
+    deploy_network_ao.py by passing the .pb file as the model path.
+
+    The training placeholder is replaced by the constant False and the branches of the
+    batch normalisation layers for the training phase are removed, together with the
+    batch normalisation update ops and the optimiser slots. The variables are converted
+    to constants, the batch normalisation layers are folded into the convolution weights
+    and the constant expressions are folded.
+    """
+import os
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from ukbb_cardiac.common.network_ao import LSTM_FEATURES
+
+
+""" Export parameters """
+FLAGS = tf.app.flags.FLAGS
+tf.app.flags.DEFINE_string('model_path', '',
+                           'Path to the saved trained model.')
+tf.app.flags.DEFINE_string('output_path', '',
+                           'Path to the frozen inference graph. '
+                           'By default, it is <model_path>.pb.')
+tf.app.flags.DEFINE_string('output_nodes', 'prob,pred',
+                           'Comma-separated names of the output nodes.')
+
+
+def node_name(tensor_name):
+    """ Node name of a tensor name or a control input, e.g. ^cond/Switch or cond/Switch:1 """
+    return tensor_name.lstrip('^').split(':')[0]
+
+
+def tensor_port(tensor_name):
+    """ Output port of a tensor name """
+    parts = tensor_name.split(':')
+    return int(parts[1]) if len(parts) > 1 else 0
+
+
+def fold_constant_conds(graph_def):
+    """
+        Remove the branches of tf.cond which are not taken when the predicate is a constant,
+        e.g. the training branch of the batch normalisation layers once the training
+        placeholder has been replaced by False.
+
+        A Switch node forwards its data input to output port 1 if the predicate is True
+        and to output port 0 otherwise. The consumers of the taken port are connected to
+        the data input directly, the nodes which depend on the other port are dead, and
+        each Merge node is connected to its only live input.
+        """
+    nodes = {node.name: node for node in graph_def.node}
+
+    def constant_bool(name):
+        node = nodes[node_name(name)]
+        while node.op == 'Identity':
+            node = nodes[node_name(node.input[0])]
+        if node.op == 'Const' and node.attr['dtype'].type == tf.bool.as_datatype_enum:
+            return tf.make_ndarray(node.attr['value'].tensor).item()
+        return None
+
+    # Find the Switch nodes with a constant predicate and their taken output ports
+    taken = {}
+    for node in graph_def.node:
+        if node.op == 'Switch':
+            pred = constant_bool(node.input[1])
+            if pred is not None:
+                taken[node.name] = 1 if pred else 0
+    if not taken:
+        return graph_def
+
+    # Find the dead nodes, which depend on a port of a Switch node which is not taken
+    dead = set()
+    changed = True
+    while changed:
+        changed = False
+        for node in graph_def.node:
+            if node.name in dead or node.op == 'Merge':
+                continue
+            for x in node.input:
+                name = node_name(x)
+                if (name in taken and not x.startswith('^') and tensor_port(x) != taken[name]) or name in dead:
+                    dead.add(node.name)
+                    changed = True
+                    break
+
+    # Tensors which can be replaced by their live inputs
+    replace = {}
+    for name, port in taken.items():
+        replace['{0}:{1}'.format(name, port)] = nodes[name].input[0]
+    for node in graph_def.node:
+        if node.op == 'Merge':
+            live = [x for x in node.input if not x.startswith('^')
+                    and node_name(x) not in dead
+                    and not (node_name(x) in taken and tensor_port(x) != taken[node_name(x)])]
+            if len(live) == 1:
+                replace['{0}:0'.format(node.name)] = live[0]
+
+    def resolve(x):
+        key = x if ':' in x else x + ':0'
+        while key in replace:
+            x = replace[key]
+            key = x if ':' in x else x + ':0'
+        return x
+
+    output = tf.compat.v1.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in dead:
+            continue
+        new_node = output.node.add()
+        new_node.CopyFrom(node)
+        del new_node.input[:]
+        for x in node.input:
+            if x.startswith('^'):
+                if node_name(x) not in dead and node_name(x) not in taken:
+                    new_node.input.append(x)
+            else:
+                new_node.input.append(resolve(x))
+    return output
+
+
+if __name__ == '__main__':
+    output_nodes = FLAGS.output_nodes.split(',')
+    output_path = FLAGS.output_path if FLAGS.output_path else '{0}.pb'.format(FLAGS.model_path)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.compat.v1.Session(graph=graph) as sess:
+            # Import the computation graph, with the training placeholder replaced by False,
+            # and restore the variable values
+            training = tf.constant(False, name='training_false')
+            saver = tf.compat.v1.train.import_meta_graph('{0}.meta'.format(FLAGS.model_path),
+                                                         input_map={'training:0': training},
+                                                         clear_devices=True)
+            saver.restore(sess, '{0}'.format(FLAGS.model_path))
+
+            # Keep the UNet feature map of a UNet-LSTM model, which deploy_network_ao.py
+            # feeds to the LSTM, as an output node so that it is not removed
+            output_nodes += [x.op.name for x in graph.get_collection(LSTM_FEATURES)
+                             if x.op.name not in output_nodes]
+
+            # Convert the variables into constants and keep only the inference graph
+            graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), output_nodes)
+
+    graph_def = fold_constant_conds(graph_def)
+    graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph_def, output_nodes)
+
+    # Fold the constants and the batch normalisation layers into the convolution weights
+    graph_def = TransformGraph(graph_def, ['image'], output_nodes,
+                               ['strip_unused_nodes',
+                                'remove_nodes(op=Identity, op=CheckNumerics)',
+                                'fold_constants(ignore_errors=true)',
+                                'fold_batch_norms',
+                                'fold_old_batch_norms',
+                                'sort_by_execution_order'])
+
+    tf.io.write_graph(graph_def, os.path.dirname(os.path.abspath(output_path)),
+                      os.path.basename(output_path), as_text=False)
+    print('Frozen inference graph with {0} nodes is saved to {1}.'.format(len(graph_def.node), output_path))
@@ -0,0 +1,91 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Geometry of the images of a subject, without reading the images.
+
+    When the DICOM images of a subject are converted into nifti images, the geometry
+    of each image (affine, pixdim, dim and the temporal spacing dt) is saved to the
+    sidecar file geometry.json in the subject directory. read_geometry() looks up the
+    geometry of an image in the sidecar, or reads the image header if the image is not
+    listed, so that the pixel data never need to be read for a geometry lookup.
+    """
+import os
+import json
+import numpy as np
+from ukbb_cardiac.common.nifti_cache import load_header
+
+GEOMETRY_FILE = 'geometry.json'
+
+
+class ImageGeometry(object):
+    """ Image-to-world affine matrix, nifti dim and pixdim fields and temporal spacing of an image """
+    def __init__(self, affine, dim, pixdim):
+        self.affine = np.array(affine, dtype=np.float64)
+        # Same types as the dim and pixdim fields of the nifti header
+        self.dim = np.array(dim, dtype=np.int16)
+        self.pixdim = np.array(pixdim, dtype=np.float32)
+
+    @property
+    def dt(self):
+        return self.pixdim[4]
+
+    @staticmethod
+    def from_header(header):
+        return ImageGeometry(header.get_best_affine(), header['dim'], header['pixdim'])
+
+    @staticmethod
+    def from_dict(d):
+        return ImageGeometry(d['affine'], d['dim'], d['pixdim'])
+
+    def to_dict(self):
+        return {'affine': self.affine.tolist(),
+                'dim': self.dim.tolist(),
+                'pixdim': self.pixdim.tolist(),
+                'dt': float(self.dt)}
+
+
+def image_key(image_name):
+    """ Key of an image in the sidecar, i.e. its file name without the extension """
+    name = os.path.basename(image_name)
+    for ext in ['.nii.gz', '.nii']:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def write_geometry(output_dir, geometries):
+    """ Save a dictionary {image name: ImageGeometry} to the sidecar of a subject directory """
+    with open(os.path.join(output_dir, GEOMETRY_FILE), 'w') as f:
+        json.dump({image_key(name): g.to_dict() for name, g in geometries.items()}, f, indent=1)
+
+
+def read_sidecar(data_dir):
+    """ Read the sidecar of a subject directory as a dictionary {image key: ImageGeometry} """
+    sidecar = os.path.join(data_dir, GEOMETRY_FILE)
+    if not os.path.exists(sidecar):
+        return {}
+    with open(sidecar) as f:
+        return {key: ImageGeometry.from_dict(d) for key, d in json.load(f).items()}
+
+
+def read_geometry(image_name):
+    """
+        Geometry of an image, from the sidecar of its directory if the image is listed
+        there, otherwise from the image header.
+        """
+    geometry = read_sidecar(os.path.dirname(image_name)).get(image_key(image_name))
+    if geometry is None:
+        geometry = ImageGeometry.from_header(load_header(image_name))
+    return geometry
@@ -18,6 +18,7 @@ import nibabel as nib
 import tensorflow as tf
 from scipy import ndimage
 import scipy.ndimage.measurements as measure
+from ukbb_cardiac.common.nifti_cache import load_nifti
 
 
 def tf_categorical_accuracy(pred, truth):
@@ -224,6 +225,38 @@ def distance_metric(seg_A, seg_B, dx):
     return mean_md, mean_hd
 
 
+# Number of voxels counted at a time by label_counts()
+LABEL_COUNT_CHUNK = 1 << 22
+
+
+def label_counts(seg, n_labels):
+    """
+        Count the voxels of each label in each time frame of a segmentation (X, Y, Z, T)
+        in a single pass. Returns an array of shape (T, n_labels), whose entry (t, l) is
+        the number of voxels of label l at time frame t. Labels >= n_labels are ignored.
+        """
+    if seg.ndim == 3:
+        seg = np.expand_dims(seg, axis=3)
+    T = seg.shape[3]
+    n_bins = (n_labels + 1) * T
+
+    # Combined index label * T + t, with the labels >= n_labels gathered in the bin n_labels.
+    # It is computed in place in the smallest integer type which holds it, e.g. uint8 for
+    # 2 labels and 50 time frames, so that no full-size 8-byte array is created.
+    dtype = np.min_scalar_type(n_bins - 1)
+    idx = np.empty(seg.shape, dtype=dtype)
+    np.minimum(seg, n_labels, out=idx, casting='unsafe')
+    idx *= dtype.type(T)
+    idx += np.arange(T, dtype=dtype)
+
+    # bincount converts its input to intp, so it is counted in chunks to bound the memory
+    idx = idx.ravel()
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for start in range(0, idx.size, LABEL_COUNT_CHUNK):
+        counts += np.bincount(idx[start:start + LABEL_COUNT_CHUNK], minlength=n_bins)
+    return counts.reshape((n_labels + 1, T))[:n_labels].T
+
+
 def get_largest_cc(binary):
     """ Get the largest connected component in the foreground. """
     cc, n_cc = measure.label(binary)
@@ -251,7 +284,7 @@ def remove_small_cc(binary, thres=10):
 
 def split_sequence(image_name, output_name):
     """ Split an image sequence into a number of time frames. """
-    nim = nib.load(image_name)
+    nim = load_nifti(image_name)
     T = nim.header['dim'][4]
     affine = nim.affine
     image = nim.get_data()
@@ -280,7 +313,7 @@ def make_sequence(image_names, dt, output_name):
 
 def split_volume(image_name, output_name):
     """ Split an image volume into a number of slices. """
-    nim = nib.load(image_name)
+    nim = load_nifti(image_name)
     Z = nim.header['dim'][3]
     affine = nim.affine
     image = nim.get_data()
@@ -304,16 +337,16 @@ def image_apply_mask(input_name, output_name, mask_image, pad_value=-1):
 
 
 def padding(input_A_name, input_B_name, output_name, value_in_B, value_output):
-    nim = nib.load(input_A_name)
+    nim = load_nifti(input_A_name)
     image_A = nim.get_data()
-    image_B = nib.load(input_B_name).get_data()
+    image_B = load_nifti(input_B_name).get_data()
     image_A[image_B == value_in_B] = value_output
     nim2 = nib.Nifti1Image(image_A, nim.affine)
     nib.save(nim2, output_name)
 
 
 def auto_crop_image(input_name, output_name, reserve):
-    nim = nib.load(input_name)
+    nim = load_nifti(input_name)
     image = nim.get_data()
     X, Y, Z = image.shape[:3]
 
@@ -0,0 +1,433 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Motion backends for cine motion tracking.
+
+    A motion backend registers pairs of time frames, composes and averages the
+    transformations and transforms the contour points. Two backends are provided:
+
+    mirtk: runs the MIRTK command line tools (and average_3d_ffd), with each
+           transformation saved as a .dof.gz file in the output directory.
+    sitk:  runs a 2D B-spline free-form deformation registration in process using
+           SimpleITK. The transformations are kept in memory as dense displacement
+           fields, which are composed and averaged analytically, and the contour
+           points are warped directly.
+    """
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+import vtk
+import SimpleITK as sitk
+from vtk.util import numpy_support
+from scipy import ndimage
+from ukbb_cardiac.common.nifti_cache import cached_path, load_nifti
+
+
+def read_registration_par(par):
+    """ Read the parameters of a MIRTK registration configuration file as a dictionary.
+        Only the first occurrence of each parameter is kept, i.e. the parameters of
+        the first resolution level for the level-specific ones.
+        """
+    params = {}
+    with open(par) as f:
+        for line in f:
+            line = line.split('#')[0]
+            if '=' not in line:
+                continue
+            key, value = [x.strip() for x in line.split('=', 1)]
+            params.setdefault(key, value)
+    return params
+
+
+class MirtkBackend(object):
+    """ Motion backend using the MIRTK command line tools """
+    # compose-dofs -approximate fits a single FFD to the composition, which is not exact
+    approximate_compose = True
+
+    def __init__(self, par, output_dir):
+        self.par = par
+        self.output_dir = output_dir
+
+    def dof_name(self, name):
+        return '{0}/{1}.dof.gz'.format(self.output_dir, name)
+
+    def resample(self, input_name, output_name, target_name):
+        """ Resample an image onto the image grid of the target image """
+        os.system('mirtk transform-image {0} {1} -target {2}'.format(cached_path(input_name), output_name,
+                                                                     target_name))
+
+    def register(self, target, source, name):
+        """ Register the source image to the target image """
+        dof = self.dof_name(name)
+        os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(target, source, self.par, dof))
+        return dof
+
+    def compose(self, dofs, name):
+        """ Compose the transformations, with dofs[0] applied first """
+        dof_out = self.dof_name(name)
+        if len(dofs) == 1:
+            shutil.copyfile(dofs[0], dof_out)
+        else:
+            os.system('mirtk compose-dofs {0} {1} -approximate'.format(' '.join(dofs), dof_out))
+        return dof_out
+
+    def identity(self, target, name):
+        """ The identity transformation """
+        dof = self.dof_name(name)
+        os.system('mirtk init-dof {0}'.format(dof))
+        return dof
+
+    def average(self, dofs, weights, name):
+        """ The weighted average of the transformations """
+        dof_out = self.dof_name(name)
+        args = ' '.join(['{0} {1}'.format(dof, w) for dof, w in zip(dofs, weights)])
+        os.system('average_3d_ffd {0} {1} {2}'.format(len(dofs), args, dof_out))
+        return dof_out
+
+    def transform_points(self, input_name, output_name, dof):
+        """ Transform the points of a vtk polydata """
+        os.system('mirtk transform-points {0} {1} -dofin {2}'.format(input_name, output_name, dof))
+
+    def transform_image(self, input_name, output_name, dof, target_name, interp='Linear'):
+        """ Transform an image onto the image grid of the target image """
+        os.system('mirtk transform-image {0} {1} -dofin {2} -target {3} -interp {4}'.format(
+            input_name, output_name, dof, target_name, interp))
+
+
+class DisplacementField(object):
+    """ A dense 2D transformation on the voxel grid of a time frame.
+        The point at voxel (i, j) is mapped to (i, j) + disp[i, j].
+        """
+    def __init__(self, disp, affine):
+        self.disp = disp
+        self.affine = affine
+
+    def map_voxels(self, voxels):
+        """ Map the voxel coordinates (2 x N) """
+        u = np.stack([ndimage.map_coordinates(self.disp[:, :, c], voxels, order=1, mode='nearest')
+                      for c in range(2)], axis=0)
+        return voxels + u
+
+
+class SimpleITKBackend(object):
+    """ Motion backend using an in-process SimpleITK B-spline FFD registration.
+
+        The similarity metric, the number of resolution levels and the control point
+        spacing are read from the MIRTK configuration file. The bending energy term
+        is not supported by the SimpleITK registration and the regularisation comes
+        from the control point spacing only.
+        """
+    def __init__(self, par, output_dir):
+        params = read_registration_par(par)
+        self.output_dir = output_dir
+        self.n_levels = int(params.get('No. of resolution levels', 3))
+        self.cp_spacing = float(params.get('Control point spacing', 10))
+        self.similarity = params.get('Energy function', 'SSD').split('(')[0].strip()
+        self.max_iterations = 100
+
+    def resample(self, input_name, output_name, target_name):
+        """ Crop an image onto the image grid of the target image, which is
+            a sub-grid of the input image, as produced by auto_crop_image.
+            """
+        nim = load_nifti(input_name)
+        target = nib.load(target_name)
+        offset = np.round(np.dot(np.linalg.inv(nim.affine), target.affine[:, 3])[:3]).astype(int)
+        image = nim.get_data()
+        X, Y, Z = target.header['dim'][1:4]
+
+        # Pad the image in case the target grid is not fully inside the input grid
+        pad = [(max(-o, 0), max(o + n - s, 0)) for o, n, s in zip(offset, (X, Y, Z), image.shape[:3])]
+        pad += [(0, 0)] * (image.ndim - 3)
+        image = np.pad(image, pad, 'constant')
+        x, y, z = [o + p[0] for o, p in zip(offset, pad)]
+        image = image[x:x + X, y:y + Y, z:z + Z]
+
+        nim2 = nib.Nifti1Image(image, target.affine)
+        nim2.header['pixdim'] = nim.header['pixdim']
+        nib.save(nim2, output_name)
+
+    def read_frame(self, image_name, mean, std):
+        """ Read a 2D time frame as a SimpleITK image indexed in the same order as nibabel,
+            with its intensity normalised by the given mean and standard deviation
+            """
+        nim = nib.load(image_name)
+        image = np.squeeze(nim.get_data()).astype(np.float32)
+        image = (image - mean) / std
+        image = sitk.GetImageFromArray(np.transpose(image))
+        image.SetSpacing([float(x) for x in nim.header['pixdim'][1:3]])
+        return image, nim.affine
+
+    def register(self, target, source, name):
+        """ Register the source image to the target image """
+        # Normalise the intensity of both time frames with the mean and the standard
+        # deviation of the target frame. The same linear intensity transformation of both
+        # frames does not change the optimum of the similarity metrics, but helps the
+        # optimiser to converge. Normalising each frame separately would change the
+        # optimum of the mean squares metric.
+        target_image = np.asarray(nib.load(target).get_data(), dtype=np.float32)
+        mean, std = np.mean(target_image), max(np.std(target_image), 1e-6)
+        fixed, affine = self.read_frame(target, mean, std)
+        moving, _ = self.read_frame(source, mean, std)
+
+        reg = sitk.ImageRegistrationMethod()
+        if self.similarity == 'NMI':
+            reg.SetMetricAsMattesMutualInformation(numberOfHistogramBins=64)
+        else:
+            reg.SetMetricAsMeanSquares()
+        reg.SetInterpolator(sitk.sitkLinear)
+
+        # The control point mesh of the B-spline transformation
+        mesh_size = [max(1, int(round(n * s / self.cp_spacing)))
+                     for n, s in zip(fixed.GetSize(), fixed.GetSpacing())]
+        transform = sitk.BSplineTransformInitializer(fixed, mesh_size)
+        reg.SetInitialTransform(transform, inPlace=True)
+        reg.SetOptimizerAsLBFGS2(solutionAccuracy=1e-4, numberOfIterations=self.max_iterations)
+
+        # Multi-resolution pyramid, halving the image size at each level
+        factors = [2 ** k for k in range(self.n_levels - 1, -1, -1)]
+        reg.SetShrinkFactorsPerLevel(factors)
+        reg.SetSmoothingSigmasPerLevel([0.5 * f if f > 1 else 0 for f in factors])
+        reg.SmoothingSigmasAreSpecifiedInPhysicalUnitsOff()
+        reg.Execute(fixed, moving)
+
+        # Convert the transformation into a displacement field in voxel units
+        field = sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat64,
+                                                  fixed.GetSize(), fixed.GetOrigin(),
+                                                  fixed.GetSpacing(), fixed.GetDirection())
+        disp = np.transpose(sitk.GetArrayFromImage(field), axes=(1, 0, 2)) / np.array(fixed.GetSpacing())
+        return DisplacementField(disp, affine)
+
+    # The displacement fields are composed directly
+    approximate_compose = False
+
+    def compose(self, dofs, name):
+        """ Compose the transformations, with dofs[0] applied first """
+        disp = dofs[0].disp
+        X, Y = disp.shape[:2]
+        grid = np.stack(np.meshgrid(np.arange(X), np.arange(Y), indexing='ij'), axis=0).reshape((2, -1))
+        for dof in dofs[1:]:
+            voxels = grid + disp.reshape((-1, 2)).T
+            disp = (dof.map_voxels(voxels) - grid).T.reshape((X, Y, 2))
+        return DisplacementField(disp, dofs[0].affine)
+
+    def identity(self, target, name):
+        """ The identity transformation """
+        nim = nib.load(target)
+        X, Y = nim.header['dim'][1:3]
+        return DisplacementField(np.zeros((X, Y, 2)), nim.affine)
+
+    def average(self, dofs, weights, name):
+        """ The weighted average of the transformations """
+        disp = sum([w * dof.disp for dof, w in zip(dofs, weights)])
+        return DisplacementField(disp, dofs[0].affine)
+
+    def transform_points(self, input_name, output_name, dof):
+        """ Transform the points of a vtk polydata """
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(input_name)
+        reader.Update()
+        poly = reader.GetOutput()
+
+        # Map the world coordinates to voxel coordinates and transform them
+        points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData()).astype(np.float64)
+        N = points.shape[0]
+        voxels = np.dot(np.linalg.inv(dof.affine), np.concatenate((points.T, np.ones((1, N))), axis=0))
+        voxels[:2] = dof.map_voxels(voxels[:2])
+        points = np.dot(dof.affine, voxels)[:3].T
+
+        poly.GetPoints().SetData(numpy_support.numpy_to_vtk(points.astype(np.float32), deep=True))
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileName(output_name)
+        writer.SetInputData(poly)
+        writer.Write()
+
+
+# Motion backends by name
+MOTION_BACKENDS = {'mirtk': MirtkBackend,
+                   'sitk': SimpleITKBackend}
+
+
+def create_motion_backend(name, par, output_dir):
+    """ Create a motion backend by name, which uses the registration parameter file par """
+    if name not in MOTION_BACKENDS:
+        print('Error: unknown motion backend {0}!'.format(name))
+        exit(0)
+    return MOTION_BACKENDS[name](par, output_dir)
+
+
+class MotionScheduler(object):
+    """ Run the motion tracking steps on a bounded thread pool.
+
+        A step is submitted with its arguments, some of which may be the futures of
+        earlier steps. The step starts once these futures have completed, with the
+        futures replaced by their results, so independent steps, e.g. the pairwise
+        registrations of all the slices, run concurrently while a composition waits
+        for its inputs. A failed step fails the steps which depend on it.
+        With n_workers = 0, each step runs immediately when it is submitted.
+        """
+    def __init__(self, n_workers=0):
+        self.executor = ThreadPoolExecutor(n_workers) if n_workers > 0 else None
+
+    @staticmethod
+    def resolve(arg):
+        if isinstance(arg, Future):
+            return arg.result()
+        if isinstance(arg, list):
+            return [MotionScheduler.resolve(x) for x in arg]
+        return arg
+
+    def submit(self, func, *args):
+        """ Submit a step and return its future """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(func(*[self.resolve(x) for x in args]))
+            except BaseException as e:
+                future.set_exception(e)
+
+        def start():
+            if self.executor is None:
+                run()
+            else:
+                self.executor.submit(run)
+
+        deps = [x for x in args if isinstance(x, Future)]
+        deps += [y for x in args if isinstance(x, list) for y in x if isinstance(y, Future)]
+        deps = [x for x in deps if not x.done()]
+        if not deps:
+            start()
+            return future
+
+        # Start the step when the last of its inputs completes
+        n_pending = [len(deps)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                n_pending[0] -= 1
+                ready = (n_pending[0] == 0)
+            if ready:
+                start()
+
+        for dep in deps:
+            dep.add_done_callback(on_done)
+        return future
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def compose_incremental(backend, dofs, names, scheduler=None, prepend=False):
+    """ Compose a chain of transformations.
+
+        The k-th output is the composition of dofs[0], ..., dofs[k], with dofs[0] applied
+        first. With prepend=True, it is the composition of dofs[k], ..., dofs[0], with dofs[k]
+        applied first, e.g. to map each frame of a chain back to its first frame when dofs[k]
+        maps frame k + 1 to frame k.
+
+        If the backend composes exactly (SimpleITK), the k-th output is computed by composing
+        the (k - 1)-th output with dofs[k], which needs O(n) instead of O(n^2) compositions
+        for a chain of length n. If the backend approximates the compositions (MIRTK), the
+        approximation errors would accumulate along such a chain, so each output is composed
+        from scratch from dofs[0], ..., dofs[k] and approximated once, as in the original
+        pipeline. MIRTK therefore keeps the O(n^2) cost.
+
+        dofs: the transformations or their futures
+        names: the name of each output transformation
+        scheduler: the MotionScheduler which runs the compositions
+        return the futures of the composed transformations
+        """
+    if scheduler is None:
+        scheduler = MotionScheduler()
+    composed = [scheduler.submit(backend.compose, [dofs[0]], names[0])]
+    for k in range(1, len(dofs)):
+        if backend.approximate_compose:
+            chain = list(dofs[k::-1]) if prepend else list(dofs[:k + 1])
+        else:
+            chain = [dofs[k], composed[k - 1]] if prepend else [composed[k - 1], dofs[k]]
+        composed += [scheduler.submit(backend.compose, chain, names[k])]
+    return composed
+
+
+def track_contour_motion(backend, image_names, contour_name, output_names, prefix, scheduler=None):
+    """ Track a contour through a cine sequence.
+
+        The transformation from the first time frame to each time frame is estimated by
+        composing the inter-frame transformations forward and backward in time, which are
+        then averaged with the weights given by the temporal distances.
+
+        image_names: the image of each time frame
+        contour_name: the contour at the first time frame
+        output_names: the transformed contour of each time frame
+        prefix: the name prefix of the transformations, e.g. ffd_z00
+        scheduler: the MotionScheduler which runs the steps. By default, the steps
+                   run one after another.
+        return the futures of the transformed contours
+        """
+    if scheduler is None:
+        scheduler = MotionScheduler()
+    T = len(image_names)
+    pair = {}
+
+    # Forward and backward image registration, which are independent of each other
+    for fr in range(1, T):
+        target_fr = fr - 1
+        source_fr = fr
+        pair[(target_fr, source_fr)] = scheduler.submit(
+            backend.register, image_names[target_fr], image_names[source_fr],
+            '{0}_pair_{1:02d}_to_{2:02d}'.format(prefix, target_fr, source_fr))
+
+    for fr in range(T - 1, 0, -1):
+        target_fr = (fr + 1) % T
+        source_fr = fr
+        pair[(target_fr, source_fr)] = scheduler.submit(
+            backend.register, image_names[target_fr], image_names[source_fr],
+            '{0}_pair_{1:02d}_to_{2:02d}'.format(prefix, target_fr, source_fr))
+
+    # Compose forward inter-frame transformation fields, 00_to_01, 00_to_02, ...
+    frames = list(range(1, T))
+    composed = compose_incremental(backend,
+                                   [pair[(fr - 1, fr)] for fr in frames],
+                                   ['{0}_forward_00_to_{1:02d}'.format(prefix, fr) for fr in frames],
+                                   scheduler)
+    forward = dict(zip(frames, composed))
+
+    # Compose backward inter-frame transformation fields, 00_to_{T-1}, 00_to_{T-2}, ...
+    frames = list(range(T - 1, 0, -1))
+    composed = compose_incremental(backend,
+                                   [pair[((fr + 1) % T, fr)] for fr in frames],
+                                   ['{0}_backward_00_to_{1:02d}'.format(prefix, fr) for fr in frames],
+                                   scheduler)
+    backward = dict(zip(frames, composed))
+
+    # Average the forward and backward transformations
+    combined = {0: scheduler.submit(backend.identity, image_names[0], '{0}_00_to_00'.format(prefix))}
+    for fr in range(1, T):
+        weight_forward = float(T - fr) / T
+        weight_backward = float(fr) / T
+        combined[fr] = scheduler.submit(backend.average, [forward[fr], backward[fr]],
+                                        [weight_forward, weight_backward],
+                                        '{0}_00_to_{1:02d}'.format(prefix, fr))
+
+    # Transform the contours
+    outputs = []
+    for fr in range(0, T):
+        outputs += [scheduler.submit(backend.transform_points, contour_name, output_names[fr], combined[fr])]
+    return outputs
@@ -14,6 +14,9 @@
 # ==============================================================================
 from ukbb_cardiac.common.network import *
 
+# Name and graph collection of the UNet feature map which is passed to the LSTM in UNet_LSTM_Model
+LSTM_FEATURES = 'lstm_features'
+
 
 def UNet(images, n_class, n_level, n_filter, n_block, training):
     """
@@ -319,6 +322,21 @@ def BiConv_LSTM(features, lstm_input_shape, n_hidden, n_step, n_class):
     return outputs
 
 
+def find_lstm_features(graph):
+    """
+        Find the feature map (NTXYC) which the UNet passes to the LSTM in UNet_LSTM_Model, from
+        the collection saved with the model, or by its name in a frozen inference graph.
+        Returns None for a model which was saved without it.
+        """
+    features = graph.get_collection(LSTM_FEATURES)
+    if features:
+        return features[0]
+    try:
+        return graph.get_tensor_by_name('{0}:0'.format(LSTM_FEATURES))
+    except KeyError:
+        return None
+
+
 def UNet_LSTM_Model(images, labels, n_class, n_level, n_filter, n_block,
                     lstm_input_shape, n_hidden, n_step, training, training_UNet=False,
                     bidirectional=False, seq2seq=False, weight_R=1, weight_r=0):
@@ -344,6 +362,11 @@ def UNet_LSTM_Model(images, labels, n_class, n_level, n_filter, n_block,
     # features: NTXYC
     features = tf.reshape(features, [images_shape[0], images_shape[1], images_shape[2], images_shape[3], n_filter[0]])
 
+    # Name the feature map and add it to a collection, which is saved with the model, so that
+    # the deployment can compute the features of each time frame once and feed them to the LSTM
+    features = tf.identity(features, name=LSTM_FEATURES)
+    tf.add_to_collection(LSTM_FEATURES, features)
+
     # Pass the feature map to the LSTM
     # outputs: NTXYC
     if bidirectional:
@@ -0,0 +1,154 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# ==============================================================================
+"""
+    A local cache of uncompressed NIfTI images.
+
+    The same .nii.gz images are read by several stages of the pipeline, e.g. sa.nii.gz
+    and seg_sa.nii.gz are read by the deployment, the volume, wall thickness and strain
+    evaluations. With the cache enabled, each .nii.gz image is decompressed once into
+    an uncompressed .nii file in the cache directory and the stages open the cached
+    file with nibabel's memory mapping, instead of decompressing the image again.
+    The least recently used files are removed once the cache exceeds its size.
+
+    The cache is disabled by default. It is enabled for a process and its child
+    processes by the environment variables
+
+        UKBB_NIFTI_CACHE_DIR=<dir>      cache directory
+        UKBB_NIFTI_CACHE_SIZE=<GB>      maximal size of the cache (default: 20)
+
+    or by calling configure() in a script.
+    """
+import os
+import gzip
+import shutil
+import hashlib
+import nibabel as nib
+
+
+class NiftiCache(object):
+    """ Cache of uncompressed copies of .nii.gz images, with LRU eviction by size """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cached_name(self, filename):
+        """
+            File name of the cached copy of an image. The key includes the modification
+            time and the size of the image, so that a rewritten image is cached again.
+            """
+        st = os.stat(filename)
+        key = '{0}:{1}:{2}'.format(os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.nii')
+
+    def path(self, filename):
+        """ Path of the uncompressed copy of the image, which is created if it is not cached """
+        cached = self.cached_name(filename)
+        try:
+            # Mark the file as recently used
+            os.utime(cached)
+            return cached
+        except FileNotFoundError:
+            pass
+
+        # Decompress the image into a temporary file, which is renamed once it is
+        # complete, so that concurrent processes never see a partial file.
+        tmp_name = '{0}.{1}.tmp'.format(cached, os.getpid())
+        with gzip.open(filename, 'rb') as f_in, open(tmp_name, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+        os.replace(tmp_name, cached)
+        self.evict(keep=cached)
+        return cached
+
+    def evict(self, keep=None):
+        """ Remove the least recently used files until the cache fits in its size """
+        entries = []
+        total = 0
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.nii'):
+                continue
+            name = os.path.join(self.cache_dir, f)
+            try:
+                st = os.stat(name)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                # A file which is memory mapped by another process stays readable
+                # by that process after it is removed.
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def load(self, filename):
+        """ Load the cached copy of an image with memory mapping """
+        for attempt in range(2):
+            try:
+                return nib.load(self.path(filename), mmap=True)
+            except FileNotFoundError:
+                # The cached copy has been evicted by another process in between
+                if attempt > 0:
+                    raise
+
+
+_cache = None
+if os.environ.get('UKBB_NIFTI_CACHE_DIR'):
+    _cache = NiftiCache(os.environ['UKBB_NIFTI_CACHE_DIR'],
+                        int(float(os.environ.get('UKBB_NIFTI_CACHE_SIZE', 20)) * 1e9))
+
+
+def configure(cache_dir, size_gb=20):
+    """ Enable the cache in cache_dir with the given size in GB, or disable it if cache_dir is None """
+    global _cache
+    _cache = NiftiCache(cache_dir, int(size_gb * 1e9)) if cache_dir else None
+
+
+def cached_path(filename):
+    """ Path of the uncompressed cached copy of a .nii.gz image, or the image itself if it is not cached """
+    if _cache is None or not filename.endswith('.nii.gz'):
+        return filename
+    return _cache.path(filename)
+
+
+def load_nifti(filename):
+    """ Load an image, from its uncompressed cached copy if the cache is enabled """
+    if _cache is None or not filename.endswith('.nii.gz'):
+        return nib.load(filename)
+    return _cache.load(filename)
+
+
+def find_image(filename):
+    """
+        The image filename (.nii.gz) or, if it does not exist, the uncompressed image of the
+        same name (.nii), e.g. a segmentation saved by the deploy scripts with --seg_ext nii.
+        """
+    if filename.endswith('.nii.gz') and not os.path.exists(filename) and os.path.exists(filename[:-3]):
+        return filename[:-3]
+    return filename
+
+
+def load_header(filename):
+    """
+        Load only the header of an image, e.g. for its geometry. The pixel data are not
+        read, so the image is not decompressed or added to the cache.
+        """
+    return nib.load(filename).header
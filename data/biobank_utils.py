@@ -24,13 +24,20 @@
     and vary between manufacturers and machines.
 """
 import os
+import io
 import re
+import shutil
 import pickle
+import tempfile
+import zipfile
+import contextlib
 import cv2
 import pydicom as dicom
 import SimpleITK as sitk
 import numpy as np
+import pandas as pd
 import nibabel as nib
+from ukbb_cardiac.common.image_geometry import ImageGeometry, write_geometry
 
 
 def repl(m):
@@ -50,6 +57,103 @@ def process_manifest(name, name2):
                 f2.write(line2)
 
 
+def read_manifest(f):
+    """
+        Read the manifest.csv file from a file object into a data frame, after removing
+        the comma in the date format as process_manifest does.
+        """
+    text = ''.join([re.sub('([A-Z])(\w{2}) (\d{1,2}), 20(\d{2})', repl, line) for line in f])
+    return pd.read_csv(io.StringIO(text), error_bad_lines=False)
+
+
+class DicomDirSource(object):
+    """
+        DICOM files on disk, which have been sorted into one subdirectory per series
+        under input_dir. A series is referred to by its subdirectory name.
+        """
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+
+    def list_series(self):
+        return sorted(os.listdir(self.input_dir))
+
+    def list_files(self, series):
+        return sorted(os.listdir(os.path.join(self.input_dir, series)))
+
+    def get_file(self, series, f):
+        """ Return the file in a form which can be read by pydicom, i.e. its path """
+        return os.path.join(self.input_dir, series, f)
+
+    @contextlib.contextmanager
+    def local_file(self, series, f):
+        """ Provide a path to the file on disk, e.g. for SimpleITK """
+        yield os.path.join(self.input_dir, series, f)
+
+    def move_files(self, series, new_series, files):
+        """ Move some files of a series into a new series """
+        new_dir = os.path.join(self.input_dir, new_series)
+        os.mkdir(new_dir)
+        for f in files:
+            shutil.move(os.path.join(self.input_dir, series, f), new_dir)
+
+
+class DicomZipSource(object):
+    """
+        DICOM files read directly from UK Biobank zip files, without extracting them to disk.
+        The files are grouped into series according to the manifest file in each zip file.
+        """
+    def __init__(self, zip_paths):
+        self.series = {}
+        self.zips = []
+        for zip_path in zip_paths:
+            z = zipfile.ZipFile(zip_path)
+            self.zips += [z]
+            names = set(z.namelist())
+
+            # Some (or all?) manifest files have the extension .cvs
+            manifest = 'manifest.csv' if 'manifest.csv' in names else 'manifest.cvs'
+            with z.open(manifest) as f:
+                df = read_manifest(io.TextIOWrapper(f))
+
+            # Group the files for each imaging series
+            for series_name, series_df in df.groupby('series discription'):
+                series_files = self.series.setdefault(series_name, {})
+                for series_file in series_df['filename']:
+                    if series_file in names:
+                        series_files[series_file] = z
+
+    def close(self):
+        for z in self.zips:
+            z.close()
+
+    def list_series(self):
+        return sorted([x for x, y in self.series.items() if y])
+
+    def list_files(self, series):
+        return sorted(self.series[series].keys())
+
+    def get_file(self, series, f):
+        """ Return the file in a form which can be read by pydicom, i.e. an in-memory file object """
+        return io.BytesIO(self.series[series][f].read(f))
+
+    @contextlib.contextmanager
+    def local_file(self, series, f):
+        """ Provide a path to the file on disk, e.g. for SimpleITK, using a temporary file """
+        fd, path = tempfile.mkstemp(suffix='.dcm')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                f_out.write(self.series[series][f].read(f))
+            yield path
+        finally:
+            os.remove(path)
+
+    def move_files(self, series, new_series, files):
+        """ Move some files of a series into a new series """
+        new_files = self.series.setdefault(new_series, {})
+        for f in files:
+            new_files[f] = self.series[series].pop(f)
+
+
 class BaseImage(object):
     """ Representation of an image by an array, an image-to-world affine matrix and a temporal spacing """
     volume = np.array([])
@@ -61,6 +165,26 @@ class BaseImage(object):
         nim.header['pixdim'][4] = self.dt
         nim.header['sform_code'] = 1
         nib.save(nim, filename)
+        return ImageGeometry.from_header(nim.header)
+
+
+class DicomHeader(object):
+    """
+        Header fields of a DICOM file which are needed for finding the series, sorting the
+        time frames and computing the affine matrix. The pixel data are not read.
+        """
+    def __init__(self, filename, d):
+        self.filename = filename
+        self.series_uid = getattr(d, 'SeriesInstanceUID', None)
+        self.trigger_time = getattr(d, 'TriggerTime', None)
+        self.n_images = getattr(d, 'CardiacNumberOfImages', None)
+        self.columns = getattr(d, 'Columns', None)
+        self.rows = getattr(d, 'Rows', None)
+        self.pixel_spacing = getattr(d, 'PixelSpacing', None)
+        self.position = getattr(d, 'ImagePositionPatient', None)
+        self.orientation = getattr(d, 'ImageOrientationPatient', None)
+        self.spacing_between_slices = getattr(d, 'SpacingBetweenSlices', None)
+        self.slice_thickness = getattr(d, 'SliceThickness', None)
 
 
 class Biobank_Dataset(object):
@@ -69,13 +193,21 @@ class Biobank_Dataset(object):
         """
             Initialise data
             This is important, otherwise the dictionaries will not be cleaned between instances.
+
+            input_dir is either a directory which contains one subdirectory per series, or a
+            source object such as DicomZipSource, which reads the DICOM files from zip files.
             """
         self.subdir = {}
         self.data = {}
+        self.headers = {}
         self.suppress_warning = suppress_warning
+        if isinstance(input_dir, str):
+            self.source = DicomDirSource(input_dir)
+        else:
+            self.source = input_dir
 
         # Find and sort the DICOM sub directories
-        subdirs = sorted(os.listdir(input_dir))
+        subdirs = self.source.list_series()
         sax_dir = []
         lax_2ch_dir = []
         lax_3ch_dir = []
@@ -94,36 +226,36 @@ class Biobank_Dataset(object):
         for s in subdirs:
             m = re.match('CINE_segmented_SAX_b(\d*)$', s)
             if m:
-                sax_dir += [(os.path.join(input_dir, s), int(m.group(1)))]
+                sax_dir += [(s, int(m.group(1)))]
             elif re.match('CINE_segmented_LAX_2Ch$', s):
-                lax_2ch_dir = os.path.join(input_dir, s)
+                lax_2ch_dir = s
             elif re.match('CINE_segmented_LAX_3Ch$', s):
-                lax_3ch_dir = os.path.join(input_dir, s)
+                lax_3ch_dir = s
             elif re.match('CINE_segmented_LAX_4Ch$', s):
-                lax_4ch_dir = os.path.join(input_dir, s)
+                lax_4ch_dir = s
             elif re.match('CINE_segmented_SAX$', s):
-                sax_mix_dir = os.path.join(input_dir, s)
+                sax_mix_dir = s
             elif re.match('CINE_segmented_LAX$', s):
-                lax_mix_dir = os.path.join(input_dir, s)
+                lax_mix_dir = s
             elif re.match('CINE_segmented_Ao_dist$', s):
-                ao_dir = os.path.join(input_dir, s)
+                ao_dir = s
             elif re.match('CINE_segmented_LVOT$', s):
-                lvot_dir = os.path.join(input_dir, s)
+                lvot_dir = s
             elif re.match('flow_250_tp_AoV_bh_ePAT@c$', s):
-                flow_dir = os.path.join(input_dir, s)
+                flow_dir = s
             elif re.match('flow_250_tp_AoV_bh_ePAT@c_MAG$', s):
-                flow_mag_dir = os.path.join(input_dir, s)
+                flow_mag_dir = s
             elif re.match('flow_250_tp_AoV_bh_ePAT@c_P$', s):
-                flow_pha_dir = os.path.join(input_dir, s)
+                flow_pha_dir = s
             elif re.match('ShMOLLI_192i_SAX_b2s$', s):
-                shmolli_dir = os.path.join(input_dir, s)
+                shmolli_dir = s
             elif re.match('ShMOLLI_192i_SAX_b2s_SAX_b2s_FITPARAMS$', s):
-                shmolli_fitpar_dir = os.path.join(input_dir, s)
+                shmolli_fitpar_dir = s
             elif re.match('ShMOLLI_192i_SAX_b2s_SAX_b2s_SAX_b2s_T1MAP$', s):
-                shmolli_t1map_dir = os.path.join(input_dir, s)
+                shmolli_t1map_dir = s
             m = re.match('cine_tagging_3sl_SAX_b(\d*)s$', s)
             if m:
-                tag_dir += [(os.path.join(input_dir, s), int(m.group(1)))]
+                tag_dir += [(s, int(m.group(1)))]
 
         if not sax_dir:
             if not self.suppress_warning:
@@ -132,15 +264,13 @@ class Biobank_Dataset(object):
                 if not self.suppress_warning:
                     print('But a mixed SAX directory has been found. '
                         'We will sort it into directories for each slice.')
-                list = sorted(os.listdir(sax_mix_dir))
-                d = dicom.read_file(os.path.join(sax_mix_dir, list[0]))
+                list = self.source.list_files(sax_mix_dir)
+                d = dicom.read_file(self.source.get_file(sax_mix_dir, list[0]), stop_before_pixels=True)
                 T = d.CardiacNumberOfImages
                 Z = int(np.floor(len(list) / float(T)))
                 for z in range(Z):
-                    s = os.path.join(input_dir, 'CINE_segmented_SAX_b{0}'.format(z))
-                    os.mkdir(s)
-                    for f in list[z * T:(z + 1) * T]:
-                        os.system('mv {0}/{1} {2}'.format(sax_mix_dir, f, s))
+                    s = 'CINE_segmented_SAX_b{0}'.format(z)
+                    self.source.move_files(sax_mix_dir, s, list[z * T:(z + 1) * T])
                     sax_dir += [(s, z)]
 
         if not lax_2ch_dir and not lax_3ch_dir and not lax_4ch_dir:
@@ -150,26 +280,20 @@ class Biobank_Dataset(object):
                 if not self.suppress_warning:
                     print('But a mixed LAX directory has been found. '
                         'We will sort it into directories for 2Ch, 3Ch and 4Ch views.')
-                list = sorted(os.listdir(lax_mix_dir))
-                d = dicom.read_file(os.path.join(lax_mix_dir, list[0]))
+                list = self.source.list_files(lax_mix_dir)
+                d = dicom.read_file(self.source.get_file(lax_mix_dir, list[0]), stop_before_pixels=True)
                 T = d.CardiacNumberOfImages
                 if len(list) != 3 * T:
                     print('Error: cannot split files into three partitions!')
                 else:
-                    lax_3ch_dir = os.path.join(input_dir, 'CINE_segmented_LAX_3Ch')
-                    os.mkdir(lax_3ch_dir)
-                    for f in list[:T]:
-                        os.system('mv {0}/{1} {2}'.format(lax_mix_dir, f, lax_3ch_dir))
+                    lax_3ch_dir = 'CINE_segmented_LAX_3Ch'
+                    self.source.move_files(lax_mix_dir, lax_3ch_dir, list[:T])
 
-                    lax_4ch_dir = os.path.join(input_dir, 'CINE_segmented_LAX_4Ch')
-                    os.mkdir(lax_4ch_dir)
-                    for f in list[T:2 * T]:
-                        os.system('mv {0}/{1} {2}'.format(lax_mix_dir, f, lax_4ch_dir))
+                    lax_4ch_dir = 'CINE_segmented_LAX_4Ch'
+                    self.source.move_files(lax_mix_dir, lax_4ch_dir, list[T:2 * T])
 
-                    lax_2ch_dir = os.path.join(input_dir, 'CINE_segmented_LAX_2Ch')
-                    os.mkdir(lax_2ch_dir)
-                    for f in list[2 * T:3 * T]:
-                        os.system('mv {0}/{1} {2}'.format(lax_mix_dir, f, lax_2ch_dir))
+                    lax_2ch_dir = 'CINE_segmented_LAX_2Ch'
+                    self.source.move_files(lax_mix_dir, lax_2ch_dir, list[2 * T:3 * T])
 
         self.subdir = {}
         if sax_dir:
@@ -204,18 +328,33 @@ class Biobank_Dataset(object):
 
         self.cvi42_dir = cvi42_dir
 
+    def read_headers(self, dir_name):
+        """
+            Read the header of every DICOM file in a directory in a single pass, without the
+            pixel data. The header records are cached, so that each file is only parsed once
+            for finding the series, sorting the time frames and computing the geometry.
+            Pixel data are only read later for the files which are selected.
+            """
+        if dir_name not in self.headers:
+            headers = {}
+            for f in self.source.list_files(dir_name):
+                d = dicom.read_file(self.source.get_file(dir_name, f), stop_before_pixels=True)
+                headers[f] = DicomHeader(f, d)
+            self.headers[dir_name] = headers
+        return self.headers[dir_name]
+
     def find_series(self, dir_name, T):
         """
             In a few cases, there are two or three time sequences or series within each folder.
             We need to find which series to convert.
             """
-        files = sorted(os.listdir(dir_name))
+        headers = self.read_headers(dir_name)
+        files = list(headers.keys())
         if len(files) > T:
             # Sort the files according to their series UIDs
             series = {}
             for f in files:
-                d = dicom.read_file(os.path.join(dir_name, f))
-                suid = d.SeriesInstanceUID
+                suid = headers[f].series_uid
                 if suid in series:
                     series[suid] += [f]
                 else:
@@ -251,18 +390,18 @@ class Biobank_Dataset(object):
             # Number of slices
             Z = len(dir)
 
-            # Read a dicom file at the first slice to get the temporal information
+            # Read the dicom header at the first slice to get the temporal information
             # We need the number of images in a sequence to check whether multiple sequences are recorded
-            d = dicom.read_file(os.path.join(dir[0], sorted(os.listdir(dir[0]))[0]))
-            T = d.CardiacNumberOfImages
+            headers = self.read_headers(dir[0])
+            T = next(iter(headers.values())).n_images
 
-            # Read a dicom file from the correct series when there are multiple time sequences
-            d = dicom.read_file(os.path.join(dir[0], self.find_series(dir[0], T)[0]))
-            X = d.Columns
-            Y = d.Rows
-            T = d.CardiacNumberOfImages
-            dx = float(d.PixelSpacing[1])
-            dy = float(d.PixelSpacing[0])
+            # Read the dicom header from the correct series when there are multiple time sequences
+            d = headers[self.find_series(dir[0], T)[0]]
+            X = d.columns
+            Y = d.rows
+            T = d.n_images
+            dx = float(d.pixel_spacing[1])
+            dy = float(d.pixel_spacing[0])
 
             # DICOM coordinate (LPS)
             #  x: left
@@ -278,19 +417,19 @@ class Biobank_Dataset(object):
             # http://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/nifti1fields_pages/figqformusage
 
             # The coordinate of the upper-left voxel of the first and second slices
-            pos_ul = np.array([float(x) for x in d.ImagePositionPatient])
+            pos_ul = np.array([float(x) for x in d.position])
             pos_ul[:2] = -pos_ul[:2]
 
             # Image orientation
-            axis_x = np.array([float(x) for x in d.ImageOrientationPatient[:3]])
-            axis_y = np.array([float(x) for x in d.ImageOrientationPatient[3:]])
+            axis_x = np.array([float(x) for x in d.orientation[:3]])
+            axis_y = np.array([float(x) for x in d.orientation[3:]])
             axis_x[:2] = -axis_x[:2]
             axis_y[:2] = -axis_y[:2]
 
             if Z >= 2:
-                # Read a dicom file at the second slice
-                d2 = dicom.read_file(os.path.join(dir[1], sorted(os.listdir(dir[1]))[0]))
-                pos_ul2 = np.array([float(x) for x in d2.ImagePositionPatient])
+                # Read the dicom header at the second slice
+                d2 = next(iter(self.read_headers(dir[1]).values()))
+                pos_ul2 = np.array([float(x) for x in d2.position])
                 pos_ul2[:2] = -pos_ul2[:2]
                 axis_z = pos_ul2 - pos_ul
                 axis_z = axis_z / np.linalg.norm(axis_z)
@@ -298,8 +437,8 @@ class Biobank_Dataset(object):
                 axis_z = np.cross(axis_x, axis_y)
 
             # Determine the z spacing
-            if hasattr(d, 'SpacingBetweenSlices'):
-                dz = float(d.SpacingBetweenSlices)
+            if d.spacing_between_slices is not None:
+                dz = float(d.spacing_between_slices)
             elif Z >= 2:
                 if not self.suppress_warning:
                     print('Warning: can not find attribute SpacingBetweenSlices. '
@@ -309,7 +448,7 @@ class Biobank_Dataset(object):
                 if not self.suppress_warning:
                     print('Warning: can not find attribute SpacingBetweenSlices. '
                         'Use attribute SliceThickness instead.')
-                dz = float(d.SliceThickness)
+                dz = float(d.slice_thickness)
 
             # Affine matrix which converts the voxel coordinate to world coordinate
             affine = np.eye(4)
@@ -334,11 +473,12 @@ class Biobank_Dataset(object):
                 # We need to find which seires to convert.
                 files = self.find_series(dir[z], T)
 
-                # Now for this series, sort the files according to the trigger time.
+                # Now for this series, sort the files according to the trigger time,
+                # using the cached header records.
+                headers = self.read_headers(dir[z])
                 files_time = []
                 for f in files:
-                    d = dicom.read_file(os.path.join(dir[z], f))
-                    t = d.TriggerTime
+                    t = headers[f].trigger_time
                     files_time += [[f, t]]
                 files_time = sorted(files_time, key=lambda x: x[1])
 
@@ -351,7 +491,7 @@ class Biobank_Dataset(object):
                     # with nibabel's dimension.
                     try:
                         f = files_time[t][0]
-                        d = dicom.read_file(os.path.join(dir[z], f))
+                        d = dicom.read_file(self.source.get_file(dir[z], f))
                         volume[:, :, z, t] = d.pixel_array.transpose()
                     except IndexError:
                         print('Warning: dicom file missing for {0}: time point {1}. '
@@ -365,9 +505,10 @@ class Biobank_Dataset(object):
                         print('Warning: failed to read pixel_array from file {0}. '
                               'pydicom cannot handle compressed dicom files. '
                               'Switch to SimpleITK instead.'.format(os.path.join(dir[z], f)))
-                        reader = sitk.ImageFileReader()
-                        reader.SetFileName(os.path.join(dir[z], f))
-                        img = sitk.GetArrayFromImage(reader.Execute())
+                        with self.source.local_file(dir[z], f) as local_name:
+                            reader = sitk.ImageFileReader()
+                            reader.SetFileName(local_name)
+                            img = sitk.GetArrayFromImage(reader.Execute())
                         volume[:, :, z, t] = np.transpose(img[0], (1, 0))
 
                     if self.cvi42_dir:
@@ -455,6 +596,11 @@ class Biobank_Dataset(object):
                     self.data['label_up_' + name].dt = dt
 
     def convert_dicom_to_nifti(self, output_dir):
-        """ Save the image in nifti format. """
+        """
+            Save the image in nifti format, together with the geometry of the images
+            in the sidecar file geometry.json.
+            """
+        geometries = {}
         for name, image in self.data.items():
-            image.WriteToNifti(os.path.join(output_dir, '{0}.nii.gz'.format(name)))
+            geometries[name] = image.WriteToNifti(os.path.join(output_dir, '{0}.nii.gz'.format(name)))
+        write_geometry(output_dir, geometries)
@@ -17,7 +17,7 @@
     the manual annotations of 5,000 subjects.
 
     This script assumes that the images and annotations have already been downloaded
-    as zip files. It decompresses the zip files, sort the DICOM files into subdirectories
+    as zip files. It reads the DICOM files directly from the zip files, groups them into series
     according to the information provided in the manifest.csv spreadsheet, parse manual
     annotated contours from the cvi42 xml files, read the matching DICOM and cvi42 contours
     and finally save them as nifti images.
@@ -30,6 +30,9 @@ import csv
 import glob
 import re
 import time
+import argparse
+import traceback
+import multiprocessing
 import pandas as pd
 import dateutil.parser
 from biobank_utils import *
@@ -38,11 +41,64 @@ import parse_cvi42_xml
 DICOM_ZIP_PATTERN = re.compile('(\d+)_20210_(\d+)_0.zip')
 AORTIC_DIR = "20210-aortic"
 
+
+def convert_subject(eid_and_num, zip_list, data_path, output_dir):
+    """
+        Convert the DICOM zip files of one <eid>_<num> into nifti images.
+
+        The DICOM files are read directly from the zip files, without extracting them to disk.
+        The images are written to <output_dir>/<eid>_<num>.working, which is renamed to
+        <output_dir>/<eid>_<num> once the conversion is complete, so that subjects can be
+        converted concurrently. Returns a tuple (eid_and_num, status, message), where status
+        is one of 'converted', 'skipped' or 'failed'.
+        """
+    sub_output_dir = os.path.join(output_dir, eid_and_num)
+    tmp_sub_output_dir = os.path.join(output_dir, f'{eid_and_num}.working')
+    source = None
+    try:
+        if os.path.exists(tmp_sub_output_dir):
+            shutil.rmtree(tmp_sub_output_dir)
+        os.mkdir(tmp_sub_output_dir)
+
+        # Group the dicom files in the zip files into imaging series using the manifest files
+        source = DicomZipSource([os.path.join(data_path, f) for f in zip_list])
+
+        # Rare cases when no dicom file exists
+        # e.g. 12xxxxx/1270299
+        if not source.list_series():
+            shutil.rmtree(tmp_sub_output_dir, ignore_errors=True)
+            return eid_and_num, 'skipped', 'Warning: empty dicom directory! Skip this one.'
+
+        # Convert dicom files into nifti images
+        dset = Biobank_Dataset(source, None, suppress_warning=True)
+        dset.read_dicom_images()
+        dset.convert_dicom_to_nifti(tmp_sub_output_dir)
+
+        # rename temp working dir to the final dir
+        shutil.move(tmp_sub_output_dir, sub_output_dir)
+    except Exception:
+        shutil.rmtree(tmp_sub_output_dir, ignore_errors=True)
+        return eid_and_num, 'failed', traceback.format_exc()
+    finally:
+        if source:
+            source.close()
+
+    return eid_and_num, 'converted', 'done'
+
+
+def convert_subject_star(args):
+    """ Unpack the arguments of convert_subject for Pool.imap_unordered """
+    return convert_subject(*args)
+
+
 if __name__ == '__main__':
 
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print(f'Usage: {sys.argv[0]} <data_dir> [<output_dir>]', file=sys.stderr)
-        exit(-1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', metavar='data_dir')
+    parser.add_argument('output_dir', metavar='output_dir', nargs='?', default=None)
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of subjects to convert in parallel.')
+    args = parser.parse_args()
     
     # data_path is the path to the ukbb data
     # structure of input data dir
@@ -68,11 +124,11 @@ if __name__ == '__main__':
     #      |
     #     ...
     # -----------------------------------------
-    data_path = sys.argv[1]
+    data_path = args.data_dir
     # remove trailing slash if any
     if data_path.endswith('/'):
         data_path = data_path[:-1]
-    output_dir = sys.argv[2] if len(sys.argv) > 2 else f'{data_path}.converted'
+    output_dir = args.output_dir if args.output_dir else f'{data_path}.converted'
 
     ao_data_dir = os.path.join(data_path, AORTIC_DIR)
     if not os.path.isdir(ao_data_dir):
@@ -80,10 +136,6 @@ if __name__ == '__main__':
         exit(-1)
 
 
-    tmp_dir = os.path.join(os.getenv('HOME'), 'tmp')
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
-
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
@@ -99,70 +151,33 @@ if __name__ == '__main__':
         zip_list.append(os.path.join(AORTIC_DIR, item))    # append to the list
         zip_files[key] = zip_list   # update the dict
 
-    skipped = 0
-    # Convert image data for each <eid>_<num>
+    # Completed subjects are skipped, since the working dir is only renamed to
+    # the final dir after a successful conversion
+    jobs = []
+    completed = 0
     for eid_and_num, zip_list in sorted(zip_files.items(), key=lambda x:x[0]):
-        sub_output_dir = os.path.join(output_dir, eid_and_num)
-        if os.path.exists(sub_output_dir):
-            # print(f'skipping completed {eid_and_num}')
-            skipped += 1
+        if os.path.exists(os.path.join(output_dir, eid_and_num)):
+            completed += 1
             continue
-        if skipped > 0:
-            print(f'{skipped} completed subjects skipped')
-            skipped = 0
-        print(f'converting {eid_and_num}...', end='', flush=True)
-        tmp_sub_output_dir = os.path.join(output_dir, f'{eid_and_num}.working')
-        if os.path.exists(tmp_sub_output_dir):
-            shutil.rmtree(tmp_sub_output_dir)
-        os.mkdir(tmp_sub_output_dir)
-        # Decompress the zip files for this <eid>_<num>
-        dicom_dir = os.path.join(tmp_dir, f'{eid_and_num}_dicom')
-        if not os.path.exists(dicom_dir):
-            os.mkdir(dicom_dir)
-        
-        for f in zip_list:
-            # convert to full path
-            zip_path = os.path.join(data_path, f)
-            os.system(f'unzip -q -o {zip_path} -d {dicom_dir}')
-
-            # Process the manifest file
-            source_manifest = os.path.join(dicom_dir, 'manifest.csv');
-            if not os.path.exists(source_manifest):
-                source_manifest = os.path.join(dicom_dir, 'manifest.cvs');  # some(or all?) has extension .cvs
-            dest_manifest = os.path.join(dicom_dir, 'manifest2.csv')
-            process_manifest(source_manifest, dest_manifest)
-            df2 = pd.read_csv(dest_manifest, error_bad_lines=False)
-
-            # Organise the dicom files
-            # Group the files into subdirectories for each imaging series
-            for series_name, series_df in df2.groupby('series discription'):
-                series_dir = os.path.join(dicom_dir, series_name)
-                if not os.path.exists(series_dir):
-                    os.mkdir(series_dir)
-                for series_file in series_df['filename']:
-                    sf_path = os.path.join(dicom_dir, series_file)
-                    if os.path.exists(sf_path):
-                        shutil.move(sf_path, series_dir)
+        jobs.append((eid_and_num, zip_list, data_path, output_dir))
+    if completed > 0:
+        print(f'{completed} completed subjects skipped')
 
-        # Rare cases when no dicom file exists
-        # e.g. 12xxxxx/1270299
-        if not os.listdir(dicom_dir):
-            print('Warning: empty dicom directory! Skip this one.')
-            continue
-
-        # Convert dicom files into nifti images
-        dset = Biobank_Dataset(dicom_dir, None, suppress_warning=True)
-        dset.read_dicom_images()
-        dset.convert_dicom_to_nifti(tmp_sub_output_dir)
-
-        # Remove intermediate files
-        shutil.rmtree(dicom_dir, ignore_errors=True)
-
-        # rename temp working dir to the final dir
-        shutil.move(tmp_sub_output_dir, sub_output_dir)
-
-
-        print('done')
-    
-    if skipped > 0:
-        print(f'{skipped} completed subjects skipped')
\ No newline at end of file
+    # Convert image data for each <eid>_<num>
+    results = {'converted': [], 'skipped': [], 'failed': []}
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            for eid_and_num, status, message in pool.imap_unordered(convert_subject_star, jobs):
+                print(f'converting {eid_and_num}...{message}', flush=True)
+                results[status].append(eid_and_num)
+    else:
+        for job in jobs:
+            print(f'converting {job[0]}...', end='', flush=True)
+            eid_and_num, status, message = convert_subject(*job)
+            print(message)
+            results[status].append(eid_and_num)
+
+    print(f'converted: {len(results["converted"])}, skipped: {completed + len(results["skipped"])}, '
+          f'failed: {len(results["failed"])}')
+    if results['failed']:
+        print('failed subjects: {0}'.format(' '.join(sorted(results['failed']))))
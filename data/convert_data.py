@@ -17,7 +17,7 @@
     the manual annotations of 5,000 subjects.
 
     This script assumes that the images and annotations have already been downloaded
-    as zip files. It decompresses the zip files, sort the DICOM files into subdirectories
+    as zip files. It reads the DICOM files directly from the zip files, groups them into series
     according to the information provided in the manifest.csv spreadsheet, parse manual
     annotated contours from the cvi42 xml files, read the matching DICOM and cvi42 contours
     and finally save them as nifti images.
@@ -90,31 +90,16 @@ if __name__ == '__main__':
         sub_output_dir = os.path.join(output_dir, eid)
         if not os.path.exists(sub_output_dir):
             os.mkdir(sub_output_dir)
-        # Decompress the zip files in this directory
+        # Decompress the cvi42 zip file in this directory. The DICOM files are read
+        # directly from the other zip files and grouped into series using the manifest files.
         files = glob.glob('{0}/{1}_*.zip'.format(data_dir, eid))
-        dicom_dir = os.path.join(data_dir, 'dicom')
-        if not os.path.exists(dicom_dir):
-            os.mkdir(dicom_dir)
-
+        dicom_zips = []
         for f in files:
             if os.path.basename(f) == '{0}_cvi42.zip'.format(eid):
                 os.system('unzip -q -o {0} -d {1}'.format(f, data_dir))
             else:
-                os.system('unzip -q -o {0} -d {1}'.format(f, dicom_dir))
-
-                # Process the manifest file
-                process_manifest(os.path.join(dicom_dir, 'manifest.csv'),
-                                    os.path.join(dicom_dir, 'manifest2.csv'))
-                df2 = pd.read_csv(os.path.join(dicom_dir, 'manifest2.csv'), error_bad_lines=False)
-
-                # Organise the dicom files
-                # Group the files into subdirectories for each imaging series
-                for series_name, series_df in df2.groupby('series discription'):
-                    series_dir = os.path.join(dicom_dir, series_name)
-                    if not os.path.exists(series_dir):
-                        os.mkdir(series_dir)
-                    series_files = [os.path.join(dicom_dir, x) for x in series_df['filename']]
-                    os.system('mv {0} {1}'.format(' '.join(series_files), series_dir))
+                dicom_zips += [f]
+        source = DicomZipSource(dicom_zips)
 
         cvi42_contours_dir = None
         xml_name = os.path.join(data_dir, f'{eid}.cvi42wsx')
@@ -130,18 +115,20 @@ if __name__ == '__main__':
 
         # Rare cases when no dicom file exists
         # e.g. 12xxxxx/1270299
-        if not os.listdir(dicom_dir):
+        if not source.list_series():
             print('Warning: empty dicom directory! Skip this one.')
+            source.close()
             continue
 
         # Convert dicom files and annotations into nifti images
-        dset = Biobank_Dataset(dicom_dir, cvi42_contours_dir)
+        dset = Biobank_Dataset(source, cvi42_contours_dir)
         dset.read_dicom_images()
         dset.convert_dicom_to_nifti(sub_output_dir)
+        source.close()
 
         # Remove intermediate files
-        shutil.rmtree(dicom_dir, ignore_errors=True)
-        shutil.rmtree(cvi42_contours_dir, ignore_errors=True)
+        if cvi42_contours_dir:
+            shutil.rmtree(cvi42_contours_dir, ignore_errors=True)
 
         for file_path in (xml_name, json_name, txt_name):
             if os.path.exists(file_path):
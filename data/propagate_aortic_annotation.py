@@ -20,6 +20,7 @@ import sys
 import nibabel as nib
 import numpy as np
 from ukbb_cardiac.common.image_utils import *
+from ukbb_cardiac.common.motion_utils import MirtkBackend, compose_incremental
 
 
 def infer_time_frame(image_name, image_fr_name):
@@ -56,6 +57,12 @@ if __name__ == '__main__':
     data_list = sorted(os.listdir(data_path))
     par_path = '/vol/biomedic2/wbai/git/ukbb_cardiac/par'
 
+    # By default, the label of each frame is propagated from its source frame, i.e. the
+    # previous frame or the frame 5 frames before. Set compose_propagation to True to
+    # compose the transformations between consecutive frames back to the annotated frame
+    # instead, so that the annotation is resampled only once for each frame.
+    compose_propagation = False
+
     for data in data_list:
         print(data)
         data_dir = os.path.join(data_path, data)
@@ -129,9 +136,34 @@ if __name__ == '__main__':
                 sort_idx = np.argsort(dist)
                 prop_idx[t][dir] = prop_idx[t][dir][sort_idx]
 
+        backend = MirtkBackend('{0}/ffd_aortic_motion.cfg'.format(par_path), motion_dir)
+
         # For each time frame, infer the segmentation from its closest annotated time frame
         for t in t_anno:
             for dir in ['forward', 'backward']:
+                if compose_propagation:
+                    # The frames of prop_idx[t][dir] follow each other from frame t
+                    dofs = []
+                    for target_t in prop_idx[t][dir]:
+                        source_t = wrap_frame_index([target_t - 1 if dir == 'forward' else target_t + 1], T)[0]
+                        target_image = '{0}/ao_crop_fr{1:02d}.nii.gz'.format(motion_dir, target_t)
+                        source_image = '{0}/ao_crop_fr{1:02d}.nii.gz'.format(motion_dir, source_t)
+                        dofs += [backend.register(target_image, source_image,
+                                                  'ffd_{0:02d}_to_{1:02d}'.format(target_t, source_t))]
+                    if not dofs:
+                        continue
+
+                    # Transform the annotation of frame t by the composition from each target frame to frame t
+                    names = ['ffd_{0:02d}_to_{1:02d}_composed'.format(target_t, t) for target_t in prop_idx[t][dir]]
+                    composed = compose_incremental(backend, dofs, names, prepend=True)
+                    anno_label = '{0}/label_ao_prop{1:02d}.nii.gz'.format(motion_dir, t)
+                    orig_anno_image = '{0}/ao_fr{1:02d}.nii.gz'.format(motion_dir, t)
+                    for target_t, dof in zip(prop_idx[t][dir], composed):
+                        print('{0} -> {1}'.format(t, target_t))
+                        target_label = '{0}/label_ao_prop{1:02d}.nii.gz'.format(motion_dir, target_t)
+                        backend.transform_image(anno_label, target_label, dof.result(), orig_anno_image, interp='NN')
+                    continue
+
                 for target_t in prop_idx[t][dir]:
                     # Propagate from source_t to target_t
                     # To avoid accummulation of sub-pixel errors, use long-range propagation after every 5 frames
@@ -145,17 +177,14 @@ if __name__ == '__main__':
                     print('{0} -> {1}'.format(source_t, target_t))
                     target_image = '{0}/ao_crop_fr{1:02d}.nii.gz'.format(motion_dir, target_t)
                     source_image = '{0}/ao_crop_fr{1:02d}.nii.gz'.format(motion_dir, source_t)
-                    par = '{0}/ffd_aortic_motion.cfg'.format(par_path)
-                    dof = '{0}/ffd_{1:02d}_to_{2:02d}.dof.gz'.format(motion_dir, target_t, source_t)
-                    os.system('mirtk register {0} {1} -parin {2} -dofout {3}'.format(
-                        target_image, source_image, par, dof))
+                    dof = backend.register(target_image, source_image,
+                                           'ffd_{0:02d}_to_{1:02d}'.format(target_t, source_t))
 
                     source_label = '{0}/label_ao_prop{2:02d}.nii.gz'.format(motion_dir, fr, source_t)
                     target_label = '{0}/label_ao_prop{2:02d}.nii.gz'.format(motion_dir, fr, target_t)
 
                     orig_source_image = '{0}/ao_fr{1:02d}.nii.gz'.format(motion_dir, source_t)
-                    os.system('mirtk transform-image {0} {1} -dofin {2} -target {3} -interp NN'.format(
-                        source_label, target_label, dof, orig_source_image))
+                    backend.transform_image(source_label, target_label, dof, orig_source_image, interp='NN')
 
         # Combine into a sequence
         image_names = []
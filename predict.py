@@ -45,16 +45,21 @@ if __name__ == '__main__':
     if not os.path.exists(OUTPUT_CSV_DIR):
         os.mkdir(OUTPUT_CSV_DIR)
 
+    # Deploy the segmentation networks
+    # FCN_sa, FCN_la_2ch, FCN_la_4ch and FCN_la_4ch_seg4 are loaded once by a single
+    # process, which reads each subject's images once.
+    print('******************************')
+    print('  Image segmentation')
+    print('******************************')
+    print('Deploying the segmentation networks ...')
+    os.system(f'PYTHONPATH={PYTHONPATH} CUDA_VISIBLE_DEVICES={CUDA_VISIBLE_DEVICES} python3 common/deploy_all_networks.py --data_dir {DATA_DIR} '
+              f'--model_dir trained_model')
+
     # Analyse show-axis images
     print('******************************')
     print('  Short-axis image analysis')
     print('******************************')
 
-    # Deploy the segmentation network
-    print('Deploying the segmentation network ...')
-    os.system(f'PYTHONPATH={PYTHONPATH} CUDA_VISIBLE_DEVICES={CUDA_VISIBLE_DEVICES} python3 common/deploy_network.py --seq_name sa --data_dir {DATA_DIR} '
-              f'--model_path trained_model/FCN_sa')
-
     # Evaluate ventricular volumes
     print('Evaluating ventricular volumes ...')
     os.system(f'PYTHONPATH={PYTHONPATH} python3 short_axis/eval_ventricular_volume.py --data_dir {DATA_DIR} '
@@ -76,19 +81,6 @@ if __name__ == '__main__':
     print('  Long-axis image analysis')
     print('******************************')
 
-    # Deploy the segmentation network
-    print('Deploying the segmentation network FCN_la_2ch...')
-    os.system(f'PYTHONPATH={PYTHONPATH} CUDA_VISIBLE_DEVICES={CUDA_VISIBLE_DEVICES} python3 common/deploy_network.py --seq_name la_2ch --data_dir {DATA_DIR} '
-              f'--model_path trained_model/FCN_la_2ch')
-
-    print('Deploying the segmentation network FCN_la_4ch...')
-    os.system(f'PYTHONPATH={PYTHONPATH} CUDA_VISIBLE_DEVICES={CUDA_VISIBLE_DEVICES} python3 common/deploy_network.py --seq_name la_4ch --data_dir {DATA_DIR} '
-              f'--model_path trained_model/FCN_la_4ch')
-
-    print('Deploying the segmentation network FCN_la_4ch_seg4...')
-    os.system(f'PYTHONPATH={PYTHONPATH} CUDA_VISIBLE_DEVICES={CUDA_VISIBLE_DEVICES} python3 common/deploy_network.py --seq_name la_4ch --data_dir {DATA_DIR} '
-              f'--seg4 --model_path trained_model/FCN_la_4ch_seg4')
-
     # Evaluate atrial volumes
     print('Evaluating atrial volumes ...')
     os.system(f'PYTHONPATH={PYTHONPATH} python3 long_axis/eval_atrial_volume.py --data_dir {DATA_DIR} '
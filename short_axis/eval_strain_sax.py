@@ -16,6 +16,60 @@ import os
 import argparse
 import pandas as pd
 from ukbb_cardiac.common.cardiac_utils import *
+from ukbb_cardiac.common.nifti_cache import find_image
+from ukbb_cardiac.common.eval_utils import evaluate_subjects, MISSING
+
+
+COLUMNS = ['Ecc_AHA_1 (%)', 'Ecc_AHA_2 (%)', 'Ecc_AHA_3 (%)',
+           'Ecc_AHA_4 (%)', 'Ecc_AHA_5 (%)', 'Ecc_AHA_6 (%)',
+           'Ecc_AHA_7 (%)', 'Ecc_AHA_8 (%)', 'Ecc_AHA_9 (%)',
+           'Ecc_AHA_10 (%)', 'Ecc_AHA_11 (%)', 'Ecc_AHA_12 (%)',
+           'Ecc_AHA_13 (%)', 'Ecc_AHA_14 (%)', 'Ecc_AHA_15 (%)', 'Ecc_AHA_16 (%)',
+           'Ecc_Global (%)',
+           'Err_AHA_1 (%)', 'Err_AHA_2 (%)', 'Err_AHA_3 (%)',
+           'Err_AHA_4 (%)', 'Err_AHA_5 (%)', 'Err_AHA_6 (%)',
+           'Err_AHA_7 (%)', 'Err_AHA_8 (%)', 'Err_AHA_9 (%)',
+           'Err_AHA_10 (%)', 'Err_AHA_11 (%)', 'Err_AHA_12 (%)',
+           'Err_AHA_13 (%)', 'Err_AHA_14 (%)', 'Err_AHA_15 (%)', 'Err_AHA_16 (%)',
+           'Err_Global (%)']
+
+
+def process_subject(data_dir, par_dir, motion_backend, motion_workers):
+    """ Evaluate the strain of one subject, or return None if it is skipped
+        and MISSING if its files are missing
+        """
+    # Quality control for segmentation at ED
+    # If the segmentation quality is low, the following functions may fail.
+    seg_sa_name = find_image('{0}/seg_sa_ED.nii.gz'.format(data_dir))
+    if not os.path.exists(seg_sa_name):
+        return MISSING
+    if not sa_pass_quality_control(seg_sa_name):
+        return None
+
+    # Intermediate result directory
+    motion_dir = os.path.join(data_dir, 'cine_motion')
+    if not os.path.exists(motion_dir):
+        os.makedirs(motion_dir)
+
+    # Perform motion tracking on short-axis images and calculate the strain
+    cine_2d_sa_motion_and_strain_analysis(data_dir,
+                                          par_dir,
+                                          motion_dir,
+                                          '{0}/strain_sa'.format(data_dir),
+                                          motion_backend=motion_backend,
+                                          n_workers=motion_workers)
+
+    # Remove intermediate files
+    os.system('rm -rf {0}'.format(motion_dir))
+
+    # Record data
+    if os.path.exists('{0}/strain_sa_radial.csv'.format(data_dir)) \
+            and os.path.exists('{0}/strain_sa_circum.csv'.format(data_dir)):
+        df_radial = pd.read_csv('{0}/strain_sa_radial.csv'.format(data_dir), index_col=0)
+        df_circum = pd.read_csv('{0}/strain_sa_circum.csv'.format(data_dir), index_col=0)
+        line = [df_circum.iloc[i, :].min() for i in range(17)] + [df_radial.iloc[i, :].max() for i in range(17)]
+        return line
+    return None
 
 
 if __name__ == '__main__':
@@ -25,6 +79,15 @@ if __name__ == '__main__':
     parser.add_argument('--par_dir', metavar='dir_name', default='', required=True)
     parser.add_argument('--start_idx', metavar='start index', type=int, default=0)
     parser.add_argument('--end_idx', metavar='end index', type=int, default=0)
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of subjects which are evaluated in parallel')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also save the table in the Parquet format')
+    parser.add_argument('--motion_backend', choices=['mirtk', 'sitk'], default='mirtk',
+                        help='Motion tracking using the MIRTK command line tools or '
+                             'the in-process SimpleITK registration')
+    parser.add_argument('--motion_workers', metavar='N', type=int, default=0,
+                        help='Number of registrations which run concurrently for each subject')
     args = parser.parse_args()
 
     data_path = args.data_dir
@@ -32,57 +95,10 @@ if __name__ == '__main__':
     n_data = len(data_list)
     start_idx = args.start_idx
     end_idx = n_data if args.end_idx == 0 else args.end_idx
-    table = []
-    processed_list = []
-    for data in data_list[start_idx:end_idx]:
-        print(data)
-        data_dir = os.path.join(data_path, data)
-
-        # Quality control for segmentation at ED
-        # If the segmentation quality is low, the following functions may fail.
-        seg_sa_name = '{0}/seg_sa_ED.nii.gz'.format(data_dir)
-        if not os.path.exists(seg_sa_name):
-            continue
-        if not sa_pass_quality_control(seg_sa_name):
-            continue
-
-        # Intermediate result directory
-        motion_dir = os.path.join(data_dir, 'cine_motion')
-        if not os.path.exists(motion_dir):
-            os.makedirs(motion_dir)
-
-        # Perform motion tracking on short-axis images and calculate the strain
-        cine_2d_sa_motion_and_strain_analysis(data_dir,
-                                              args.par_dir,
-                                              motion_dir,
-                                              '{0}/strain_sa'.format(data_dir))
-
-        # Remove intermediate files
-        os.system('rm -rf {0}'.format(motion_dir))
-
-        # Record data
-        if os.path.exists('{0}/strain_sa_radial.csv'.format(data_dir)) \
-                and os.path.exists('{0}/strain_sa_circum.csv'.format(data_dir)):
-            df_radial = pd.read_csv('{0}/strain_sa_radial.csv'.format(data_dir), index_col=0)
-            df_circum = pd.read_csv('{0}/strain_sa_circum.csv'.format(data_dir), index_col=0)
-            line = [df_circum.iloc[i, :].min() for i in range(17)] + [df_radial.iloc[i, :].max() for i in range(17)]
-            table += [line]
-            processed_list += [data]
-
-    # Save strain values for all the subjects
-    df = pd.DataFrame(table, index=processed_list,
-                      columns=['Ecc_AHA_1 (%)', 'Ecc_AHA_2 (%)', 'Ecc_AHA_3 (%)',
-                               'Ecc_AHA_4 (%)', 'Ecc_AHA_5 (%)', 'Ecc_AHA_6 (%)',
-                               'Ecc_AHA_7 (%)', 'Ecc_AHA_8 (%)', 'Ecc_AHA_9 (%)',
-                               'Ecc_AHA_10 (%)', 'Ecc_AHA_11 (%)', 'Ecc_AHA_12 (%)',
-                               'Ecc_AHA_13 (%)', 'Ecc_AHA_14 (%)', 'Ecc_AHA_15 (%)', 'Ecc_AHA_16 (%)',
-                               'Ecc_Global (%)',
-                               'Err_AHA_1 (%)', 'Err_AHA_2 (%)', 'Err_AHA_3 (%)',
-                               'Err_AHA_4 (%)', 'Err_AHA_5 (%)', 'Err_AHA_6 (%)',
-                               'Err_AHA_7 (%)', 'Err_AHA_8 (%)', 'Err_AHA_9 (%)',
-                               'Err_AHA_10 (%)', 'Err_AHA_11 (%)', 'Err_AHA_12 (%)',
-                               'Err_AHA_13 (%)', 'Err_AHA_14 (%)', 'Err_AHA_15 (%)', 'Err_AHA_16 (%)',
-                               'Err_Global (%)'])
-    df.to_csv(args.output_csv)
-
+    jobs = [(data, (os.path.join(data_path, data), args.par_dir, args.motion_backend, args.motion_workers))
+            for data in data_list[start_idx:end_idx]]
 
+    # Evaluate the subjects and save strain values for all the subjects.
+    # The results are logged as each subject completes, so that the run can be resumed.
+    evaluate_subjects(process_subject, jobs, args.output_csv, COLUMNS, args.workers,
+                      parquet=args.parquet)
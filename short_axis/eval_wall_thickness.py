@@ -16,89 +16,59 @@ import os
 import argparse
 import pandas as pd
 from ukbb_cardiac.common.cardiac_utils import *
+from ukbb_cardiac.common.nifti_cache import find_image
+from ukbb_cardiac.common.eval_utils import evaluate_subjects, MISSING
+
+
+COLUMNS = ['WT_AHA_1 (mm)', 'WT_AHA_2 (mm)', 'WT_AHA_3 (mm)',
+           'WT_AHA_4 (mm)', 'WT_AHA_5 (mm)', 'WT_AHA_6 (mm)',
+           'WT_AHA_7 (mm)', 'WT_AHA_8 (mm)', 'WT_AHA_9 (mm)',
+           'WT_AHA_10 (mm)', 'WT_AHA_11 (mm)', 'WT_AHA_12 (mm)',
+           'WT_AHA_13 (mm)', 'WT_AHA_14 (mm)', 'WT_AHA_15 (mm)', 'WT_AHA_16 (mm)',
+           'WT_Global (mm)']
+
+
+def process_subject(data_dir, save_vtk):
+    """ Evaluate the wall thickness of one subject, or return None if it is skipped
+        and MISSING if its files are missing
+        """
+    # Quality control for segmentation at ED
+    # If the segmentation quality is low, evaluation of wall thickness may fail.
+    seg_sa_name = find_image('{0}/seg_sa_ED.nii.gz'.format(data_dir))
+    if not os.path.exists(seg_sa_name):
+        return MISSING
+    if not sa_pass_quality_control(seg_sa_name):
+        return None
+
+    # Evaluate myocardial wall thickness
+    evaluate_wall_thickness(seg_sa_name,
+                            '{0}/wall_thickness_ED'.format(data_dir),
+                            save_vtk=save_vtk)
+
+    # Record data
+    if os.path.exists('{0}/wall_thickness_ED.csv'.format(data_dir)):
+        df = pd.read_csv('{0}/wall_thickness_ED.csv'.format(data_dir), index_col=0)
+        line = df['Thickness'].values
+        return line
+    return None
 
-BATCH_SIZE = 500
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', metavar='dir_name', default='', required=True)
     parser.add_argument('--output_csv', metavar='csv_name', default='', required=True)
+    parser.add_argument('--no_vtk', action='store_true',
+                        help='Do not save the endocardial contours with the wall thickness to vtk files')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of subjects which are evaluated in parallel')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Also save the table in the Parquet format')
     args = parser.parse_args()
 
     data_path = args.data_dir
-
-    output_dir = os.path.dirname(args.output_csv)
-    output_csv_prefix = os.path.basename(args.output_csv) + '.'
-    completed_csv_list = sorted(filter(lambda x:x.startswith(output_csv_prefix), os.listdir(output_dir)))
-    completed_subjects = set()
-
-    batch = 0
-    for csv_file in completed_csv_list:
-        csv_batch = int(csv_file[len(output_csv_prefix):])
-        if csv_batch > batch:
-            batch = csv_batch
-        csv_df = pd.read_csv(os.path.join(output_dir, csv_file))
-        completed_subjects.update(csv_df[csv_df.columns[0]].values.tolist())
-    batch += 1
-
     data_list = sorted(filter(lambda x:not x.startswith('.'), os.listdir(data_path)))
-    table = []
-    processed_list = []
-    processed = 0
-    skipped = 0
-    count = 0
-    for data in data_list:
-        if data in completed_subjects:
-            skipped += 1
-            continue
-        print(data)
-        data_dir = os.path.join(data_path, data)
-
-        # Quality control for segmentation at ED
-        # If the segmentation quality is low, evaluation of wall thickness may fail.
-        seg_sa_name = '{0}/seg_sa_ED.nii.gz'.format(data_dir)
-        if not os.path.exists(seg_sa_name):
-            continue
-        if not sa_pass_quality_control(seg_sa_name):
-            continue
-
-        # Evaluate myocardial wall thickness
-        evaluate_wall_thickness('{0}/seg_sa_ED.nii.gz'.format(data_dir),
-                                '{0}/wall_thickness_ED'.format(data_dir))
+    jobs = [(data, (os.path.join(data_path, data), not args.no_vtk)) for data in data_list]
 
-        # Record data
-        if os.path.exists('{0}/wall_thickness_ED.csv'.format(data_dir)):
-            df = pd.read_csv('{0}/wall_thickness_ED.csv'.format(data_dir), index_col=0)
-            line = df['Thickness'].values
-            table += [line]
-            processed_list += [data]
-            processed += 1
-            count += 1
-            if count >= BATCH_SIZE:
-                # write out current batch
-                df = pd.DataFrame(table, index=processed_list,
-                                columns=['WT_AHA_1 (mm)', 'WT_AHA_2 (mm)', 'WT_AHA_3 (mm)',
-                                        'WT_AHA_4 (mm)', 'WT_AHA_5 (mm)', 'WT_AHA_6 (mm)',
-                                        'WT_AHA_7 (mm)', 'WT_AHA_8 (mm)', 'WT_AHA_9 (mm)',
-                                        'WT_AHA_10 (mm)', 'WT_AHA_11 (mm)', 'WT_AHA_12 (mm)',
-                                        'WT_AHA_13 (mm)', 'WT_AHA_14 (mm)', 'WT_AHA_15 (mm)', 'WT_AHA_16 (mm)',
-                                        'WT_Global (mm)'])
-                df.to_csv(os.path.join(output_dir, f'{output_csv_prefix}{batch:04d}'))
-                count = 0
-                batch += 1
-                table = []
-                processed_list = []
-        
-    # write out the remainders
-    if count > 0:
-        # write out current batch
-        df = pd.DataFrame(table, index=processed_list,
-                        columns=['WT_AHA_1 (mm)', 'WT_AHA_2 (mm)', 'WT_AHA_3 (mm)',
-                                'WT_AHA_4 (mm)', 'WT_AHA_5 (mm)', 'WT_AHA_6 (mm)',
-                                'WT_AHA_7 (mm)', 'WT_AHA_8 (mm)', 'WT_AHA_9 (mm)',
-                                'WT_AHA_10 (mm)', 'WT_AHA_11 (mm)', 'WT_AHA_12 (mm)',
-                                'WT_AHA_13 (mm)', 'WT_AHA_14 (mm)', 'WT_AHA_15 (mm)', 'WT_AHA_16 (mm)',
-                                'WT_Global (mm)'])
-        df.to_csv(os.path.join(output_dir, f'{output_csv_prefix}{batch:04d}'))
-    
-    print(f'processed: {processed}, skipped: {skipped}')
\ No newline at end of file
+    # Evaluate the subjects and save the measures in batches of the results store
+    evaluate_subjects(process_subject, jobs, args.output_csv, COLUMNS, args.workers,
+                      parquet=args.parquet)
@@ -0,0 +1,194 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Tests of assoc/assoc_utils.py against the per-column implementations it replaces
+    in assoc/perform_phenome_wide_association.py.
+    """
+import math
+import datetime
+import warnings
+import numpy as np
+import scipy.special
+import scipy.stats
+from ukbb_cardiac.assoc.assoc_utils import age_by_date, normalise, normalise_columns, \
+    rank_columns, rank_normalise_columns, masked_pearsonr, collinear_columns, deconfound
+
+
+def random_data(n_subj, n_col, seed=0):
+    """ Correlated columns with missing values, tied values and a constant column """
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n_subj, n_col))
+    X[:, 1] += 0.5 * X[:, 0]
+    X[:, 2] = np.round(X[:, 2])
+    X[:, 3] = 1.0
+    X[rng.uniform(size=X.shape) < 0.2] = np.nan
+    return X
+
+
+def pearsonr_loop(X, Y):
+    """ The original loop of scipy.stats.pearsonr over the pairs of columns """
+    corr = np.zeros((X.shape[1], Y.shape[1]))
+    corr_p = np.zeros((X.shape[1], Y.shape[1]))
+    for i in range(X.shape[1]):
+        for j in range(Y.shape[1]):
+            valid_idx = ~np.isnan(X[:, i]) & ~np.isnan(Y[:, j])
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                corr[i, j], corr_p[i, j] = scipy.stats.pearsonr(X[valid_idx, i], Y[valid_idx, j])
+    return corr, corr_p
+
+
+def test_masked_pearsonr():
+    X = random_data(300, 5, seed=0)
+    Y = np.concatenate((random_data(300, 7, seed=1), X[:, :2] * 2 + 1), axis=1)
+    corr, corr_p = masked_pearsonr(X, Y, chunk_size=3)
+    corr2, corr_p2 = pearsonr_loop(X, Y)
+
+    # The constant column gives NaN
+    assert np.all(np.isnan(corr[3])) and np.all(np.isnan(corr[:, 3]))
+    assert np.array_equal(np.isnan(corr), np.isnan(corr2))
+    assert np.allclose(corr, corr2, rtol=0, atol=1e-12, equal_nan=True)
+    assert np.allclose(corr_p, corr_p2, rtol=1e-9, atol=1e-300, equal_nan=True)
+
+
+def collinear_loop(X):
+    """ The original double loop of the data cleaning """
+    n_col = X.shape[1]
+    bad_vars = []
+    for i in range(n_col):
+        for j in range(i + 1, n_col):
+            if i in bad_vars or j in bad_vars:
+                continue
+            val_i = X[:, i]
+            val_j = X[:, j]
+            valid_idx = ~np.isnan(val_i) & ~np.isnan(val_j)
+            if np.sum(valid_idx) == 0:
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                cc, _ = scipy.stats.pearsonr(val_i[valid_idx], val_j[valid_idx])
+            if cc > 0.9999:
+                if np.sum(~np.isnan(val_i)) > np.sum(~np.isnan(val_j)):
+                    bad_vars += [j]
+                else:
+                    bad_vars += [i]
+    return sorted(bad_vars)
+
+
+def test_collinear_columns():
+    X = random_data(300, 12, seed=2)
+    rng = np.random.RandomState(3)
+    # Duplicates with more or fewer missing values, a chain of duplicates,
+    # an anti-correlated column and a duplicate of the constant column
+    X[:, 5] = X[:, 0] * 3 + 2
+    X[:, 6] = np.where(rng.uniform(size=300) < 0.5, np.nan, X[:, 0])
+    X[:, 7] = X[:, 1]
+    X[:, 8] = -X[:, 4]
+    X[:, 9] = X[:, 3]
+    X[:, 11] = X[:, 7]
+    X[:, 11][np.isnan(X[:, 11])] = 0.5
+
+    expected = collinear_loop(X)
+    assert len(expected) >= 3
+    assert collinear_columns(X, chunk_size=5) == expected
+    assert collinear_columns(X, chunk_size=100) == expected
+
+
+def test_deconfound():
+    rng = np.random.RandomState(4)
+    conf = rng.normal(size=(200, 5))
+    Y = np.dot(conf, rng.normal(size=(5, 8))) + rng.normal(size=(200, 8))
+    # Columns sharing a pattern of missing values, a column without any value
+    # and a column with fewer values than confounding factors
+    missing = rng.uniform(size=200) < 0.3
+    Y[missing, 1] = np.nan
+    Y[missing, 2] = np.nan
+    Y[rng.uniform(size=200) < 0.5, 3] = np.nan
+    Y[:, 4] = np.nan
+    Y[3:, 5] = np.nan
+
+    residual, beta = deconfound(Y, conf)
+
+    # The original loop with the pseudo-inverse for each column
+    for i in range(Y.shape[1]):
+        valid_idx = ~np.isnan(Y[:, i])
+        assert np.array_equal(np.isnan(residual[:, i]), ~valid_idx)
+        if not np.any(valid_idx):
+            continue
+        b = np.dot(np.linalg.pinv(conf[valid_idx]), Y[valid_idx, i])
+        x = Y[valid_idx, i] - np.dot(conf[valid_idx], b)
+        assert np.allclose(beta[:, i], b, rtol=0, atol=1e-10)
+        assert np.allclose(residual[valid_idx, i], x, rtol=0, atol=1e-10)
+
+
+def rank_normalise_loop(x):
+    """ The original rank-based inverse normal transform of a column """
+    ri = np.argsort(np.argsort(x))
+    u, inv_idx = np.unique(x, return_inverse=True)
+    sii = np.sort(inv_idx)
+    repeated_idx = np.unique(sii[np.diff(np.append(sii, 1)) == 0])
+    for i in repeated_idx:
+        ri[inv_idx == i] = np.mean(ri[inv_idx == i])
+    N = len(x)
+    ri = ri + 1
+    c = 3.0 / 8
+    p = (ri - c) / (N - 2 * c + 1)
+    return math.sqrt(2) * scipy.special.erfinv(2 * p - 1)
+
+
+def test_rank_columns():
+    X = random_data(300, 6, seed=5)
+    ranks = rank_columns(X)
+    for i in range(X.shape[1]):
+        valid_idx = ~np.isnan(X[:, i])
+        assert np.all(np.isnan(ranks[~valid_idx, i]))
+        assert np.array_equal(ranks[valid_idx, i], scipy.stats.rankdata(X[valid_idx, i]))
+
+
+def test_rank_normalise_columns():
+    X = random_data(300, 6, seed=6)
+    X[:, 4] = np.round(X[:, 4] * 2)
+    Y = rank_normalise_columns(X, chunk_size=4)
+    for i in range(X.shape[1]):
+        valid_idx = ~np.isnan(X[:, i])
+        assert np.all(np.isnan(Y[~valid_idx, i]))
+        assert np.array_equal(Y[valid_idx, i], rank_normalise_loop(X[valid_idx, i]))
+
+
+def test_normalise_columns():
+    X = random_data(300, 6, seed=7)
+    X[:, 3] = np.nan
+    X[:2, 3] = 1.0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        Y = normalise_columns(X)
+        for i in range(X.shape[1]):
+            valid_idx = ~np.isnan(X[:, i])
+            assert np.allclose(Y[valid_idx, i], normalise(X[valid_idx, i]), rtol=0, atol=1e-12, equal_nan=True)
+
+
+def test_age_by_date():
+    year = np.array([1950, 1960, 1945, 1970, 1955], dtype=np.float64)
+    month = np.array([1, 12, 2, 6, 3], dtype=np.float64)
+    date = np.array(['2015-06-30', '2016-01-01', '2014-02-14', '2019-12-31', np.nan], dtype=object)
+    age = age_by_date(year, month, date)
+
+    # The original computation with datetime for each subject
+    for i in range(4):
+        d1 = datetime.date(int(year[i]), int(month[i]), 15)
+        s = date[i]
+        d2 = datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+        assert age[i] == np.round((d2 - d1).days / 365.25, 1)
+    assert np.isnan(age[4])
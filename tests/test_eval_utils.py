@@ -0,0 +1,145 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Tests of the results store and the table functions of common/eval_utils.py.
+    """
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from ukbb_cardiac.common.eval_utils import ResultsStore, consolidate, evaluate_subjects, read_table, \
+    read_units, save_table, parquet_name, MISSING, TIME_COLUMN
+
+COLUMNS = ['LVEDV (mL)', 'LVEF (%)']
+
+
+def test_resume_after_partial_journal(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    store = ResultsStore(output_csv, COLUMNS, batch_size=10)
+    store.append('1001', [150.0, 60.0], 1.0)
+    store.append('1002', [140.0, 55.0], 2.0)
+    # The run crashes while a row is being written
+    store.journal.write('1003,130.0,5')
+    store.flush_journal()
+
+    store = ResultsStore(output_csv, COLUMNS, batch_size=10)
+    assert '1001' in store and '1002' in store
+    assert '1003' not in store
+    store.close()
+
+    df = consolidate(output_csv)
+    assert list(df.index.astype(str)) == ['1001', '1002']
+    assert df.loc[1002, 'LVEF (%)'] == 55.0
+    assert TIME_COLUMN not in df.columns
+    assert not os.path.exists('{0}.journal'.format(output_csv))
+
+
+def test_unindexed_batch(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    # A batch written by the old scripts, or committed just before a crash, is not indexed
+    df = pd.DataFrame([[150.0, 60.0], [140.0, 55.0]], index=['1001', '1002'], columns=COLUMNS)
+    df.to_csv('{0}.0003'.format(output_csv))
+
+    store = ResultsStore(output_csv, COLUMNS, batch_size=1)
+    assert '1001' in store and '1002' in store
+    store.append('1003', [130.0, 50.0], 1.0)
+    store.close()
+    assert os.path.exists('{0}.0004'.format(output_csv))
+
+    # The batch is indexed once, so it is not read again
+    with open('{0}.index'.format(output_csv)) as f:
+        assert f.read().split('\n')[:-1] == ['3,1001', '3,1002', '4,1003']
+
+
+def test_consolidate_keeps_last_duplicate(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    pd.DataFrame([[150.0, 60.0], [140.0, 55.0]], index=['1002', '1001'],
+                 columns=COLUMNS).to_csv('{0}.0001'.format(output_csv))
+    pd.DataFrame([[145.0, 58.0]], index=['1002'], columns=COLUMNS).to_csv('{0}.0002'.format(output_csv))
+
+    df = consolidate(output_csv)
+    assert list(df.index) == [1001, 1002]
+    assert df.loc[1002, 'LVEDV (mL)'] == 145.0
+
+
+def test_skipped_subjects_are_recorded(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    calls = []
+    available = {1, 2, 3, 4}
+
+    def func(x):
+        calls.append(x)
+        if x not in available:
+            return MISSING
+        return None if x % 2 == 0 else [x, x]
+
+    jobs = [(str(x), (x,)) for x in range(1, 6)]
+    evaluate_subjects(func, jobs, output_csv, COLUMNS, batch_size=2)
+    assert calls == [1, 2, 3, 4, 5]
+
+    # The skipped subjects are not evaluated again on resume and not saved in the table,
+    # but a subject whose files were missing is evaluated once they exist
+    available.add(5)
+    evaluate_subjects(func, jobs, output_csv, COLUMNS, batch_size=2)
+    assert calls == [1, 2, 3, 4, 5, 5]
+    assert list(pd.read_csv(output_csv, index_col=0).index) == [1, 3, 5]
+
+
+def test_incremental_consolidate(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    jobs = [(str(x), (x,)) for x in range(1, 5)]
+    evaluate_subjects(lambda x: [x, x], jobs[:2], output_csv, COLUMNS, batch_size=1)
+
+    # Only the new batch is read to update the table, so the merged batches can be removed
+    os.remove('{0}.0001'.format(output_csv))
+    evaluate_subjects(lambda x: [x, x], jobs[:3], output_csv, COLUMNS, batch_size=1)
+    df = pd.read_csv(output_csv, index_col=0)
+    assert list(df.index) == [1, 2, 3]
+    assert list(pd.read_csv('{0}_time.csv'.format(str(tmp_path / 'table')), index_col=0).index) == [1, 2, 3]
+
+    # The table is not rewritten if nothing has changed
+    mtime = os.path.getmtime(output_csv)
+    assert consolidate(output_csv, incremental=True) is None
+    assert os.path.getmtime(output_csv) == mtime
+
+    # A full merge reads all the remaining batches
+    assert list(consolidate(output_csv).index) == [2, 3]
+
+
+def test_read_table_columns(tmp_path):
+    output_csv = str(tmp_path / 'table.csv')
+    df = pd.DataFrame([[150.0, 60.0, 1.0], [140.0, 55.0, 2.0]], index=['1001', '1002'],
+                      columns=COLUMNS + ['RVEDV (mL)'])
+    save_table(df, output_csv)
+
+    df2 = read_table(output_csv, columns=['RVEDV (mL)', 'LVEF (%)'])
+    assert list(df2.columns) == ['RVEDV (mL)', 'LVEF (%)']
+    assert np.array_equal(df2.values, df[['RVEDV (mL)', 'LVEF (%)']].values)
+
+
+def test_parquet_units(tmp_path):
+    pytest.importorskip('pyarrow')
+    output_csv = str(tmp_path / 'table.csv')
+    df = pd.DataFrame([[150.0, 60.0, 1], [140.0, 55.0, 2]], index=[1001, 1002],
+                      columns=COLUMNS + ['Count'])
+    save_table(df, output_csv, parquet=True)
+
+    filename = parquet_name(output_csv)
+    assert read_units(filename) == {'LVEDV (mL)': 'mL', 'LVEF (%)': '%', 'Count': ''}
+    df2 = read_table(filename)
+    assert df2.index.name == 'subject'
+    assert df2['Count'].dtype == np.int64
+    assert np.array_equal(df2.values, df.values)
+    assert list(read_table(filename, columns=['LVEF (%)']).columns) == ['LVEF (%)']
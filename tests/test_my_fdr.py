@@ -0,0 +1,47 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Tests of the permutation-based corrections in assoc/my_fdr.py.
+    """
+import numpy as np
+from ukbb_cardiac.assoc.my_fdr import fwer_threshold, fwer_p_adjust
+
+
+def test_fwer_threshold_is_an_order_statistic():
+    min_p = np.arange(1, 101) / 1000.0
+    np.random.RandomState(0).shuffle(min_p)
+    # floor(0.05 * 100) = 5, the 5th smallest minimum p-value
+    assert fwer_threshold(min_p, 0.05) == 0.005
+    # floor(0.055 * 100) = 5, where an interpolated quantile would be above 0.005
+    assert fwer_threshold(min_p, 0.055) == 0.005
+    # Fewer than 1 / alpha permutations
+    assert fwer_threshold(min_p[:10], 0.05) == 0
+
+
+def test_fwer_threshold_controls_fwer():
+    rng = np.random.RandomState(1)
+    for n_perm in [20, 99, 100, 1000, 1001]:
+        min_p = rng.uniform(size=n_perm) ** 3
+        for alpha in [0.01, 0.05, 0.1]:
+            t = fwer_threshold(min_p, alpha)
+            assert np.sum(min_p < t) <= alpha * n_perm
+
+
+def test_fwer_p_adjust():
+    min_p = np.array([0.001, 0.01, 0.02, 0.5])
+    p = np.array([0.0005, 0.01, 0.9, np.nan])
+    p_adj = fwer_p_adjust(p, min_p)
+    assert np.allclose(p_adj[:3], [1 / 5.0, 3 / 5.0, 1.0])
+    assert np.isnan(p_adj[3])
@@ -0,0 +1,53 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Tests of the UNet feature map which deploy_network_ao.py reuses across the time windows.
+    """
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('UNet_LSTM_Model needs TensorFlow 1.x', allow_module_level=True)
+
+from ukbb_cardiac.common.network_ao import UNet_LSTM_Model, find_lstm_features
+
+
+def test_reused_features_match_full_network():
+    X, T, time_window = 16, 5, 3
+    graph = tf.Graph()
+    with graph.as_default():
+        image_pl = tf.placeholder(tf.float32, shape=[None, None, None, None, 1], name='image')
+        label_pl = tf.placeholder(tf.int32, shape=[None, None, None, None], name='label')
+        training_pl = tf.placeholder(tf.bool, shape=[], name='training')
+        UNet_LSTM_Model(image_pl, label_pl, 3, 2, [4, 8], [1, 1], [X, X, 4], 4, time_window,
+                        training_pl, bidirectional=True, seq2seq=True, weight_R=2, weight_r=0.1)
+        features_tensor = find_lstm_features(graph)
+        assert features_tensor is not None
+
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            image = np.random.RandomState(0).normal(size=(1, T, X, X, 1)).astype(np.float32)
+
+            # The features of all the time frames, computed in chunks of time_window frames
+            features = np.concatenate([sess.run(features_tensor, {image_pl: image[:, t:t + time_window],
+                                                                  training_pl: False})
+                                       for t in range(0, T, time_window)], axis=1)
+
+            for t in range(T):
+                idx = [(t + d) % T for d in range(-1, 2)]
+                prob = sess.run('prob:0', {image_pl: image[:, idx], training_pl: False})
+                prob_reused = sess.run('prob:0', {features_tensor: features[:, idx], training_pl: False})
+                assert np.allclose(prob, prob_reused, atol=1e-5)
@@ -0,0 +1,46 @@
+# Copyright 2019, Wenjia Bai. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""
+    Tests of assoc/permutation_test.py.
+    """
+import numpy as np
+from ukbb_cardiac.assoc.assoc_utils import masked_pearsonr
+from ukbb_cardiac.assoc.permutation_test import permutation_test
+
+
+def test_permutation_test_is_reproducible():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(100, 3))
+    Y = rng.normal(size=(100, 5))
+    Y[rng.uniform(size=Y.shape) < 0.2] = np.nan
+    _, corr_p = masked_pearsonr(X, Y)
+
+    min_p, null_counts = permutation_test(X, Y, corr_p, n_perm=20, seed=1, n_workers=1)
+    min_p2, null_counts2 = permutation_test(X, Y, n_perm=20, seed=1, n_workers=2)
+    assert np.array_equal(min_p, min_p2)
+    assert np.array_equal(null_counts, null_counts2)
+    assert min_p.shape == (20,) and null_counts.shape == (15,)
+    # At most the 15 p-values of a permutation are counted, increasingly with the threshold
+    assert np.all(null_counts <= 15) and np.all(np.diff(null_counts) >= 0)
+
+
+def test_permutation_test_without_valid_p_values():
+    # A constant column gives no valid correlation
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(50, 2))
+    Y = np.ones((50, 1))
+    min_p, null_counts = permutation_test(X, Y, n_perm=5, seed=0)
+    assert np.array_equal(min_p, np.ones(5))
+    assert len(null_counts) == 0